@@ -12,6 +12,8 @@ import uvicorn
 import os
 import sqlite3
 import pathlib
+import html
+import uuid
 
 # ====== 配置区 ======
 API_ID = os.getenv('API_ID', '611335')  # 可用环境变量覆盖
@@ -80,8 +82,11 @@ def safe_database_operation(operation_func):
         try:
             return operation_func(*args, **kwargs)
         except sqlite3.Error as e:
+            # 共享连接上未提交的部分写入不能留给下一次操作一起提交
+            rollback_db()
             raise Exception(f"数据库操作失败: {str(e)}")
         except Exception as e:
+            rollback_db()
             raise Exception(f"操作失败: {str(e)}")
     return wrapper
 
@@ -122,9 +127,114 @@ def format_error_message(operation: str, error: Exception) -> str:
     else:
         return f"❌ {operation}失败：{error_msg}"
 
+# ====== 数据库连接 ======
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# 共享连接的页缓存大小（KB）和语句缓存条数
+DB_CACHE_SIZE_KB = 16384
+DB_CACHED_STATEMENTS = 256
+# 只读查询线程数
+DB_READER_THREADS = 3
+
+_db_local = threading.local()
+
+def get_db() -> sqlite3.Connection:
+    """
+    获取当前线程的长期数据库连接
+    
+    每个线程（事件循环、写线程、读线程）首次使用时打开一个连接并一直保持，开启 WAL 日志
+    （读写互不阻塞，提交只追加日志），各数据库函数复用该连接及其语句缓存，
+    不再每次调用都重新打开文件、解析表结构
+    """
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, cached_statements=DB_CACHED_STATEMENTS)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # WAL 模式下 NORMAL 只在检查点时 fsync，断电最多丢失最近的提交，不会损坏数据库
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        _db_local.conn = conn
+    return conn
+
+def rollback_db():
+    """回滚当前线程连接上未提交的事务"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        try:
+            conn.rollback()
+        except sqlite3.Error as e:
+            print(f"[db] 回滚失败: {e}")
+
+def close_db():
+    """关闭当前线程的连接"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _db_local.conn = None
+
+class AsyncDatabase:
+    """
+    在线程中执行数据库函数，避免磁盘慢时阻塞事件循环
+    
+    所有写操作由同一个写线程按提交顺序串行执行，只读查询交给读线程池；
+    还有已提交未完成的写操作时，读也排到写线程中，保证能读到之前提交的写入；
+    read/write 供协程 await，submit_write 用于同步代码中不需要等待结果的写入
+    """
+    def __init__(self, reader_threads: int = DB_READER_THREADS):
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self.readers = ThreadPoolExecutor(max_workers=reader_threads, thread_name_prefix='db-reader')
+        self.last_write = None  # 最近提交的写操作，写线程按顺序执行，它完成即之前的写入都已完成
+    
+    async def read(self, func, *args, **kwargs):
+        if self.last_write is not None and not self.last_write.done():
+            return await asyncio.wrap_future(self.writer.submit(func, *args, **kwargs))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.readers, functools.partial(func, *args, **kwargs))
+    
+    async def write(self, func, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit_write(func, *args, **kwargs))
+    
+    def submit_write(self, func, *args, **kwargs):
+        """提交写操作，返回 concurrent.futures.Future；无人等待时失败只记录日志"""
+        future = self.writer.submit(func, *args, **kwargs)
+        future.add_done_callback(functools.partial(self._log_error, func.__name__))
+        self.last_write = future
+        return future
+    
+    @staticmethod
+    def _log_error(name: str, future):
+        if not future.cancelled() and future.exception():
+            print(f"[db] {name} 执行失败: {future.exception()}")
+    
+    def close(self):
+        """等待已提交的写入完成后关闭线程（退出时调用）"""
+        self.writer.submit(close_db)
+        self.writer.shutdown(wait=True)
+        self.readers.shutdown(wait=False)
+        close_db()
+
+async_db = AsyncDatabase()
+
+def async_db_read(func):
+    """生成在读线程池中执行 func 的协程版本"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await async_db.read(func, *args, **kwargs)
+    return wrapper
+
+def async_db_write(func):
+    """生成在写线程中执行 func 的协程版本"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await async_db.write(func, *args, **kwargs)
+    return wrapper
+
 # ====== 自动下载配置数据库和设置 ======
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS auto_download (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -151,6 +261,36 @@ def init_db():
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )''')
+    # 任务日志字段：任务类型、目标路径、进度通知的会话和调度优先级，重启后据此重新执行
+    for column in ('job_type TEXT', 'file_path TEXT', 'bot_chat_id INTEGER', 'priority INTEGER DEFAULT 0'):
+        try:
+            c.execute(f'ALTER TABLE download_tasks ADD COLUMN {column}')
+        except sqlite3.OperationalError:
+            pass
+    # 按状态、用户筛选和按创建时间分页（created_at, task_id 作为键集游标）
+    c.execute('CREATE INDEX IF NOT EXISTS idx_download_tasks_created ON download_tasks (created_at, task_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_download_tasks_status ON download_tasks (status, created_at, task_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_download_tasks_user ON download_tasks (user_id, created_at, task_id)')
+    # 已归档的历史任务（只保留统计需要的字段）及按天汇总的任务统计
+    c.execute('''CREATE TABLE IF NOT EXISTS download_tasks_archive (
+        task_id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        chat_id TEXT,
+        msg_id INTEGER,
+        status TEXT,
+        total_size INTEGER DEFAULT 0,
+        file_count INTEGER DEFAULT 0,
+        created_at TIMESTAMP,
+        updated_at TIMESTAMP
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS download_stats_daily (
+        day TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        task_count INTEGER DEFAULT 0,
+        total_size INTEGER DEFAULT 0,
+        PRIMARY KEY (day, user_id, status)
+    )''')
     # 关键词监听表
     c.execute('''CREATE TABLE IF NOT EXISTS keyword_monitors (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -161,46 +301,152 @@ def init_db():
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         UNIQUE(chat_id)
     )''')
+    # 范围下载任务，cursor 为已处理完的最后一条消息ID，用于重启后继续
+    c.execute('''CREATE TABLE IF NOT EXISTS range_jobs (
+        job_id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        chat_id TEXT NOT NULL,
+        bot_chat_id INTEGER NOT NULL,
+        min_id INTEGER NOT NULL,
+        max_id INTEGER NOT NULL,
+        cursor INTEGER NOT NULL,
+        status TEXT DEFAULT 'running',
+        downloaded INTEGER DEFAULT 0,
+        skipped INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        reply_to INTEGER
+    )''')
+    # 旧数据库的 range_jobs 没有 reply_to 列（评论区下载任务）
+    try:
+        c.execute('ALTER TABLE range_jobs ADD COLUMN reply_to INTEGER')
+    except sqlite3.OperationalError:
+        pass
+    # 频道/群组实体缓存，key 为用户名或 ID
+    c.execute('''CREATE TABLE IF NOT EXISTS entity_cache (
+        key TEXT PRIMARY KEY,
+        entity_id INTEGER NOT NULL,
+        peer_id INTEGER NOT NULL,
+        peer_type TEXT,
+        access_hash INTEGER,
+        title TEXT,
+        username TEXT,
+        updated_at REAL NOT NULL
+    )''')
+    # 已下载的媒体文件，按 Telegram 文件 ID + 大小去重
+    c.execute('''CREATE TABLE IF NOT EXISTS media_store (
+        media_key TEXT PRIMARY KEY,
+        file_path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    # 额外的 userbot 账号（主账号使用 USER_SESSION）
+    c.execute('''CREATE TABLE IF NOT EXISTS userbot_accounts (
+        name TEXT PRIMARY KEY,
+        session_path TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
     # 默认最大并发下载数为3
     c.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('max_concurrent_downloads', '3'))
     # 默认进度刷新间隔为1秒
     c.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('refresh_interval', '1'))
     # 文件分类开关，默认关闭
     c.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('file_classification', '0'))
+    # 大文件并行下载连接数（1 表示关闭并行），以及启用并行的文件大小阈值（MB）
+    c.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('parallel_connections', '4'))
+    c.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('parallel_threshold_mb', '20'))
+    # 自动调节并发数（AIMD），以及自动模式下的并发上限
+    c.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('auto_concurrency', '0'))
+    c.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('auto_concurrency_max', '10'))
+    # 连接池用过的媒体 DC，启动时预热
+    c.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('sender_pool_dcs', ''))
     # 管理员和允许用户
     c.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('admin_ids', ''))
     c.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('allowed_user_ids', ''))
+    # 已结束任务的保留策略：保留天数，以及每个用户保留的条数（0 表示不按该条件清理）
+    c.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('task_retention_days', '30'))
+    c.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('task_retention_per_user', '0'))
     conn.commit()
-    conn.close()
+    # 导入模块时（建表和写入默认值之前）可能已经加载过设置快照，这里重新加载
+    settings_cache.reload()
 
 @safe_database_operation
-def get_setting(key):
-    conn = sqlite3.connect(DB_PATH)
+def add_auto_download(chat):
+    conn = get_db()
     c = conn.cursor()
-    c.execute('SELECT value FROM settings WHERE key=?', (key,))
-    row = c.fetchone()
-    conn.close()
-    return row[0] if row else ''
+    c.execute('INSERT OR IGNORE INTO auto_download (chat) VALUES (?)', (chat,))
+    conn.commit()
 
 @safe_database_operation
-def set_setting(key, value):
-    conn = sqlite3.connect(DB_PATH)
+def load_settings() -> dict:
+    """读取整个 settings 表"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT key, value FROM settings')
+    return dict(c.fetchall())
+
+class SettingsCache:
+    """
+    settings 表的内存快照
+    
+    首次读取时整表加载，之后的读取和权限检查不再访问数据库；
+    set_setting 先更新快照，再交给写线程写库。多实例共用数据库时，
+    其他实例的修改需要通过 reload（/reloadsettings）重新加载
+    """
+    def __init__(self):
+        self.values = None  # key -> value，None 表示尚未加载
+        self.id_sets = {}  # key -> 解析后的用户ID集合
+    
+    def reload(self):
+        self.values = load_settings()
+        self.id_sets.clear()
+    
+    def get(self, key: str) -> str:
+        if self.values is None:
+            self.reload()
+        return self.values.get(key, '')
+    
+    def set(self, key: str, value: str):
+        if self.values is not None:
+            self.values[key] = value
+        self.id_sets.pop(key, None)
+    
+    def get_id_set(self, key: str) -> set:
+        """按逗号分隔的ID列表，解析结果缓存到下次修改"""
+        ids = self.id_sets.get(key)
+        if ids is None:
+            ids = set(int(i) for i in self.get(key).split(',') if i)
+            self.id_sets[key] = ids
+        return ids
+
+settings_cache = SettingsCache()
+
+@safe_database_operation
+def get_setting(key):
+    return settings_cache.get(key)
+
+@safe_database_operation
+def save_setting(key, value):
+    conn = get_db()
     c = conn.cursor()
     c.execute('REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
     conn.commit()
-    conn.close()
+
+def set_setting(key, value):
+    """更新设置：立即更新内存快照，写库在写线程中按顺序执行，不阻塞事件循环"""
+    settings_cache.set(key, value)
+    async_db.submit_write(save_setting, key, value)
 
 def get_admin_ids():
     try:
-        ids = get_setting('admin_ids')
-        return set(int(i) for i in ids.split(',') if i)
+        return set(settings_cache.get_id_set('admin_ids'))
     except Exception:
         return set()
 
 def get_allowed_user_ids():
     try:
-        ids = get_setting('allowed_user_ids')
-        return set(int(i) for i in ids.split(',') if i)
+        return set(settings_cache.get_id_set('allowed_user_ids'))
     except Exception:
         return set()
 
@@ -232,23 +478,15 @@ def remove_allowed_user(user_id):
 
 def get_max_concurrent_downloads():
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('SELECT value FROM settings WHERE key=?', ('max_concurrent_downloads',))
-        row = c.fetchone()
-        conn.close()
-        return int(row[0]) if row else 3
+        value = get_setting('max_concurrent_downloads')
+        return int(value) if value else 3
     except Exception:
         return 3
 
 def get_refresh_interval():
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('SELECT value FROM settings WHERE key=?', ('refresh_interval',))
-        row = c.fetchone()
-        conn.close()
-        return float(row[0]) if row else 1.0
+        value = get_setting('refresh_interval')
+        return float(value) if value else 1.0
     except Exception:
         return 1.0
 
@@ -265,12 +503,8 @@ def set_refresh_interval(value):
 def get_file_classification():
     """获取文件分类开关状态"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('SELECT value FROM settings WHERE key=?', ('file_classification',))
-        row = c.fetchone()
-        conn.close()
-        return bool(int(row[0])) if row else False
+        value = get_setting('file_classification')
+        return bool(int(value)) if value else False
     except Exception:
         return False
 
@@ -279,12 +513,108 @@ def set_file_classification(enabled):
     """设置文件分类开关"""
     set_setting('file_classification', '1' if enabled else '0')
 
+def get_parallel_connections():
+    """获取大文件并行下载的连接数"""
+    try:
+        value = get_setting('parallel_connections')
+        return int(value) if value else 4
+    except Exception:
+        return 4
+
+def get_parallel_threshold():
+    """获取启用并行下载的文件大小阈值（字节）"""
+    try:
+        value = get_setting('parallel_threshold_mb')
+        return int(float(value) * 1024 * 1024) if value else 20 * 1024 * 1024
+    except Exception:
+        return 20 * 1024 * 1024
+
+def get_auto_concurrency():
+    """获取是否自动调节并发数"""
+    try:
+        return get_setting('auto_concurrency') == '1'
+    except Exception:
+        return False
+
+def get_auto_concurrency_max():
+    """获取自动调节模式下的并发上限"""
+    try:
+        value = get_setting('auto_concurrency_max')
+        return int(value) if value else 10
+    except Exception:
+        return 10
+
+@safe_database_operation
+def set_auto_concurrency(enabled, max_value=None):
+    """设置并发数自动调节开关及上限"""
+    set_setting('auto_concurrency', '1' if enabled else '0')
+    if max_value is not None:
+        set_setting('auto_concurrency_max', str(max_value))
+
+def get_bandwidth_limit(scope: str) -> float:
+    """获取带宽限制（字节/秒），scope 为 global 或 user:<用户ID>，0 表示不限制"""
+    try:
+        value = get_setting(f'bandwidth_limit_{scope}')
+        return float(value) if value else 0
+    except Exception:
+        return 0
+
+def get_task_retention() -> tuple[int, int]:
+    """获取已结束任务的保留策略 (保留天数, 每用户保留条数)，0 表示不按该条件清理"""
+    try:
+        days = get_setting('task_retention_days')
+        per_user = get_setting('task_retention_per_user')
+        return int(days) if days else 30, int(per_user) if per_user else 0
+    except Exception:
+        return 30, 0
+
+@safe_database_operation
+def set_task_retention(days: int, per_user: int = None):
+    """设置已结束任务的保留策略"""
+    set_setting('task_retention_days', str(days))
+    if per_user is not None:
+        set_setting('task_retention_per_user', str(per_user))
+
+@safe_database_operation
+def set_bandwidth_limit(scope: str, rate: float):
+    """设置带宽限制（字节/秒），0 表示不限制"""
+    set_setting(f'bandwidth_limit_{scope}', str(int(rate)))
+
+def get_sender_pool_dcs():
+    """获取连接池需要预热的 DC 列表"""
+    try:
+        ids = get_setting('sender_pool_dcs')
+        return set(int(i) for i in ids.split(',') if i)
+    except Exception:
+        return set()
+
+@safe_database_operation
+def add_sender_pool_dc(dc_id):
+    ids = get_sender_pool_dcs()
+    if dc_id not in ids:
+        ids.add(dc_id)
+        set_setting('sender_pool_dcs', ','.join(str(i) for i in sorted(ids)))
+
+@safe_database_operation
+def set_parallel_download(connections, threshold_mb=None):
+    """设置并行下载连接数及大小阈值"""
+    set_setting('parallel_connections', str(connections))
+    if threshold_mb is not None:
+        set_setting('parallel_threshold_mb', str(threshold_mb))
+
 @safe_database_operation
 def reset_settings_to_default():
     """重置系统设置为默认值，保留用户权限设置"""
     set_setting('max_concurrent_downloads', '3')
     set_setting('refresh_interval', '1')
     set_setting('file_classification', '0')
+    set_setting('parallel_connections', '4')
+    set_setting('parallel_threshold_mb', '20')
+    set_setting('auto_concurrency', '0')
+    set_setting('auto_concurrency_max', '10')
+    set_setting('bandwidth_limit_global', '0')
+    set_setting('task_retention_days', '30')
+    set_setting('task_retention_per_user', '0')
     # 不重置 admin_ids 和 allowed_user_ids
 
 # ====== 下载任务数据库操作 ======
@@ -292,21 +622,33 @@ import json
 
 @safe_database_operation
 def save_download_task(task_id: str, user_id: int, chat_id: str = None, msg_id: int = None, 
-                       link: str = None, status: str = 'pending'):
-    """保存下载任务到数据库"""
-    conn = sqlite3.connect(DB_PATH)
+                       link: str = None, status: str = 'pending', job_type: str = None,
+                       file_path: str = None, bot_chat_id: int = None, priority: int = 0):
+    """
+    保存下载任务到数据库
+    
+    重新执行中断的任务时沿用原任务ID，只更新状态和任务日志字段，
+    保留 created_at 和已记录的进度
+    """
+    conn = get_db()
     c = conn.cursor()
-    c.execute('''INSERT OR REPLACE INTO download_tasks 
-                 (task_id, user_id, chat_id, msg_id, link, status, updated_at) 
-                 VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)''',
-              (task_id, user_id, chat_id, msg_id, link, status))
+    c.execute('''INSERT INTO download_tasks 
+                 (task_id, user_id, chat_id, msg_id, link, status, job_type, file_path, bot_chat_id, priority, updated_at) 
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                 ON CONFLICT (task_id) DO UPDATE SET
+                     status = excluded.status,
+                     job_type = excluded.job_type,
+                     file_path = excluded.file_path,
+                     bot_chat_id = excluded.bot_chat_id,
+                     priority = excluded.priority,
+                     updated_at = CURRENT_TIMESTAMP''',
+              (task_id, user_id, chat_id, msg_id, link, status, job_type, file_path, bot_chat_id, priority))
     conn.commit()
-    conn.close()
 
 @safe_database_operation
 def update_download_task(task_id: str, **kwargs):
     """更新下载任务信息"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     # 构建更新语句
@@ -324,79 +666,359 @@ def update_download_task(task_id: str, **kwargs):
         query = f"UPDATE download_tasks SET {', '.join(update_fields)} WHERE task_id = ?"
         c.execute(query, values)
         conn.commit()
-    conn.close()
 
 @safe_database_operation
-def get_download_task(task_id: str):
-    """获取下载任务信息"""
-    conn = sqlite3.connect(DB_PATH)
+def update_download_tasks(updates: dict, status_change: tuple = None):
+    """
+    在一个事务中批量更新多个任务，updates: task_id -> 字段字典
+    
+    status_change: 可选的 (task_id 列表, 新状态)，批量暂停/取消等操作用一条 UPDATE 写入
+    """
+    conn = get_db()
     c = conn.cursor()
-    c.execute('SELECT * FROM download_tasks WHERE task_id = ?', (task_id,))
-    row = c.fetchone()
-    conn.close()
+    for task_id, fields in updates.items():
+        update_fields = []
+        values = []
+        for key, value in fields.items():
+            if key == 'file_paths' and isinstance(value, list):
+                value = json.dumps(value)
+            update_fields.append(f"{key} = ?")
+            values.append(value)
+        if update_fields:
+            update_fields.append("updated_at = CURRENT_TIMESTAMP")
+            values.append(task_id)
+            c.execute(f"UPDATE download_tasks SET {', '.join(update_fields)} WHERE task_id = ?", values)
+    if status_change:
+        task_ids, status = status_change
+        # 分段以免超出 SQLite 的参数个数上限
+        for i in range(0, len(task_ids), 500):
+            chunk = task_ids[i:i + 500]
+            c.execute(f'''UPDATE download_tasks SET status = ?, updated_at = CURRENT_TIMESTAMP
+                         WHERE task_id IN ({', '.join('?' * len(chunk))})''', [status, *chunk])
+    conn.commit()
+
+# 任务进度写入数据库的合并间隔（秒）
+TASK_STATE_FLUSH_INTERVAL = 1.0
+# 进入这些状态时立即写入，保证重启后能看到最终状态
+TASK_STATE_FLUSH_STATUSES = {'completed', 'failed', 'cancelled', 'paused'}
+
+class TaskStateWriter:
+    """
+    任务状态的延迟写入缓冲
     
-    if row:
-        columns = ['task_id', 'user_id', 'chat_id', 'msg_id', 'link', 'status', 
-                   'progress', 'total_size', 'downloaded_size', 'speed', 'file_paths', 
-                   'error_message', 'created_at', 'updated_at']
-        task_dict = dict(zip(columns, row))
-        if task_dict.get('file_paths'):
+    每个任务只保留最新的字段值，按固定间隔在一个事务中写入，
+    避免每次进度回调都单独提交一次；状态变为完成、失败、取消或暂停时立即写入
+    """
+    def __init__(self, interval: float = TASK_STATE_FLUSH_INTERVAL):
+        self.interval = interval
+        self.pending = {}  # task_id -> 待写入的字段
+        self.handle = None  # 已安排的定时写入
+    
+    def update(self, task_id: str, **kwargs):
+        self.pending.setdefault(task_id, {}).update(kwargs)
+        if kwargs.get('status') in TASK_STATE_FLUSH_STATUSES:
+            self.flush()
+            return
+        if self.handle is None:
             try:
-                task_dict['file_paths'] = json.loads(task_dict['file_paths'])
-            except:
-                task_dict['file_paths'] = []
-        return task_dict
-    return None
+                self.handle = asyncio.get_running_loop().call_later(self.interval, self.flush)
+            except RuntimeError:
+                # 不在事件循环中（如启动阶段），直接写入
+                self.flush()
+    
+    def update_status_many(self, task_ids: list, status: str):
+        """批量修改状态：与其他待写入的更新一起，在一个事务中用一条 UPDATE 立即写入"""
+        for task_id in task_ids:
+            fields = self.pending.get(task_id)
+            if fields:
+                # 旧状态不能在新状态之后写入
+                fields.pop('status', None)
+        self.flush(status_change=(list(task_ids), status))
+    
+    def discard(self, task_id: str):
+        """任务被删除时丢弃尚未写入的更新"""
+        self.pending.pop(task_id, None)
+    
+    def flush(self, status_change: tuple = None):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if not self.pending and not status_change:
+            return
+        updates, self.pending = self.pending, {}
+        async_db.submit_write(update_download_tasks, updates, status_change)
+
+task_state_writer = TaskStateWriter()
+
+DOWNLOAD_TASK_COLUMNS = ['task_id', 'user_id', 'chat_id', 'msg_id', 'link', 'status', 
+                         'progress', 'total_size', 'downloaded_size', 'speed', 'file_paths', 
+                         'error_message', 'created_at', 'updated_at',
+                         'job_type', 'file_path', 'bot_chat_id', 'priority']
+
+def row_to_download_task(row) -> dict:
+    task_dict = dict(zip(DOWNLOAD_TASK_COLUMNS, row))
+    if task_dict.get('file_paths'):
+        try:
+            task_dict['file_paths'] = json.loads(task_dict['file_paths'])
+        except:
+            task_dict['file_paths'] = []
+    return task_dict
 
 @safe_database_operation
-def get_all_download_tasks(status: str = None, user_id: int = None):
-    """获取所有下载任务，可按状态和用户ID过滤"""
-    conn = sqlite3.connect(DB_PATH)
+def get_download_task(task_id: str):
+    """获取下载任务信息"""
+    conn = get_db()
     c = conn.cursor()
+    c.execute(f'SELECT {", ".join(DOWNLOAD_TASK_COLUMNS)} FROM download_tasks WHERE task_id = ?', (task_id,))
+    row = c.fetchone()
+    return row_to_download_task(row) if row else None
+
+def iter_download_tasks(statuses: list = None, user_id: int = None, before: tuple = None, limit: int = None):
+    """
+    按创建时间倒序逐行返回下载任务（生成器），不会把整张表一次读入内存
     
-    query = 'SELECT * FROM download_tasks WHERE 1=1'
+    statuses: 状态列表，一次查询即可筛选多个状态
+    before: 键集分页游标 (created_at, task_id)，只返回排在它之后的任务
+    生成器使用当前线程的连接，需要在同一线程中迭代
+    """
+    query = f'SELECT {", ".join(DOWNLOAD_TASK_COLUMNS)} FROM download_tasks WHERE 1=1'
     params = []
     
-    if status:
-        query += ' AND status = ?'
-        params.append(status)
+    if statuses:
+        query += f' AND status IN ({", ".join("?" * len(statuses))})'
+        params.extend(statuses)
     if user_id:
         query += ' AND user_id = ?'
         params.append(user_id)
+    if before:
+        query += ' AND (created_at, task_id) < (?, ?)'
+        params.extend(before)
     
-    query += ' ORDER BY created_at DESC'
-    c.execute(query, params)
-    rows = c.fetchall()
-    conn.close()
+    query += ' ORDER BY created_at DESC, task_id DESC'
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
     
-    tasks = []
-    columns = ['task_id', 'user_id', 'chat_id', 'msg_id', 'link', 'status', 
-               'progress', 'total_size', 'downloaded_size', 'speed', 'file_paths', 
-               'error_message', 'created_at', 'updated_at']
-    for row in rows:
-        task_dict = dict(zip(columns, row))
-        if task_dict.get('file_paths'):
-            try:
-                task_dict['file_paths'] = json.loads(task_dict['file_paths'])
-            except:
-                task_dict['file_paths'] = []
-        tasks.append(task_dict)
-    return tasks
+    c = get_db().cursor()
+    c.execute(query, params)
+    for row in c:
+        yield row_to_download_task(row)
+
+@safe_database_operation
+def get_all_download_tasks(status: str = None, user_id: int = None, statuses: list = None):
+    """获取所有下载任务，可按状态（单个或多个）和用户ID过滤"""
+    if status:
+        statuses = [status]
+    return list(iter_download_tasks(statuses=statuses, user_id=user_id))
+
+@safe_database_operation
+def get_download_tasks_page(user_id: int = None, before: tuple = None, limit: int = 10):
+    """按创建时间倒序获取一页任务，before 为上一页最后一个任务的 (created_at, task_id)"""
+    return list(iter_download_tasks(user_id=user_id, before=before, limit=limit))
 
 @safe_database_operation
 def delete_download_task(task_id: str):
     """删除下载任务"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('DELETE FROM download_tasks WHERE task_id = ?', (task_id,))
     conn.commit()
-    conn.close()
+
+# 可以归档的已结束状态，以及重启后需要恢复的未完成状态
+TASK_TERMINAL_STATUSES = ('completed', 'cancelled', 'failed')
+PENDING_TASK_STATUSES = ('queued', 'running', 'paused', 'pending')
+
+@safe_database_operation
+def archive_download_tasks(days: int, per_user: int, batch_size: int = 500) -> int:
+    """
+    把超出保留策略的已结束任务移入归档表，并累加到按天统计中
+    
+    days: 早于该天数的任务归档；per_user: 每个用户只保留最新的这么多条
+    每次最多处理 batch_size 条，在一个事务中完成，返回本次归档的条数
+    """
+    conn = get_db()
+    c = conn.cursor()
+    placeholders = ', '.join('?' * len(TASK_TERMINAL_STATUSES))
+    conditions = []
+    params = list(TASK_TERMINAL_STATUSES)
+    if days > 0:
+        conditions.append("created_at < datetime('now', ?)")
+        params.append(f'-{days} days')
+    if per_user > 0:
+        conditions.append('user_rank > ?')
+        params.append(per_user)
+    if not conditions:
+        return 0
+    params.append(batch_size)
+    c.execute(f'''SELECT task_id FROM (
+                     SELECT task_id, created_at,
+                            ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY created_at DESC, task_id DESC) AS user_rank
+                     FROM download_tasks WHERE status IN ({placeholders})
+                 ) WHERE {' OR '.join(conditions)} LIMIT ?''', params)
+    task_ids = [row[0] for row in c.fetchall()]
+    if not task_ids:
+        return 0
+    
+    id_placeholders = ', '.join('?' * len(task_ids))
+    c.execute(f'''INSERT OR REPLACE INTO download_tasks_archive
+                 (task_id, user_id, chat_id, msg_id, status, total_size, file_count, created_at, updated_at)
+                 SELECT task_id, user_id, chat_id, msg_id, status, total_size,
+                        CASE WHEN json_valid(file_paths) THEN json_array_length(file_paths) ELSE 0 END,
+                        created_at, updated_at
+                 FROM download_tasks WHERE task_id IN ({id_placeholders})''', task_ids)
+    c.execute(f'''INSERT INTO download_stats_daily (day, user_id, status, task_count, total_size)
+                 SELECT date(created_at), user_id, status, COUNT(*), COALESCE(SUM(total_size), 0)
+                 FROM download_tasks WHERE task_id IN ({id_placeholders})
+                 GROUP BY date(created_at), user_id, status
+                 ON CONFLICT (day, user_id, status) DO UPDATE SET
+                     task_count = task_count + excluded.task_count,
+                     total_size = total_size + excluded.total_size''', task_ids)
+    c.execute(f'DELETE FROM download_tasks WHERE task_id IN ({id_placeholders})', task_ids)
+    conn.commit()
+    return len(task_ids)
+
+@safe_database_operation
+def enable_incremental_vacuum():
+    """
+    把数据库切换为 auto_vacuum=INCREMENTAL
+    
+    旧数据库需要完整 VACUUM 一次，耗时与数据库大小成正比，
+    所以只在启动时、开始响应之前执行，之后 incremental_vacuum 只做有界的回收
+    """
+    conn = get_db()
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return
+    started = time.time()
+    print("[startup] 正在把数据库切换为增量回收模式（仅首次执行，需要完整 VACUUM 一次）...")
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('VACUUM')
+    print(f"[startup] 数据库已切换为增量回收模式，用时 {time.time() - started:.1f} 秒")
+
+@safe_database_operation
+def incremental_vacuum(max_pages: int = 2000):
+    """归还数据库文件中最多 max_pages 个空闲页；未切换为增量回收模式时不做任何事"""
+    conn = get_db()
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return
+    # execute 对不返回行的语句只执行一步（只回收一页），用 executescript 执行到底
+    conn.executescript(f'PRAGMA incremental_vacuum({int(max_pages)});')
+
+@safe_database_operation
+def get_archive_summary() -> dict:
+    """归档任务总数及最近 7 天的按天统计"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT COUNT(*) FROM download_tasks_archive')
+    archived = c.fetchone()[0]
+    c.execute('''SELECT day, SUM(task_count), SUM(total_size) FROM download_stats_daily
+                 GROUP BY day ORDER BY day DESC LIMIT 7''')
+    days = [{'day': row[0], 'task_count': row[1], 'total_size': row[2]} for row in c.fetchall()]
+    return {'archived': archived, 'days': days}
+
+# ====== 范围下载任务数据库操作 ======
+RANGE_JOB_COLUMNS = ['job_id', 'user_id', 'chat_id', 'bot_chat_id', 'min_id', 'max_id', 'cursor',
+                     'status', 'downloaded', 'skipped', 'failed', 'created_at', 'updated_at', 'reply_to']
+
+@safe_database_operation
+def save_range_job(job: dict):
+    """保存范围下载任务"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''INSERT OR REPLACE INTO range_jobs 
+                 (job_id, user_id, chat_id, bot_chat_id, min_id, max_id, cursor, reply_to, status, updated_at) 
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'running', CURRENT_TIMESTAMP)''',
+              (job['job_id'], job['user_id'], job['chat_id'], job['bot_chat_id'],
+               job['min_id'], job['max_id'], job['cursor'], job.get('reply_to')))
+    conn.commit()
+
+@safe_database_operation
+def update_range_job(job_id: str, **kwargs):
+    """更新范围下载任务的游标、状态和统计"""
+    conn = get_db()
+    c = conn.cursor()
+    update_fields = [f"{key} = ?" for key in kwargs]
+    values = list(kwargs.values())
+    if update_fields:
+        update_fields.append("updated_at = CURRENT_TIMESTAMP")
+        values.append(job_id)
+        c.execute(f"UPDATE range_jobs SET {', '.join(update_fields)} WHERE job_id = ?", values)
+        conn.commit()
+
+@safe_database_operation
+def get_range_jobs(status: str = None):
+    """获取范围下载任务，可按状态过滤"""
+    conn = get_db()
+    c = conn.cursor()
+    if status:
+        c.execute('SELECT * FROM range_jobs WHERE status = ? ORDER BY created_at', (status,))
+    else:
+        c.execute('SELECT * FROM range_jobs ORDER BY created_at')
+    rows = c.fetchall()
+    return [dict(zip(RANGE_JOB_COLUMNS, row)) for row in rows]
+
+# ====== 实体缓存数据库操作 ======
+ENTITY_CACHE_COLUMNS = ['key', 'entity_id', 'peer_id', 'peer_type', 'access_hash', 'title', 'username', 'updated_at']
+
+@safe_database_operation
+def save_cached_entity(keys: list, info: dict):
+    """以多个 key（用户名、ID）保存同一个实体"""
+    conn = get_db()
+    c = conn.cursor()
+    c.executemany('''REPLACE INTO entity_cache 
+                     (key, entity_id, peer_id, peer_type, access_hash, title, username, updated_at) 
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                  [(key, info['entity_id'], info['peer_id'], info['peer_type'], info['access_hash'],
+                    info['title'], info['username'], info['updated_at']) for key in keys])
+    conn.commit()
+
+@safe_database_operation
+def get_cached_entity(key: str):
+    """读取缓存的实体信息"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT * FROM entity_cache WHERE key = ?', (key,))
+    row = c.fetchone()
+    return dict(zip(ENTITY_CACHE_COLUMNS, row)) if row else None
+
+# ====== 去重存储数据库操作 ======
+@safe_database_operation
+def save_stored_media(media_key: str, file_path: str, size: int):
+    """记录媒体文件的存储位置"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('REPLACE INTO media_store (media_key, file_path, size) VALUES (?, ?, ?)',
+              (media_key, file_path, size))
+    conn.commit()
+
+@safe_database_operation
+def get_stored_media(media_key: str):
+    """获取媒体文件的存储位置，返回 (文件路径, 大小) 或 None"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT file_path, size FROM media_store WHERE media_key = ?', (media_key,))
+    row = c.fetchone()
+    return row
+
+@safe_database_operation
+def delete_stored_media(media_key: str):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('DELETE FROM media_store WHERE media_key = ?', (media_key,))
+    conn.commit()
+
+@safe_database_operation
+def move_stored_media(src_path: str, dst_path: str):
+    """文件被移动后更新存储位置"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('UPDATE media_store SET file_path = ? WHERE file_path = ?', (dst_path, src_path))
+    conn.commit()
 
 # ====== 关键词监听数据库操作 ======
 @safe_database_operation
 def add_keyword_monitor(chat_id: str, keywords: list, chat_title: str = None):
     """添加关键词监听"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     keywords_str = json.dumps(keywords)
     c.execute('''INSERT OR REPLACE INTO keyword_monitors 
@@ -404,25 +1026,22 @@ def add_keyword_monitor(chat_id: str, keywords: list, chat_title: str = None):
                  VALUES (?, ?, ?, 1)''',
               (chat_id, chat_title, keywords_str))
     conn.commit()
-    conn.close()
 
 @safe_database_operation
 def remove_keyword_monitor(chat_id: str):
     """删除关键词监听"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('DELETE FROM keyword_monitors WHERE chat_id = ?', (chat_id,))
     conn.commit()
-    conn.close()
 
 @safe_database_operation
 def get_keyword_monitor(chat_id: str):
     """获取指定频道的关键词监听"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT * FROM keyword_monitors WHERE chat_id = ?', (chat_id,))
     row = c.fetchone()
-    conn.close()
     
     if row:
         return {
@@ -438,7 +1057,7 @@ def get_keyword_monitor(chat_id: str):
 @safe_database_operation
 def get_all_keyword_monitors(enabled_only: bool = True):
     """获取所有关键词监听"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     if enabled_only:
@@ -447,7 +1066,6 @@ def get_all_keyword_monitors(enabled_only: bool = True):
         c.execute('SELECT * FROM keyword_monitors')
     
     rows = c.fetchall()
-    conn.close()
     
     monitors = []
     for row in rows:
@@ -464,12 +1082,54 @@ def get_all_keyword_monitors(enabled_only: bool = True):
 @safe_database_operation
 def toggle_keyword_monitor(chat_id: str, enabled: bool):
     """启用/禁用关键词监听"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('UPDATE keyword_monitors SET enabled = ? WHERE chat_id = ?', 
               (1 if enabled else 0, chat_id))
     conn.commit()
-    conn.close()
+
+# ====== userbot 账号数据库操作 ======
+@safe_database_operation
+def save_userbot_account(name: str, session_path: str):
+    """保存额外的 userbot 账号"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('INSERT OR IGNORE INTO userbot_accounts (name, session_path) VALUES (?, ?)',
+              (name, session_path))
+    conn.commit()
+
+@safe_database_operation
+def get_userbot_accounts():
+    """获取所有额外的 userbot 账号"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT name, session_path FROM userbot_accounts ORDER BY created_at')
+    rows = c.fetchall()
+    return [{'name': row[0], 'session_path': row[1]} for row in rows]
+
+# ====== 异步数据库接口 ======
+# 协程中使用的版本：读在读线程池、写在写线程中执行，不阻塞事件循环
+save_download_task_async = async_db_write(save_download_task)
+update_download_task_async = async_db_write(update_download_task)
+delete_download_task_async = async_db_write(delete_download_task)
+get_download_task_async = async_db_read(get_download_task)
+get_all_download_tasks_async = async_db_read(get_all_download_tasks)
+get_download_tasks_page_async = async_db_read(get_download_tasks_page)
+save_range_job_async = async_db_write(save_range_job)
+update_range_job_async = async_db_write(update_range_job)
+get_range_jobs_async = async_db_read(get_range_jobs)
+get_cached_entity_async = async_db_read(get_cached_entity)
+get_stored_media_async = async_db_read(get_stored_media)
+save_stored_media_async = async_db_write(save_stored_media)
+delete_stored_media_async = async_db_write(delete_stored_media)
+save_userbot_account_async = async_db_write(save_userbot_account)
+get_userbot_accounts_async = async_db_read(get_userbot_accounts)
+add_auto_download_async = async_db_write(add_auto_download)
+add_keyword_monitor_async = async_db_write(add_keyword_monitor)
+remove_keyword_monitor_async = async_db_write(remove_keyword_monitor)
+toggle_keyword_monitor_async = async_db_write(toggle_keyword_monitor)
+get_keyword_monitor_async = async_db_read(get_keyword_monitor)
+get_all_keyword_monitors_async = async_db_read(get_all_keyword_monitors)
 
 # ====== 文件分类工具函数 ======
 def get_file_category(file_name: str) -> str:
@@ -566,6 +1226,95 @@ def check_file_exists(file_path: str) -> tuple[bool, int]:
     except Exception:
         return False, 0
 
+class FileIndex:
+    """
+    下载目录的文件索引：(目录, 消息ID) -> 文件名
+    
+    每个目录在首次查询时用 scandir 扫描一次，之后随下载完成、移动和删除更新，
+    避免大目录每次检查都 listdir；只索引以 "消息ID_" 开头的文件和对应的隐藏 .part 文件
+    """
+    def __init__(self):
+        self.folders = {}  # folder -> {'files': {msg_id: 文件名}, 'partials': {msg_id: 最终文件名}}
+    
+    @staticmethod
+    def _parse(filename: str):
+        """返回 (消息ID, 是否为 .part 文件, 最终文件名)，不是下载文件时返回 None"""
+        is_partial = filename.startswith('.') and filename.endswith('.part')
+        name = filename[1:-len('.part')] if is_partial else filename
+        prefix, sep, _ = name.partition('_')
+        if not sep or not prefix.isdigit():
+            return None
+        return int(prefix), is_partial, name
+    
+    def _scan(self, folder: str) -> dict:
+        entry = {'files': {}, 'partials': {}}
+        if os.path.isdir(folder):
+            with os.scandir(folder) as it:
+                for item in it:
+                    parsed = self._parse(item.name)
+                    if not parsed or not item.is_file():
+                        continue
+                    msg_id, is_partial, name = parsed
+                    if is_partial:
+                        entry['partials'].setdefault(msg_id, name)
+                    else:
+                        entry['files'].setdefault(msg_id, name)
+            print(f"[FileIndex] 已索引 {folder}: {len(entry['files'])} 个文件, {len(entry['partials'])} 个未完成下载")
+        return entry
+    
+    def _get_folder(self, folder: str) -> dict:
+        folder = os.path.normpath(folder)
+        entry = self.folders.get(folder)
+        if entry is None:
+            entry = self._scan(folder)
+            self.folders[folder] = entry
+        return entry
+    
+    def _locate(self, file_path: str):
+        """返回文件所在目录的索引（目录尚未扫描时返回 None，扫描时会自然包含该文件）和解析结果"""
+        folder, filename = os.path.split(os.path.normpath(file_path))
+        parsed = self._parse(filename)
+        if not parsed:
+            return None, None
+        return self.folders.get(folder), parsed
+    
+    def lookup(self, folder: str, message_id: int) -> tuple:
+        """
+        Returns:
+            (完整文件名或 None, 未完成下载的最终文件名或 None)
+        """
+        entry = self._get_folder(folder)
+        return entry['files'].get(message_id), entry['partials'].get(message_id)
+    
+    def add(self, file_path: str):
+        """下载完成后登记文件，同时清除其 .part 记录"""
+        entry, parsed = self._locate(file_path)
+        if entry is not None:
+            msg_id, _, name = parsed
+            entry['files'][msg_id] = name
+            if entry['partials'].get(msg_id) == name:
+                del entry['partials'][msg_id]
+    
+    def add_partial(self, file_path: str):
+        """登记正在写入 .part 的下载"""
+        entry, parsed = self._locate(file_path)
+        if entry is not None:
+            entry['partials'][parsed[0]] = parsed[2]
+    
+    def remove(self, file_path: str):
+        """文件被删除或移走"""
+        entry, parsed = self._locate(file_path)
+        if entry is not None and entry['files'].get(parsed[0]) == parsed[2]:
+            del entry['files'][parsed[0]]
+    
+    def remove_partial(self, file_path: str):
+        """.part 文件被删除或移走"""
+        entry, parsed = self._locate(file_path)
+        if entry is not None and entry['partials'].get(parsed[0]) == parsed[2]:
+            del entry['partials'][parsed[0]]
+
+file_index = FileIndex()
+
 def check_message_file_exists(folder_path: str, message_id: int, expected_size: int = 0) -> tuple[bool, str, int]:
     """
     检查目录中是否已存在指定消息ID的文件
@@ -577,32 +1326,37 @@ def check_message_file_exists(folder_path: str, message_id: int, expected_size:
     
     Returns:
         (是否存在, 完整文件路径, 文件大小)
+        对于仍在 .part 中的未完成下载，返回最终文件路径和可续传的字节数
     """
     try:
-        if not os.path.exists(folder_path):
-            return False, "", 0
-        
-        # 查找以消息ID开头的文件
-        prefix = f"{message_id}_"
-        for filename in os.listdir(folder_path):
-            if filename.startswith(prefix):
-                file_path = os.path.join(folder_path, filename)
-                if os.path.isfile(file_path):
-                    file_size = os.path.getsize(file_path)
-                    print(f"[check_message_file_exists] 找到现有文件: {filename} ({file_size} bytes)")
-                    
-                    # 如果指定了期望大小，检查文件完整性
-                    if expected_size > 0:
-                        if file_size == expected_size:
-                            print(f"[check_message_file_exists] 文件完整: {filename}")
-                            return True, file_path, file_size
-                        else:
-                            print(f"[check_message_file_exists] 文件不完整: {filename} ({file_size}/{expected_size})")
-                            return True, file_path, file_size
+        # 从文件索引查找以消息ID开头的文件
+        filename, partial_name = file_index.lookup(folder_path, message_id)
+        if filename:
+            file_path = os.path.join(folder_path, filename)
+            if os.path.isfile(file_path):
+                file_size = os.path.getsize(file_path)
+                print(f"[check_message_file_exists] 找到现有文件: {filename} ({file_size} bytes)")
+                
+                # 如果指定了期望大小，检查文件完整性
+                if expected_size > 0:
+                    if file_size == expected_size:
+                        print(f"[check_message_file_exists] 文件完整: {filename}")
                     else:
-                        # 期望大小为0时，只要文件存在就认为完整
-                        print(f"[check_message_file_exists] 文件存在（期望大小为0）: {filename}")
-                        return True, file_path, file_size
+                        print(f"[check_message_file_exists] 文件不完整: {filename} ({file_size}/{expected_size})")
+                else:
+                    # 期望大小为0时，只要文件存在就认为完整
+                    print(f"[check_message_file_exists] 文件存在（期望大小为0）: {filename}")
+                return True, file_path, file_size
+            # 文件已在外部被删除
+            file_index.remove(file_path)
+        
+        # 没有完整文件时，检查是否有可续传的未完成下载
+        if partial_name and expected_size > 0:
+            file_path = os.path.join(folder_path, partial_name)
+            resume_offset = read_resume_offset(file_path, expected_size)
+            if resume_offset > 0:
+                print(f"[check_message_file_exists] 找到未完成下载: {partial_name} ({resume_offset}/{expected_size})")
+                return True, file_path, resume_offset
         
         print(f"[check_message_file_exists] 未找到消息ID {message_id} 的文件")
         return False, "", 0
@@ -626,16 +1380,14 @@ async def get_message_files_info(chat_id: int, msg_id: int) -> list[dict]:
     files_info = []
     
     try:
-        msg = await userbot.get_messages(chat_id, ids=msg_id)
+        msg = await get_message(chat_id, msg_id)
         if not msg:
             return files_info
         
         # 检查是否是相册
         if msg.grouped_id:
             # 获取相册中的所有消息
-            all_msgs = await userbot.get_messages(chat_id, limit=50, min_id=msg.id-25, max_id=msg.id+25)
-            album = [m for m in all_msgs if getattr(m, 'grouped_id', None) == msg.grouped_id]
-            album.sort(key=lambda m: m.id)
+            album = await album_cache.get(chat_id, msg)
             
             for idx, m in enumerate(album):
                 if isinstance(m.media, (MessageMediaDocument, MessageMediaPhoto)):
@@ -794,13 +1546,17 @@ def format_download_status_message(status: dict, chat_title: str = None) -> str:
 # ====== 权限检查工具函数 ======
 def is_admin(user_id: int) -> bool:
     """检查用户是否为管理员"""
-    admin_ids = get_admin_ids()
-    return user_id in admin_ids
+    try:
+        return user_id in settings_cache.get_id_set('admin_ids')
+    except Exception:
+        return False
 
 def is_authorized_user(user_id: int) -> bool:
     """检查用户是否为授权用户"""
-    allowed_user_ids = get_allowed_user_ids()
-    return user_id in allowed_user_ids
+    try:
+        return user_id in settings_cache.get_id_set('allowed_user_ids')
+    except Exception:
+        return False
 
 def get_user_permission_level(user_id: int) -> str:
     """获取用户权限级别"""
@@ -865,10 +1621,15 @@ ADMIN_HELP_TEMPLATE = """🔧 管理员命令
 
 ⚙️ 系统配置：
 /settings - 查看设置
-/setmax <数量> - 设置并发数
+/setmax <数量|auto [上限]> - 设置并发数
 /setrefresh <秒数> - 设置刷新间隔
+/setparallel <连接数> [阈值MB] - 大文件并行下载
+/setspeed <global|user ID|task ID> <MB/s> - 带宽限制
+/setretention <天数> [每用户条数] - 任务记录保留策略
+/accounts - 查看 userbot 账号池
 /classification <on/off> - 文件分类开关
 /resetsettings - 重置设置
+/reloadsettings - 重新加载设置
 
 📥 任务管理：
 /pauseall - 暂停所有任务
@@ -892,6 +1653,9 @@ SETTINGS_DISPLAY_TEMPLATE = """⚙️ 当前系统设置
 • 最大并发下载数：{max_concurrent}
 • 进度刷新间隔：{refresh_interval} 秒
 • 文件分类存储：{classification_status}
+• 并行下载连接数：{parallel_connections}（≥ {parallel_threshold_mb} MB 的文件启用）
+• 全局带宽限制：{bandwidth_limit}
+• 任务记录保留：{task_retention}
 
 👥 用户权限：
 • 管理员数量：{admin_count}
@@ -1045,6 +1809,9 @@ COMMAND_HELP = {
 💥 下载失败
 
 💡 配合使用：
+📜 历史记录：
+/downloads history 按时间倒序分页查看所有任务记录
+
 查看任务ID后使用：
 • /pause <任务ID> - 暂停指定任务
 • /resume <任务ID> - 恢复指定任务
@@ -1115,8 +1882,12 @@ COMMAND_HELP = {
    /cancel <任务ID>
    例: /cancel task_1_123
 
+3️⃣ 取消范围/评论区下载
+   /cancel <范围任务ID>
+   例: /cancel range_1a2b3c4d5e6f
+
 📌 获取任务ID：
-使用 /downloads 查看任务列表
+使用 /downloads 查看任务列表，范围任务ID显示在范围下载的状态消息中
 
 ⚠️ 注意：
 • 取消后任务从列表移除
@@ -1200,11 +1971,23 @@ def format_settings_display() -> str:
         allowed_user_ids = get_allowed_user_ids()
         
         classification_status = "✅ 已开启" if classification_enabled else "❌ 已关闭"
+        parallel_connections = get_parallel_connections()
+        parallel_threshold_mb = get_parallel_threshold() // (1024 * 1024)
+        if get_auto_concurrency():
+            max_concurrent = f"自动（当前 {download_manager.limit}，上限 {get_auto_concurrency_max()}）"
+        retention_days, retention_per_user = get_task_retention()
+        task_retention = f"{retention_days} 天" if retention_days else "不限天数"
+        if retention_per_user:
+            task_retention += f"，每用户 {retention_per_user} 条"
         
         return SETTINGS_DISPLAY_TEMPLATE.format(
             max_concurrent=max_concurrent,
             refresh_interval=refresh_interval,
             classification_status=classification_status,
+            parallel_connections=parallel_connections if parallel_connections > 1 else "关闭",
+            parallel_threshold_mb=parallel_threshold_mb,
+            bandwidth_limit=format_bandwidth(get_bandwidth_limit('global')),
+            task_retention=task_retention,
             admin_count=len(admin_ids),
             user_count=len(allowed_user_ids)
         )
@@ -1228,16 +2011,23 @@ def format_user_list_display() -> str:
         return f"❌ 获取用户列表失败: {str(e)}"
 
 # ====== 下载并发控制 ======
+from collections import OrderedDict, deque
+
+# 调度优先级：数值越小越先分配下载槽位
+PRIORITY_INTERACTIVE = 0  # /dl、链接、转发文件等交互式请求
+PRIORITY_BULK = 1  # 范围下载、评论区下载、关键词监听等批量任务
+
 class DownloadTask:
     def __init__(self, task_id: str, chat_id: int, message_id: int, file_name: str, user_id: int, 
-                 link: str = None, restore_from_db: bool = False):
+                 link: str = None, restore_from_db: bool = False, job_type: str = None,
+                 file_path: str = None, bot_chat_id: int = None, priority: int = PRIORITY_INTERACTIVE):
         self.task_id = task_id
         self.chat_id = chat_id
         self.message_id = message_id
         self.file_name = file_name
         self.user_id = user_id
         self.link = link
-        self.status = "running"  # running, paused, cancelled, completed, failed
+        self.status = "running"  # queued, running, paused, cancelled, completed, failed
         self.progress = 0
         self.total_size = 0
         self.current_size = 0
@@ -1249,6 +2039,13 @@ class DownloadTask:
         self.cancel_event = asyncio.Event()
         self.file_paths = []  # 下载的文件路径列表
         self.error_message = None
+        self.engine = "default"  # 下载引擎：default（download_media）、parallel（多连接分片）、resume（断点续传）或 dedup（复用已下载文件）
+        # 任务日志：重启后按这些信息重新执行下载
+        self.job_type = job_type  # single、album、range、comments，None 表示无法自动重新执行
+        self.file_path = file_path
+        self.bot_chat_id = bot_chat_id
+        self.priority = priority
+        self.replay_job = None  # 重启后恢复的暂停任务，继续时按该记录重新执行
         
         # 如果不是从数据库恢复，则保存到数据库
         if not restore_from_db:
@@ -1256,24 +2053,24 @@ class DownloadTask:
     
     def save_to_db(self):
         """保存任务到数据库"""
-        try:
-            save_download_task(
-                task_id=self.task_id,
-                user_id=self.user_id,
-                chat_id=str(self.chat_id) if self.chat_id else None,
-                msg_id=self.message_id,
-                link=self.link,
-                status=self.status
-            )
-        except Exception as e:
-            print(f"保存任务到数据库失败: {e}")
+        # 由写线程执行，之后的进度更新也经写线程提交，顺序不会颠倒
+        async_db.submit_write(
+            save_download_task,
+            task_id=self.task_id,
+            user_id=self.user_id,
+            chat_id=str(self.chat_id) if self.chat_id else None,
+            msg_id=self.message_id,
+            link=self.link,
+            status=self.status,
+            job_type=self.job_type,
+            file_path=self.file_path,
+            bot_chat_id=self.bot_chat_id,
+            priority=self.priority
+        )
     
     def update_db(self, **kwargs):
-        """更新数据库中的任务信息"""
-        try:
-            update_download_task(self.task_id, **kwargs)
-        except Exception as e:
-            print(f"更新任务数据库失败: {e}")
+        """更新数据库中的任务信息（经 task_state_writer 合并后批量写入）"""
+        task_state_writer.update(self.task_id, **kwargs)
     
     def set_status(self, status: str):
         """设置任务状态并同步到数据库"""
@@ -1287,7 +2084,7 @@ class DownloadTask:
         self.total_size = total_size
         self.speed = speed
         
-        # 批量更新数据库（每次都更新可能影响性能，可以考虑定时更新）
+        # 进度更新由 task_state_writer 合并，按间隔批量写入数据库
         self.update_db(
             progress=progress,
             downloaded_size=downloaded_size,
@@ -1307,21 +2104,114 @@ class DownloadTask:
         self.update_db(error_message=error_message, status="failed")
 
 class DownloadManager:
+    """
+    下载任务管理与调度
+    
+    下载槽位按优先级分配：交互式请求总是先于批量任务；
+    同一优先级内按用户轮转，避免单个用户的大批量任务饿死其他用户
+    """
     def __init__(self):
-        self.semaphore = asyncio.Semaphore(get_max_concurrent_downloads())
+        self.limit = get_max_concurrent_downloads()
+        self.running = 0  # 已占用的下载槽位数
+        # 每个优先级一个等待队列：user_id -> deque[(future, task)]，按用户轮转出队
+        self.queues = {PRIORITY_INTERACTIVE: OrderedDict(), PRIORITY_BULK: OrderedDict()}
+        self.waiters = {}  # task_id -> 排队中的 future，用于取消排队任务
         self.active_tasks = {}  # task_id -> DownloadTask
         self.task_counter = 0
+        self.transferred_bytes = 0  # 自上次采样以来所有任务下载的字节数
         
     def update_limit(self, n):
-        self.semaphore = asyncio.Semaphore(n)
-    
-    def generate_task_id(self) -> str:
-        self.task_counter += 1
-        return f"task_{self.task_counter}_{int(time.time())}"
+        """
+        调整并发上限，立即生效
+        
+        调大时马上唤醒等待者；调小时不打断进行中的下载，
+        只是在占用数降到新上限以下之前不再分配槽位
+        """
+        self.limit = max(1, n)
+        self._dispatch()
+    
+    def record_transfer(self, byte_count: int):
+        self.transferred_bytes += byte_count
+    
+    def take_transferred_bytes(self) -> int:
+        """取出并清零累计的下载字节数"""
+        byte_count, self.transferred_bytes = self.transferred_bytes, 0
+        return byte_count
+    
+    def is_saturated(self) -> bool:
+        """槽位已占满或有任务在排队"""
+        return self.running >= self.limit or self.get_queue_length() > 0
+    
+    def get_queue_length(self) -> int:
+        return sum(len(waiters) for queue in self.queues.values() for waiters in queue.values())
+    
+    def _next_waiter(self):
+        """按优先级取出下一个等待者，同一优先级内轮转到下一个用户"""
+        for priority in sorted(self.queues):
+            queue = self.queues[priority]
+            while queue:
+                user_id, waiters = next(iter(queue.items()))
+                future, task = waiters.popleft()
+                if waiters:
+                    queue.move_to_end(user_id)
+                else:
+                    del queue[user_id]
+                if task:
+                    self.waiters.pop(task.task_id, None)
+                if not future.done():
+                    return future
+        return None
     
-    def add_task(self, chat_id: int, message_id: int, file_name: str, user_id: int, link: str = None) -> str:
-        task_id = self.generate_task_id()
-        task = DownloadTask(task_id, chat_id, message_id, file_name, user_id, link=link)
+    def _dispatch(self):
+        """把空闲槽位分配给等待者"""
+        while self.running < self.limit:
+            future = self._next_waiter()
+            if future is None:
+                break
+            self.running += 1
+            future.set_result(True)
+    
+    def _cancel_waiter(self, task_id: str):
+        future = self.waiters.pop(task_id, None)
+        if future and not future.done():
+            future.cancel()
+    
+    async def acquire(self, user_id: int = 0, priority: int = PRIORITY_INTERACTIVE, task: DownloadTask = None):
+        """等待下载槽位；排队期间任务状态为 queued"""
+        future = asyncio.get_running_loop().create_future()
+        self.queues[priority].setdefault(user_id, deque()).append((future, task))
+        self._dispatch()
+        if future.done():
+            return
+        if task:
+            self.waiters[task.task_id] = future
+            task.set_status("queued")
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已分配到槽位但调用方被取消，归还槽位
+                self.release()
+            raise
+        if task and task.status == "queued":
+            task.set_status("running")
+    
+    def release(self):
+        self.running -= 1
+        self._dispatch()
+    
+    def generate_task_id(self) -> str:
+        self.task_counter += 1
+        return f"task_{self.task_counter}_{int(time.time())}"
+    
+    def add_task(self, chat_id: int, message_id: int, file_name: str, user_id: int, link: str = None,
+                 task_id: str = None, **journal) -> str:
+        """
+        task_id: 重新执行中断的任务时沿用原任务ID
+        journal: 任务日志字段 job_type、file_path、bot_chat_id、priority
+        """
+        task_id = task_id or self.generate_task_id()
+        task = DownloadTask(task_id, chat_id, message_id, file_name, user_id, link=link, **journal)
         self.active_tasks[task_id] = task
         print(f"✅ 任务添加成功: {file_name} (ID: {task_id}) - 用户: {user_id}")
         return task_id
@@ -1331,7 +2221,7 @@ class DownloadManager:
         task_id = task_dict['task_id']
         task = DownloadTask(
             task_id=task_id,
-            chat_id=int(task_dict['chat_id']) if task_dict.get('chat_id') else 0,
+            chat_id=parse_stored_chat_id(task_dict['chat_id']) if task_dict.get('chat_id') else 0,
             message_id=task_dict.get('msg_id', 0),
             file_name="恢复的任务",
             user_id=task_dict['user_id'],
@@ -1371,79 +2261,84 @@ class DownloadManager:
         task = self.active_tasks.get(task_id)
         if task and task.status == "paused":
             task.set_status("running")
-            task.pause_event.set()
+            if not self._replay_restored(task):
+                task.pause_event.set()
             return True
         return False
     
+    def _replay_restored(self, task: DownloadTask) -> bool:
+        """重启后恢复的暂停任务没有协程在执行，继续时按任务日志重新执行"""
+        job = task.replay_job
+        if not job:
+            return False
+        task.replay_job = None
+        schedule_task_replay(job)
+        return True
+    
     def cancel_task(self, task_id: str) -> bool:
         task = self.active_tasks.get(task_id)
-        if task and task.status in ["running", "paused"]:
+        if task and task.status in ["queued", "running", "paused"]:
             task.set_status("cancelled")
             task.cancel_event.set()
             task.pause_event.set()  # 确保任务能够检查取消状态
+            self._cancel_waiter(task_id)
             return True
         return False
     
+    def _set_status_many(self, tasks: list, status: str):
+        """批量修改任务状态：先更新内存，再在一个事务中用一条 UPDATE 写入数据库"""
+        for task in tasks:
+            task.status = status
+        if tasks:
+            task_state_writer.update_status_many([task.task_id for task in tasks], status)
+    
+    def _pause_tasks(self, tasks) -> int:
+        tasks = [task for task in tasks if task.status == "running"]
+        self._set_status_many(tasks, "paused")
+        for task in tasks:
+            task.pause_event.clear()
+        return len(tasks)
+    
+    def _resume_tasks(self, tasks) -> int:
+        tasks = [task for task in tasks if task.status == "paused"]
+        self._set_status_many(tasks, "running")
+        for task in tasks:
+            if not self._replay_restored(task):
+                task.pause_event.set()
+        return len(tasks)
+    
+    def _cancel_tasks(self, tasks) -> int:
+        tasks = [task for task in tasks if task.status in ["queued", "running", "paused"]]
+        self._set_status_many(tasks, "cancelled")
+        for task in tasks:
+            task.cancel_event.set()
+            task.pause_event.set()
+            self._cancel_waiter(task.task_id)
+        return len(tasks)
+    
     def pause_user_tasks(self, user_id: int) -> int:
-        count = 0
-        for task in self.active_tasks.values():
-            if task.user_id == user_id and task.status == "running":
-                task.set_status("paused")
-                task.pause_event.clear()
-                count += 1
-        return count
+        return self._pause_tasks(self.get_user_tasks(user_id))
     
     def resume_user_tasks(self, user_id: int) -> int:
-        count = 0
-        for task in self.active_tasks.values():
-            if task.user_id == user_id and task.status == "paused":
-                task.set_status("running")
-                task.pause_event.set()
-                count += 1
-        return count
+        return self._resume_tasks(self.get_user_tasks(user_id))
     
     def cancel_user_tasks(self, user_id: int) -> int:
-        count = 0
-        for task in self.active_tasks.values():
-            if task.user_id == user_id and task.status in ["running", "paused"]:
-                task.set_status("cancelled")
-                task.cancel_event.set()
-                task.pause_event.set()
-                count += 1
-        return count
+        return self._cancel_tasks(self.get_user_tasks(user_id))
     
     def pause_all_tasks(self) -> int:
-        count = 0
-        for task in self.active_tasks.values():
-            if task.status == "running":
-                task.set_status("paused")
-                task.pause_event.clear()
-                count += 1
-        return count
+        return self._pause_tasks(self.get_all_tasks())
     
     def resume_all_tasks(self) -> int:
-        count = 0
-        for task in self.active_tasks.values():
-            if task.status == "paused":
-                task.set_status("running")
-                task.pause_event.set()
-                count += 1
-        return count
+        return self._resume_tasks(self.get_all_tasks())
     
     def cancel_all_tasks(self) -> int:
-        count = 0
-        for task in self.active_tasks.values():
-            if task.status in ["running", "paused"]:
-                task.set_status("cancelled")
-                task.cancel_event.set()
-                task.pause_event.set()
-                count += 1
-        return count
+        return self._cancel_tasks(self.get_all_tasks())
     
     def remove_completed_task(self, task_id: str):
         """移除已完成的任务（从内存中，但保留数据库记录）"""
         if task_id in self.active_tasks:
             del self.active_tasks[task_id]
+        bandwidth_limiter.discard_task(task_id)
     
     def delete_task_completely(self, task_id: str):
         """完全删除任务（包括数据库记录和文件）"""
@@ -1454,6 +2349,7 @@ class DownloadManager:
                 try:
                     if os.path.exists(file_path):
                         os.remove(file_path)
+                        file_index.remove(file_path)
                         print(f"已删除文件: {file_path}")
                 except Exception as e:
                     print(f"删除文件失败 {file_path}: {e}")
@@ -1462,13 +2358,12 @@ class DownloadManager:
             del self.active_tasks[task_id]
         
         # 从数据库中删除
-        try:
-            delete_download_task(task_id)
-        except Exception as e:
-            print(f"删除任务数据库记录失败: {e}")
+        task_state_writer.discard(task_id)
+        async_db.submit_write(delete_download_task, task_id)
     
     def get_task_status_text(self, task: DownloadTask) -> str:
         status_emoji = {
+            "queued": "⏳",
             "running": "⏬",
             "paused": "⏸️",
             "cancelled": "❌",
@@ -1486,12 +2381,236 @@ class DownloadManager:
         
         return f"{status_emoji.get(task.status, '❓')} {task.file_name}: {progress_percent}%{speed_text}"
     
-    async def run(self, coro):
-        async with self.semaphore:
+    async def run(self, coro, user_id: int = 0, priority: int = PRIORITY_INTERACTIVE, task: DownloadTask = None):
+        """占用一个下载槽位执行 coro"""
+        try:
+            await self.acquire(user_id, priority, task)
+        except BaseException:
+            coro.close()
+            raise
+        try:
             return await coro
+        finally:
+            self.release()
 
 download_manager = DownloadManager()
 
+# ====== 并发数自动调节 ======
+AUTO_TUNE_INTERVAL = 30  # 采样周期（秒）
+AUTO_TUNE_GROWTH = 1.05  # 吞吐量至少增长 5% 才继续加并发
+AUTO_TUNE_DROP = 0.8  # 吞吐量跌到上次的 80% 以下视为拥塞
+
+class ConcurrencyTuner:
+    """
+    按 AIMD 自动调节下载并发数
+    
+    槽位占满时，吞吐量随并发增长就每个周期加 1；
+    遇到 FloodWait 减半，吞吐量明显下降则降到 3/4
+    """
+    def __init__(self, manager: DownloadManager):
+        self.manager = manager
+        self.last_throughput = 0
+        self.flood_events = 0
+        self.task = None
+    
+    def on_flood_wait(self):
+        self.flood_events += 1
+    
+    def step(self, throughput: float, saturated: bool) -> int:
+        """根据一个周期的采样计算新的并发数"""
+        limit = self.manager.limit
+        max_limit = get_auto_concurrency_max()
+        if self.flood_events:
+            self.flood_events = 0
+            new_limit = limit // 2
+        elif not saturated:
+            # 负载不足时吞吐量变化不反映容量，保持不变
+            new_limit = limit
+        elif self.last_throughput and throughput < self.last_throughput * AUTO_TUNE_DROP:
+            new_limit = min(limit - 1, int(limit * 0.75))
+        elif throughput >= self.last_throughput * AUTO_TUNE_GROWTH:
+            new_limit = limit + 1
+        else:
+            new_limit = limit
+        if saturated:
+            self.last_throughput = throughput
+        return max(1, min(new_limit, max_limit))
+    
+    async def loop(self):
+        self.manager.take_transferred_bytes()
+        while True:
+            await asyncio.sleep(AUTO_TUNE_INTERVAL)
+            try:
+                throughput = self.manager.take_transferred_bytes() / AUTO_TUNE_INTERVAL
+                old_limit = self.manager.limit
+                new_limit = self.step(throughput, self.manager.is_saturated())
+                if new_limit != old_limit:
+                    self.manager.update_limit(new_limit)
+                    print(f"[ConcurrencyTuner] 并发数 {old_limit} -> {new_limit}（吞吐量 {throughput/1024/1024:.2f}MB/s）")
+            except Exception as e:
+                print(f"[ConcurrencyTuner] 调节失败: {e}")
+    
+    def start(self):
+        if self.task is None or self.task.done():
+            self.last_throughput = 0
+            self.flood_events = 0
+            self.task = asyncio.create_task(self.loop())
+    
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+concurrency_tuner = ConcurrencyTuner(download_manager)
+
+# ====== 任务历史保留 ======
+# 启动后首次清理的延迟及之后的清理间隔（秒）
+TASK_RETENTION_DELAY = 60
+TASK_RETENTION_INTERVAL = 6 * 3600
+# 每个事务归档的任务数，批次之间让出写线程
+TASK_RETENTION_BATCH = 500
+# 每次清理后最多归还给文件系统的空闲页数
+TASK_RETENTION_VACUUM_PAGES = 2000
+
+class TaskRetention:
+    """
+    按保留策略定期把已结束的任务移入归档表，之后增量回收数据库空间
+    
+    所有数据库操作都在写线程中分批执行，不阻塞事件循环
+    """
+    def __init__(self):
+        self.task = None
+        self.running = False
+    
+    async def run_once(self) -> int:
+        """执行一次归档和空间回收，返回归档的任务数"""
+        if self.running:
+            return 0
+        self.running = True
+        try:
+            days, per_user = get_task_retention()
+            total = 0
+            while True:
+                count = await async_db.write(archive_download_tasks, days, per_user, TASK_RETENTION_BATCH)
+                total += count
+                if count < TASK_RETENTION_BATCH:
+                    break
+            # 只做有界的增量回收；切换回收模式的完整 VACUUM 在启动时执行
+            await async_db.write(incremental_vacuum, TASK_RETENTION_VACUUM_PAGES)
+            if total:
+                print(f"[TaskRetention] 已归档 {total} 个已结束的任务")
+            return total
+        finally:
+            self.running = False
+    
+    async def loop(self):
+        await asyncio.sleep(TASK_RETENTION_DELAY)
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"[TaskRetention] 归档任务失败: {e}")
+            await asyncio.sleep(TASK_RETENTION_INTERVAL)
+    
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.loop())
+
+task_retention = TaskRetention()
+
+# ====== 带宽限制 ======
+def format_bandwidth(rate: float) -> str:
+    return f"{rate/1024/1024:.2f} MB/s" if rate > 0 else "不限制"
+
+class TokenBucket:
+    """
+    令牌桶限速器，rate 为字节/秒，0 表示不限制
+    
+    桶容量为 1 秒的流量；单次消耗超过容量时允许透支，由后续请求等待补足
+    """
+    def __init__(self, rate: float = 0):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+    
+    def set_rate(self, rate: float):
+        """修改速率，正在等待的请求在下一次检查时按新速率计算"""
+        self._refill()
+        self.rate = rate
+        self.tokens = min(self.tokens, rate)
+    
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    async def consume(self, byte_count: int):
+        while self.rate > 0:
+            self._refill()
+            if self.tokens >= min(byte_count, self.rate):
+                self.tokens -= byte_count
+                return
+            # 分段等待，速率被调整后能尽快按新值生效
+            wait = (min(byte_count, self.rate) - self.tokens) / self.rate
+            await asyncio.sleep(min(wait, 0.5))
+
+class BandwidthLimiter:
+    """全局、每用户、每任务三级带宽限制，修改后对进行中的下载立即生效"""
+    def __init__(self):
+        self.global_bucket = None
+        self.user_buckets = {}  # user_id -> TokenBucket
+        self.task_buckets = {}  # task_id -> TokenBucket，仅对内存中的任务有效
+    
+    def _get_global_bucket(self) -> TokenBucket:
+        if self.global_bucket is None:
+            self.global_bucket = TokenBucket(get_bandwidth_limit('global'))
+        return self.global_bucket
+    
+    def _get_user_bucket(self, user_id: int) -> TokenBucket:
+        if user_id not in self.user_buckets:
+            self.user_buckets[user_id] = TokenBucket(get_bandwidth_limit(f'user:{user_id}'))
+        return self.user_buckets[user_id]
+    
+    def set_global_limit(self, rate: float):
+        set_bandwidth_limit('global', rate)
+        self._get_global_bucket().set_rate(rate)
+    
+    def set_user_limit(self, user_id: int, rate: float):
+        set_bandwidth_limit(f'user:{user_id}', rate)
+        self._get_user_bucket(user_id).set_rate(rate)
+    
+    def set_task_limit(self, task_id: str, rate: float):
+        if task_id in self.task_buckets:
+            self.task_buckets[task_id].set_rate(rate)
+        else:
+            self.task_buckets[task_id] = TokenBucket(rate)
+    
+    def discard_task(self, task_id: str):
+        self.task_buckets.pop(task_id, None)
+    
+    def get_throttle(self, task: DownloadTask = None):
+        """返回传输路径使用的限速函数 throttle(byte_count)"""
+        user_id = task.user_id if task else 0
+        task_id = task.task_id if task else None
+        
+        async def throttle(byte_count: int):
+            await self._get_global_bucket().consume(byte_count)
+            if user_id:
+                await self._get_user_bucket(user_id).consume(byte_count)
+            task_bucket = self.task_buckets.get(task_id)
+            if task_bucket:
+                await task_bucket.consume(byte_count)
+        return throttle
+    
+    def reset(self):
+        """重置或重新加载设置后，重新读取全局和各用户的限制"""
+        self._get_global_bucket().set_rate(get_bandwidth_limit('global'))
+        for user_id, bucket in self.user_buckets.items():
+            bucket.set_rate(get_bandwidth_limit(f'user:{user_id}'))
+
+bandwidth_limiter = BandwidthLimiter()
+
 # ====== 消息发送速率限制 ======
 from collections import deque
 from datetime import datetime, timedelta
@@ -1622,6 +2741,7 @@ class ProgressMessageManager:
             text = "📥 下载任务进度\n\n"
             for task in user_tasks:
                 status_emoji = {
+                    "queued": "⏳",
                     "running": "⏬",
                     "paused": "⏸️",
                     "cancelled": "❌",
@@ -1661,15 +2781,46 @@ class ProgressMessageManager:
 progress_manager = ProgressMessageManager()
 
 # ====== 任务恢复功能 ======
+# 正常退出时保存的未完成任务快照
+TASK_SNAPSHOT_PATH = os.path.join(SQL_DIR, 'task_snapshot.json')
+
+def write_task_snapshot():
+    """退出时把未完成的任务写入快照，须在写线程中、任务进度全部写入数据库之后调用"""
+    tasks = get_all_download_tasks(statuses=list(PENDING_TASK_STATUSES))
+    tmp_path = TASK_SNAPSHOT_PATH + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'saved_at': time.time(), 'tasks': tasks}, f, ensure_ascii=False)
+    os.replace(tmp_path, TASK_SNAPSHOT_PATH)
+    print(f"[startup] 已保存 {len(tasks)} 个未完成任务的快照")
+
+def load_task_snapshot():
+    """
+    读取退出时保存的快照，读取后立即删除（只使用一次）
+    
+    Returns:
+        任务列表；没有快照（上次异常退出）或快照损坏时返回 None，改为查询数据库
+    """
+    if not os.path.exists(TASK_SNAPSHOT_PATH):
+        return None
+    try:
+        with open(TASK_SNAPSHOT_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)['tasks']
+    except Exception as e:
+        print(f"[startup] 读取任务快照失败: {e}")
+        return None
+    finally:
+        try:
+            os.remove(TASK_SNAPSHOT_PATH)
+        except OSError:
+            pass
+
 async def restore_pending_tasks():
-    """从数据库恢复未完成的任务"""
+    """从快照或数据库恢复未完成的任务"""
     try:
-        # 获取所有未完成的任务（running, paused, pending状态）
-        pending_statuses = ['running', 'paused', 'pending']
-        all_tasks = []
-        for status in pending_statuses:
-            tasks = get_all_download_tasks(status=status)
-            all_tasks.extend(tasks)
+        # 正常退出时有快照，可以省去启动时的查询；否则一次查询获取所有未完成的任务
+        all_tasks = load_task_snapshot()
+        if all_tasks is None:
+            all_tasks = await get_all_download_tasks_async(statuses=list(PENDING_TASK_STATUSES))
         
         if not all_tasks:
             print("ℹ️ 没有需要恢复的任务")
@@ -1681,8 +2832,21 @@ async def restore_pending_tasks():
         
         for task_dict in all_tasks:
             try:
-                # 恢复任务到内存
-                download_manager.restore_task(task_dict)
+                job_type = task_dict.get('job_type')
+                if job_type in ('range', 'comments'):
+                    # 范围和评论区下载由 resume_range_jobs 按游标继续，会重新创建文件任务
+                    await delete_download_task_async(task_dict['task_id'])
+                    continue
+                replayable = job_type in REPLAYABLE_JOB_TYPES and task_dict.get('chat_id') and task_dict.get('msg_id')
+                if replayable and task_dict.get('status') != 'paused':
+                    # 自动重新排队，已下载的部分从 .part 断点续传
+                    schedule_task_replay(task_dict)
+                    task_dict['replayed'] = True
+                else:
+                    # 恢复任务到内存；暂停的任务在继续时重新执行
+                    download_manager.restore_task(task_dict)
+                    if replayable:
+                        download_manager.get_task(task_dict['task_id']).replay_job = task_dict
                 restored_count += 1
                 
                 # 按用户分组
@@ -1695,51 +2859,103 @@ async def restore_pending_tasks():
                 print(f"恢复任务失败 {task_dict.get('task_id')}: {e}")
         
         if restored_count > 0:
-            print(f"✅ 已从数据库恢复 {restored_count} 个未完成任务")
-            # 通知用户
-            await notify_users_pending_tasks(user_tasks)
+            print(f"✅ 已恢复 {restored_count} 个未完成任务")
+            # 在后台通知用户，不阻塞后续启动阶段
+            schedule_background(notify_users_pending_tasks(user_tasks))
         else:
             print("ℹ️ 没有成功恢复的任务")
     except Exception as e:
         print(f"恢复任务时出错: {e}")
 
+# 重启后可按任务日志自动重新执行的任务类型
+REPLAYABLE_JOB_TYPES = ('single', 'album')
+background_tasks = set()  # 后台运行的协程，保留引用避免被回收
+
+def schedule_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def replay_download_task(task_dict: dict):
+    """按任务日志重新执行中断的下载，沿用原任务ID"""
+    task_id = task_dict['task_id']
+    file_path = task_dict.get('file_path')
+    try:
+        result = await download_single_file(
+            parse_stored_chat_id(task_dict['chat_id']),
+            task_dict['msg_id'],
+            download_path=os.path.dirname(file_path) if file_path else None,
+            bot_chat_id=task_dict.get('bot_chat_id') or task_dict['user_id'],
+            user_id=task_dict['user_id'],
+            skip_existing=True,
+            priority=task_dict.get('priority') or PRIORITY_INTERACTIVE,
+            job_type=task_dict['job_type'],
+            task_id=task_id
+        )
+    except Exception as e:
+        print(f"重新执行任务失败 {task_id}: {e}")
+        result = [f'下载失败: {e}']
+    # 消息不存在、不是媒体消息或文件已完整时不会创建任务，任务日志仍是未完成状态，
+    # 在这里结束它，避免每次启动都重新执行
+    row = await get_download_task_async(task_id)
+    if row and row.get('status') in PENDING_TASK_STATUSES:
+        skipped = bool(result) and all(str(item).startswith('✅') for item in result)
+        await update_download_task_async(
+            task_id,
+            status='completed' if skipped else 'failed',
+            error_message=None if skipped else '; '.join(str(item) for item in result)
+        )
+        # 继续重启前暂停的任务时，内存中还留着恢复出来的任务，一并移除
+        download_manager.remove_completed_task(task_id)
+
+def schedule_task_replay(task_dict: dict):
+    schedule_background(replay_download_task(task_dict))
+
 async def notify_users_pending_tasks(user_tasks: dict):
-    """通知用户有未完成的下载任务"""
-    for user_id, tasks in user_tasks.items():
-        try:
-            # 统计任务状态
-            running_count = sum(1 for t in tasks if t.get('status') == 'running')
-            paused_count = sum(1 for t in tasks if t.get('status') == 'paused')
-            pending_count = sum(1 for t in tasks if t.get('status') == 'pending')
-            
-            # 构建任务列表
-            task_list = []
-            for idx, task in enumerate(tasks[:5], 1):  # 最多显示5个
-                link = task.get('link', '未知链接')
-                status = task.get('status', 'unknown')
-                progress = task.get('progress', 0)
-                
-                status_emoji = {
-                    'running': '⏬',
-                    'paused': '⏸️',
-                    'pending': '⏳'
-                }.get(status, '❓')
-                
-                # 截取链接显示
-                link_display = link if len(link) <= 40 else link[:37] + '...'
-                task_list.append(f"{status_emoji} {link_display} ({progress:.0f}%)")
-            
-            if len(tasks) > 5:
-                task_list.append(f"... 还有 {len(tasks) - 5} 个任务")
-            
-            # 构建消息
-            message = f"""🔔 检测到未完成的下载任务
+    """通知用户有未完成的下载任务，各用户的通知并发发送，由 rate_limiter 控制速率"""
+    await asyncio.gather(*(notify_user_pending_tasks(user_id, tasks) for user_id, tasks in user_tasks.items()))
+
+async def notify_user_pending_tasks(user_id: int, tasks: list):
+    """向单个用户发送未完成任务的通知"""
+    try:
+        # 统计任务状态
+        running_count = sum(1 for t in tasks if t.get('status') == 'running')
+        paused_count = sum(1 for t in tasks if t.get('status') == 'paused')
+        pending_count = sum(1 for t in tasks if t.get('status') in ('pending', 'queued'))
+        replayed_count = sum(1 for t in tasks if t.get('replayed'))
+        
+        # 构建任务列表
+        task_list = []
+        for idx, task in enumerate(tasks[:5], 1):  # 最多显示5个
+            # 任务日志中的单文件任务没有链接，显示文件名
+            link = task.get('link') or os.path.basename(task.get('file_path') or '') or '未知链接'
+            status = task.get('status', 'unknown')
+            progress = (task.get('progress') or 0) * 100
+            
+            status_emoji = {
+                'running': '⏬',
+                'paused': '⏸️',
+                'pending': '⏳',
+                'queued': '⏳'
+            }.get(status, '❓')
+            
+            # 截取链接显示
+            link_display = link if len(link) <= 40 else link[:37] + '...'
+            task_list.append(f"{status_emoji} {link_display} ({progress:.0f}%)")
+        
+        if len(tasks) > 5:
+            task_list.append(f"... 还有 {len(tasks) - 5} 个任务")
+        
+        # 构建消息
+        message = f"""🔔 检测到未完成的下载任务
 
 📊 任务统计：
 • 总计: {len(tasks)} 个
 • 下载中: {running_count} 个
 • 已暂停: {paused_count} 个
 • 等待中: {pending_count} 个
+• 已自动重新排队: {replayed_count} 个
 
 📋 任务列表：
 {chr(10).join(task_list)}
@@ -1749,46 +2965,43 @@ async def notify_users_pending_tasks(user_tasks: dict):
 • 使用 /downloads 查看详情
 • 使用 /resume 恢复指定任务
 • 使用 /cancel 取消不需要的任务"""
-            
-            # 创建按钮
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [
-                    InlineKeyboardButton(
-                        text="▶️ 继续所有任务",
-                        callback_data=f"resume_all_user_{user_id}"
-                    )
-                ],
-                [
-                    InlineKeyboardButton(
-                        text="⏸️ 暂停所有任务",
-                        callback_data=f"pause_all_user_{user_id}"
-                    ),
-                    InlineKeyboardButton(
-                        text="❌ 取消所有任务",
-                        callback_data=f"cancel_all_user_{user_id}"
-                    )
-                ],
-                [
-                    InlineKeyboardButton(
-                        text="📋 查看任务详情",
-                        callback_data=f"view_tasks_{user_id}"
-                    )
-                ]
-            ])
-            
-            # 发送通知（使用rate_limiter避免速率限制）
-            await rate_limiter.send_message(
-                user_id,
-                message,
-                reply_markup=keyboard
-            )
-            print(f"✅ 已通知用户 {user_id}: {len(tasks)} 个未完成任务")
-            
-            # 添加延迟避免频繁发送
-            await asyncio.sleep(0.5)
-            
-        except Exception as e:
-            print(f"通知用户 {user_id} 失败: {e}")
+        
+        # 创建按钮
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [
+                InlineKeyboardButton(
+                    text="▶️ 继续所有任务",
+                    callback_data=f"resume_all_user_{user_id}"
+                )
+            ],
+            [
+                InlineKeyboardButton(
+                    text="⏸️ 暂停所有任务",
+                    callback_data=f"pause_all_user_{user_id}"
+                ),
+                InlineKeyboardButton(
+                    text="❌ 取消所有任务",
+                    callback_data=f"cancel_all_user_{user_id}"
+                )
+            ],
+            [
+                InlineKeyboardButton(
+                    text="📋 查看任务详情",
+                    callback_data=f"view_tasks_{user_id}"
+                )
+            ]
+        ])
+        
+        # 发送通知（使用rate_limiter避免速率限制）
+        await rate_limiter.send_message(
+            user_id,
+            message,
+            reply_markup=keyboard
+        )
+        print(f"✅ 已通知用户 {user_id}: {len(tasks)} 个未完成任务")
+        
+    except Exception as e:
+        print(f"通知用户 {user_id} 失败: {e}")
 
 # ====== 关键词监听自动下载 ======
 def match_keywords(text: str, keywords: list) -> bool:
@@ -1807,7 +3020,7 @@ async def setup_keyword_monitors():
             chat_id = str(event.chat_id)
             
             # 检查是否有该频道的监听配置
-            monitor = get_keyword_monitor(chat_id)
+            monitor = await get_keyword_monitor_async(chat_id)
             if not monitor or not monitor['enabled']:
                 return
             
@@ -1850,7 +3063,8 @@ async def setup_keyword_monitors():
                         event.message.id,
                         bot_chat_id=list(admin_ids)[0],
                         user_id=list(admin_ids)[0],
-                        progress_callback=None
+                        progress_callback=None,
+                        priority=PRIORITY_BULK
                     )
                 else:
                     # 单文件下载
@@ -1859,7 +3073,8 @@ async def setup_keyword_monitors():
                         event.message.id,
                         bot_chat_id=list(admin_ids)[0],
                         user_id=list(admin_ids)[0],
-                        progress_callback=None
+                        progress_callback=None,
+                        priority=PRIORITY_BULK
                     )
                 
                 # 下载完成通知
@@ -2241,6 +3456,8 @@ async def cmd_reset_settings(message: types.Message):
         reset_settings_to_default()
         
         # 更新下载管理器的并发限制
+        concurrency_tuner.stop()
+        bandwidth_limiter.reset()
         new_max_concurrent = get_max_concurrent_downloads()
         download_manager.update_limit(new_max_concurrent)
         
@@ -2264,6 +3481,35 @@ async def cmd_reset_settings(message: types.Message):
         error_msg = format_error_message("重置设置", e)
         await message.reply(error_msg)
 
+async def cmd_reload_settings(message: types.Message):
+    """处理/reloadsettings命令，从数据库重新加载设置（多实例共用数据库时同步其他实例的修改）"""
+    try:
+        user_id = message.from_user.id
+        
+        if not is_admin(user_id):
+            await message.reply("❌ 此命令仅限管理员使用。")
+            return
+        
+        await async_db.read(settings_cache.reload)
+        
+        # 应用可能变化的并发数和带宽设置
+        if get_auto_concurrency():
+            concurrency_tuner.start()
+        else:
+            concurrency_tuner.stop()
+            download_manager.update_limit(get_max_concurrent_downloads())
+        bandwidth_limiter.reset()
+        
+        await message.reply(
+            f"✅ 已重新加载系统设置\n\n"
+            f"👥 管理员 {len(get_admin_ids())} 人，授权用户 {len(get_allowed_user_ids())} 人\n"
+            f"📊 最大并发下载数：{download_manager.limit}"
+        )
+    
+    except Exception as e:
+        error_msg = format_error_message("重新加载设置", e)
+        await message.reply(error_msg)
+
 async def cmd_pause_download(message: types.Message):
     """处理/pause命令，暂停下载任务"""
     try:
@@ -2361,15 +3607,25 @@ async def cmd_cancel_download(message: types.Message):
         args = message.text.split(maxsplit=1)
         
         if len(args) == 1:
-            # 取消用户的所有下载任务
+            # 取消用户的所有下载任务，先停止范围下载，避免继续排入新文件
+            job_count = cancel_range_jobs(user_id)
             count = download_manager.cancel_user_tasks(user_id)
-            if count > 0:
-                await message.reply(f"❌ 已取消您的 {count} 个下载任务")
+            if count > 0 or job_count > 0:
+                await message.reply(f"❌ 已取消您的 {count} 个下载任务和 {job_count} 个范围/评论区下载")
             else:
                 await message.reply("❌ 您当前没有可取消的下载任务")
         else:
             # 取消指定的下载任务
             task_id = args[1].strip()
+            if task_id in range_job_tasks:
+                # 范围或评论区下载任务
+                job = range_job_tasks[task_id][0]
+                if not is_admin(user_id) and job['user_id'] != user_id:
+                    await message.reply("❌ 您只能操作自己的下载任务")
+                    return
+                cancel_range_job(task_id)
+                await message.reply(f"❌ 已取消范围/评论区下载: {task_id}")
+                return
             task = download_manager.get_task(task_id)
             
             if not task:
@@ -2390,8 +3646,55 @@ async def cmd_cancel_download(message: types.Message):
         error_msg = format_error_message("取消下载", e)
         await message.reply(error_msg)
 
+# /downloads history 每页显示的任务数
+DOWNLOAD_HISTORY_PAGE_SIZE = 10
+
+async def build_download_history(user_id: int, before: tuple = None) -> tuple:
+    """
+    从数据库按创建时间倒序分页列出任务记录（包括已结束的历史任务）
+    
+    Returns:
+        (消息文本, 下一页按钮键盘或 None)
+    """
+    owner = None if is_admin(user_id) else user_id
+    tasks = await get_download_tasks_page_async(user_id=owner, before=before, limit=DOWNLOAD_HISTORY_PAGE_SIZE + 1)
+    has_more = len(tasks) > DOWNLOAD_HISTORY_PAGE_SIZE
+    tasks = tasks[:DOWNLOAD_HISTORY_PAGE_SIZE]
+    if not tasks:
+        return "ℹ️ 没有更多任务记录", None
+    
+    status_emoji = {
+        'queued': '⏳',
+        'running': '⏬',
+        'paused': '⏸️',
+        'completed': '✅',
+        'cancelled': '❌',
+        'failed': '💥'
+    }
+    lines = []
+    for task in tasks:
+        # 任务日志的 file_path 是下载目标路径；file_paths 只有旧数据可能有值
+        file_path = task.get('file_path') or (task.get('file_paths') or [None])[0]
+        file_name = os.path.basename(file_path) if file_path else "未知文件"
+        if len(file_name) > 30:
+            file_name = file_name[:27] + "..."
+        progress = int((task.get('progress') or 0) * 100)
+        lines.append(
+            f"{status_emoji.get(task['status'], '❓')} {file_name}\n"
+            f"   {progress}% | {task['created_at']} | ID: {task['task_id']}"
+        )
+    text = "📜 任务历史记录\n\n" + "\n\n".join(lines)
+    
+    keyboard = None
+    if has_more:
+        last = tasks[-1]
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="➡️ 下一页", callback_data=f"dl_history_{last['created_at']}|{last['task_id']}")
+        ]])
+    return text, keyboard
+
 async def cmd_list_downloads(message: types.Message):
-    """处理/downloads命令，查看下载任务列表"""
+    """处理/downloads命令，查看下载任务列表；/downloads history 分页查看历史记录"""
     try:
         user_id = message.from_user.id
         
@@ -2400,6 +3703,12 @@ async def cmd_list_downloads(message: types.Message):
             await message.reply("❌ 您没有权限使用此命令。")
             return
         
+        args = message.text.split()
+        if len(args) > 1 and args[1].lower() in ("history", "历史"):
+            text, keyboard = await build_download_history(user_id)
+            await message.reply(text, reply_markup=keyboard)
+            return
+        
         # 管理员可以查看所有任务，普通用户只能查看自己的任务
         if is_admin(user_id):
             tasks = download_manager.get_all_tasks()
@@ -2415,7 +3724,8 @@ async def cmd_list_downloads(message: types.Message):
         # 按状态分组显示任务
         running_tasks = [t for t in tasks if t.status == "running"]
         paused_tasks = [t for t in tasks if t.status == "paused"]
-        other_tasks = [t for t in tasks if t.status not in ["running", "paused"]]
+        queued_tasks = [t for t in tasks if t.status == "queued"]
+        other_tasks = [t for t in tasks if t.status not in ["running", "paused", "queued"]]
         
         response_text = f"{title}\n\n"
         
@@ -2435,6 +3745,14 @@ async def cmd_list_downloads(message: types.Message):
                 response_text += f"... 还有 {len(paused_tasks) - 5} 个任务\n"
             response_text += "\n"
         
+        if queued_tasks:
+            response_text += "⏳ 排队中:\n"
+            for task in queued_tasks[:5]:  # 最多显示5个
+                response_text += f"• {download_manager.get_task_status_text(task)} (ID: {task.task_id})\n"
+            if len(queued_tasks) > 5:
+                response_text += f"... 还有 {len(queued_tasks) - 5} 个任务\n"
+            response_text += "\n"
+        
         if other_tasks:
             response_text += "📊 其他状态:\n"
             for task in other_tasks[:3]:  # 最多显示3个
@@ -2446,7 +3764,8 @@ async def cmd_list_downloads(message: types.Message):
         response_text += f"• /pause [任务ID] - 暂停下载\n"
         response_text += f"• /resume [任务ID] - 恢复下载\n"
         response_text += f"• /cancel [任务ID] - 取消下载\n"
-        response_text += f"• 不指定任务ID则操作所有任务"
+        response_text += f"• 不指定任务ID则操作所有任务\n"
+        response_text += f"• /downloads history - 查看历史记录"
         
         await message.reply(response_text)
         
@@ -2504,9 +3823,10 @@ async def cmd_cancel_all(message: types.Message):
             await message.reply("❌ 此命令仅限管理员使用。")
             return
         
+        job_count = cancel_range_jobs()
         count = download_manager.cancel_all_tasks()
-        if count > 0:
-            await message.reply(f"❌ 已取消所有 {count} 个下载任务")
+        if count > 0 or job_count > 0:
+            await message.reply(f"❌ 已取消所有 {count} 个下载任务和 {job_count} 个范围/评论区下载")
         else:
             await message.reply("❌ 当前没有可取消的下载任务")
         
@@ -2548,12 +3868,12 @@ async def cmd_addmonitor(message: types.Message):
         
         # 获取频道信息
         try:
-            entity = await userbot.get_entity(chat_identifier)
-            chat_id = str(entity.id)
-            chat_title = getattr(entity, 'title', chat_identifier)
+            entity = await entity_cache.get(chat_identifier)
+            chat_id = str(entity['entity_id'])
+            chat_title = entity['title'] or chat_identifier
             
             # 添加监听
-            add_keyword_monitor(chat_id, keywords, chat_title)
+            await add_keyword_monitor_async(chat_id, keywords, chat_title)
             
             keywords_text = '\n'.join(f"  • {kw}" for kw in keywords)
             await rate_limiter.send_message(
@@ -2598,17 +3918,17 @@ async def cmd_removemonitor(message: types.Message):
         
         # 获取频道信息
         try:
-            entity = await userbot.get_entity(chat_identifier)
-            chat_id = str(entity.id)
+            entity = await entity_cache.get(chat_identifier)
+            chat_id = str(entity['entity_id'])
             
             # 检查是否存在监听
-            monitor = get_keyword_monitor(chat_id)
+            monitor = await get_keyword_monitor_async(chat_id)
             if not monitor:
                 await rate_limiter.send_message(message.chat.id, f"❌ 频道 {chat_identifier} 没有配置监听")
                 return
             
             # 删除监听
-            remove_keyword_monitor(chat_id)
+            await remove_keyword_monitor_async(chat_id)
             await rate_limiter.send_message(
                 message.chat.id,
                 f"✅ 已删除频道 {monitor.get('chat_title', chat_identifier)} 的关键词监听"
@@ -2633,7 +3953,7 @@ async def cmd_listmonitors(message: types.Message):
             return
         
         # 获取所有监听
-        monitors = get_all_keyword_monitors(enabled_only=False)
+        monitors = await get_all_keyword_monitors_async(enabled_only=False)
         
         if not monitors:
             await rate_limiter.send_message(message.chat.id, "ℹ️ 当前没有配置关键词监听")
@@ -2683,18 +4003,18 @@ async def cmd_togglemonitor(message: types.Message):
         
         # 获取频道信息
         try:
-            entity = await userbot.get_entity(chat_identifier)
-            chat_id = str(entity.id)
+            entity = await entity_cache.get(chat_identifier)
+            chat_id = str(entity['entity_id'])
             
             # 检查是否存在监听
-            monitor = get_keyword_monitor(chat_id)
+            monitor = await get_keyword_monitor_async(chat_id)
             if not monitor:
                 await rate_limiter.send_message(message.chat.id, f"❌ 频道 {chat_identifier} 没有配置监听")
                 return
             
             # 切换状态
             new_status = not monitor['enabled']
-            toggle_keyword_monitor(chat_id, new_status)
+            await toggle_keyword_monitor_async(chat_id, new_status)
             
             status_text = "启用" if new_status else "禁用"
             await rate_limiter.send_message(
@@ -2736,74 +4056,9 @@ async def cmd_download_comments(message: types.Message):
         await rate_limiter.send_message(message.chat.id, "⏳ 正在获取评论区...")
         
         try:
-            await ensure_userbot()
-            
-            # 获取原始消息
-            original_message = await userbot.get_messages(chat_id, ids=msg_id)
-            if not original_message:
-                await rate_limiter.send_message(message.chat.id, "❌ 无法获取原始消息")
-                return
-            
-            # 获取评论区（replies）
-            if not original_message.replies:
-                await rate_limiter.send_message(message.chat.id, "ℹ️ 该消息没有评论区或评论为空")
-                return
-            
-            # 获取所有评论
-            replies = await userbot.get_messages(
-                chat_id, 
-                reply_to=msg_id,
-                limit=100  # 限制获取最多100条评论
-            )
-            
-            if not replies:
-                await rate_limiter.send_message(message.chat.id, "ℹ️ 评论区没有媒体文件")
-                return
-            
-            # 筛选包含媒体的评论
-            media_messages = [r for r in replies if r.media or r.grouped_id]
-            
-            if not media_messages:
-                await rate_limiter.send_message(message.chat.id, "ℹ️ 评论区没有媒体文件")
-                return
-            
-            await rate_limiter.send_message(
-                message.chat.id, 
-                f"📥 找到 {len(media_messages)} 条包含媒体的评论，开始下载..."
-            )
-            
-            # 下载所有媒体
-            downloaded_count = 0
-            for reply_msg in media_messages:
-                try:
-                    if reply_msg.grouped_id:
-                        # 相册
-                        await download_album(
-                            chat_id,
-                            reply_msg.id,
-                            bot_chat_id=message.chat.id,
-                            user_id=user_id,
-                            progress_callback=None
-                        )
-                    else:
-                        # 单文件
-                        await download_single_file(
-                            chat_id,
-                            reply_msg.id,
-                            bot_chat_id=message.chat.id,
-                            user_id=user_id,
-                            progress_callback=None
-                        )
-                    downloaded_count += 1
-                except Exception as e:
-                    print(f"下载评论媒体失败: {e}")
-                    continue
-            
-            await rate_limiter.send_message(
-                message.chat.id,
-                f"✅ 评论区下载完成！成功下载 {downloaded_count}/{len(media_messages)} 个文件"
-            )
-            
+            error_text = await download_comments(chat_id, msg_id, user_id, message.chat.id)
+            if error_text:
+                await rate_limiter.send_message(message.chat.id, error_text)
         except Exception as e:
             await rate_limiter.send_message(
                 message.chat.id,
@@ -2819,11 +4074,11 @@ async def cmd_auto(message: types.Message):
         await message.reply('用法: /auto 频道ID或@用户名')
         return
     chat = args[1].strip()
-    add_auto_download(chat)
+    await add_auto_download_async(chat)
     @userbot.on(events.NewMessage(chats=chat))
     async def handler(event):
         if event.grouped_id:
-            files = await download_album(event.chat_id, event.id, bot_chat_id=message.chat.id, progress_callback=lambda cur, total: asyncio.create_task(bot.send_message(message.chat.id, f"下载进度: {cur}/{total}")))
+            files = await download_album(event.chat_id, event.id, bot_chat_id=message.chat.id, priority=PRIORITY_BULK, progress_callback=lambda cur, total: asyncio.create_task(bot.send_message(message.chat.id, f"下载进度: {cur}/{total}")))
             await bot.send_message(message.chat.id, f'自动下载: {files}')
     await message.reply(f'已设置自动下载 {chat} 的新相册消息。')
 
@@ -2838,12 +4093,34 @@ async def set_max_cmd(message: types.Message):
         
         # 验证命令参数
         is_valid, args, error_msg = validate_command_args(
-            message.text, 1, "/setmax", "/setmax <数量>"
+            message.text, 1, "/setmax", "/setmax <数量|auto [上限]>"
         )
         if not is_valid:
             await message.reply(error_msg)
             return
         
+        # 自动模式：/setmax auto [上限]
+        params = args[1].split()
+        if params[0].lower() == "auto":
+            try:
+                max_value = int(params[1]) if len(params) > 1 else get_auto_concurrency_max()
+                if max_value <= 0 or max_value > 20:
+                    await message.reply("❌ 自动模式上限必须在 1-20 之间。")
+                    return
+            except ValueError:
+                await message.reply("❌ 请输入有效的数字。\n\n💡 示例: /setmax auto 10")
+                return
+            set_auto_concurrency(True, max_value)
+            if download_manager.limit > max_value:
+                download_manager.update_limit(max_value)
+            concurrency_tuner.start()
+            await message.reply(
+                f"✅ 已开启并发数自动调节\n"
+                f"📈 从当前 {download_manager.limit} 开始，上限 {max_value}\n"
+                f"💡 使用 /setmax <数量> 恢复固定并发数"
+            )
+            return
+        
         # 验证数值参数
         try:
             n = int(args[1].strip())
@@ -2858,6 +4135,8 @@ async def set_max_cmd(message: types.Message):
             return
         
         set_max_concurrent_downloads(n)
+        set_auto_concurrency(False)
+        concurrency_tuner.stop()
         download_manager.update_limit(n)
         await message.reply(f"✅ 最大同时下载数已设置为: {n}")
         
@@ -2902,6 +4181,226 @@ async def set_refresh_cmd(message: types.Message):
         error_msg = format_error_message("设置进度刷新间隔", e)
         await message.reply(error_msg)
 
+async def set_parallel_cmd(message: types.Message):
+    """处理/setparallel命令，设置大文件并行下载的连接数和大小阈值"""
+    try:
+        user_id = message.from_user.id
+        
+        # 权限检查：只允许管理员使用
+        if not is_admin(user_id):
+            await message.reply("❌ 此命令仅限管理员使用。")
+            return
+        
+        # 验证命令参数
+        is_valid, args, error_msg = validate_command_args(
+            message.text, 1, "/setparallel", "/setparallel <连接数> [阈值MB]"
+        )
+        if not is_valid:
+            await message.reply(error_msg)
+            return
+        
+        # 验证数值参数
+        params = args[1].split()
+        try:
+            connections = int(params[0])
+            threshold_mb = float(params[1]) if len(params) > 1 else None
+            if connections < 1 or connections > 16:
+                await message.reply("❌ 连接数必须在 1-16 之间（1 表示关闭并行下载）。\n\n💡 建议范围: 4-8")
+                return
+            if threshold_mb is not None and threshold_mb < 1:
+                await message.reply("❌ 阈值不能小于 1 MB。")
+                return
+        except ValueError:
+            await message.reply("❌ 请输入有效的数字。\n\n💡 示例: /setparallel 8 50")
+            return
+        
+        set_parallel_download(connections, threshold_mb)
+        if connections == 1:
+            await message.reply("✅ 已关闭大文件并行下载")
+        else:
+            await message.reply(
+                f"✅ 并行下载已设置为: {connections} 个连接\n"
+                f"📦 启用阈值: {get_parallel_threshold() // (1024 * 1024)} MB"
+            )
+        
+    except Exception as e:
+        error_msg = format_error_message("设置并行下载", e)
+        await message.reply(error_msg)
+
+async def set_retention_cmd(message: types.Message):
+    """处理/setretention命令，设置已结束任务的保留策略并立即执行一次归档"""
+    try:
+        user_id = message.from_user.id
+        
+        # 权限检查：只允许管理员使用
+        if not is_admin(user_id):
+            await message.reply("❌ 此命令仅限管理员使用。")
+            return
+        
+        # 验证命令参数
+        is_valid, args, error_msg = validate_command_args(
+            message.text, 1, "/setretention", "/setretention <天数> [每用户条数]"
+        )
+        if not is_valid:
+            await message.reply(error_msg)
+            return
+        
+        # 验证数值参数
+        params = args[1].split()
+        try:
+            days = int(params[0])
+            per_user = int(params[1]) if len(params) > 1 else None
+            if days < 0 or (per_user is not None and per_user < 0):
+                await message.reply("❌ 天数和条数不能为负数（0 表示不按该条件清理）。")
+                return
+        except ValueError:
+            await message.reply("❌ 请输入有效的数字。\n\n💡 示例: /setretention 30 200")
+            return
+        
+        set_task_retention(days, per_user)
+        days, per_user = get_task_retention()
+        archived = await task_retention.run_once()
+        summary = await async_db.read(get_archive_summary)
+        
+        text = (
+            f"✅ 任务记录保留策略已更新\n"
+            f"📅 保留天数: {days if days else '不限'}\n"
+            f"👤 每用户保留: {per_user if per_user else '不限'}\n\n"
+            f"🗄️ 本次归档 {archived} 条，归档总数 {summary['archived']} 条"
+        )
+        if summary['days']:
+            text += "\n\n📊 最近归档的每日统计:\n" + "\n".join(
+                f"• {day['day']}: {day['task_count']} 个任务, {day['total_size'] / 1024 / 1024:.1f} MB"
+                for day in summary['days']
+            )
+        await message.reply(text)
+        
+    except Exception as e:
+        error_msg = format_error_message("设置任务保留策略", e)
+        await message.reply(error_msg)
+
+async def set_speed_cmd(message: types.Message):
+    """处理/setspeed命令，设置全局、用户或任务级别的带宽限制"""
+    try:
+        user_id = message.from_user.id
+        
+        # 权限检查：只允许管理员使用
+        if not is_admin(user_id):
+            await message.reply("❌ 此命令仅限管理员使用。")
+            return
+        
+        usage = "/setspeed global <MB/s> | /setspeed user <用户ID> <MB/s> | /setspeed task <任务ID> <MB/s>"
+        is_valid, args, error_msg = validate_command_args(message.text, 1, "/setspeed", usage)
+        if not is_valid:
+            await message.reply(error_msg)
+            return
+        
+        params = args[1].split()
+        scope = params[0].lower()
+        if (scope == "global" and len(params) != 2) or (scope in ("user", "task") and len(params) != 3) \
+                or scope not in ("global", "user", "task"):
+            await message.reply(f"❌ 用法: {usage}\n\n💡 示例: /setspeed global 10（0 表示不限制）")
+            return
+        
+        try:
+            rate_mb = float(params[-1])
+            if rate_mb < 0:
+                raise ValueError
+        except ValueError:
+            await message.reply("❌ 速度必须是非负数字（单位 MB/s，0 表示不限制）。")
+            return
+        rate = rate_mb * 1024 * 1024
+        
+        if scope == "global":
+            bandwidth_limiter.set_global_limit(rate)
+            target = "全局"
+        elif scope == "user":
+            try:
+                target_user_id = int(params[1])
+            except ValueError:
+                await message.reply("❌ 用户ID必须是数字。")
+                return
+            bandwidth_limiter.set_user_limit(target_user_id, rate)
+            target = f"用户 {target_user_id}"
+        else:
+            task_id = params[1]
+            if not download_manager.get_task(task_id):
+                await message.reply(f"❌ 未找到任务: {task_id}")
+                return
+            bandwidth_limiter.set_task_limit(task_id, rate)
+            target = f"任务 {task_id}"
+        
+        await message.reply(f"✅ {target}带宽限制已设置为: {format_bandwidth(rate)}")
+        
+    except Exception as e:
+        error_msg = format_error_message("设置带宽限制", e)
+        await message.reply(error_msg)
+
+async def cmd_accounts(message: types.Message):
+    """处理/accounts命令，查看 userbot 账号池状态"""
+    try:
+        user_id = message.from_user.id
+        
+        # 权限检查：只允许管理员使用
+        if not is_admin(user_id):
+            await message.reply("❌ 此命令仅限管理员使用。")
+            return
+        
+        await message.reply(
+            f"👥 userbot 账号池（{len(account_pool.accounts)} 个账号）\n\n"
+            f"{account_pool.get_status_text()}\n\n"
+            f"💡 添加账号：浏览器打开 ip:8000/login?account=账号名"
+        )
+    except Exception as e:
+        error_msg = format_error_message("查看账号池", e)
+        await message.reply(error_msg)
+
+RANGE_QUEUE_SIZE = 50  # 扫描结果队列上限，扫描领先下载太多时暂停扫描
+RANGE_STATUS_INTERVAL = 3  # 范围下载状态消息和游标的保存间隔（秒）
+RANGE_SCAN_RETRIES = 5  # 扫描出错时的重试次数
+RANGE_SCAN_RETRY_DELAY = 10  # 扫描重试间隔（秒）
+RANGE_SCAN_SEGMENT = 500  # 每扫描这么多条消息重新选择一次账号
+
+range_job_tasks = {}  # job_id -> (任务信息, 正在执行的 asyncio.Task)
+
+def start_range_job(job: dict):
+    """在后台执行范围或评论区下载任务，登记到 range_job_tasks 以便取消"""
+    job_id = job['job_id']
+    job_name = "评论区下载" if job.get('reply_to') else "范围下载"
+    
+    async def run():
+        try:
+            await run_range_job(job)
+        except Exception as e:
+            print(f"[range_job] {job_name}任务 {job_id} 出错: {e}")
+            try:
+                await rate_limiter.send_message(job['bot_chat_id'], f"❌ {job_name}失败 (任务 {job_id}): {e}")
+            except Exception:
+                pass
+        finally:
+            range_job_tasks.pop(job_id, None)
+    
+    range_job_tasks[job_id] = (job, asyncio.create_task(run()))
+
+def cancel_range_job(job_id: str) -> bool:
+    """取消正在执行的范围或评论区下载任务：标记为 cancelled，停止扫描并取消进行中的文件下载"""
+    entry = range_job_tasks.get(job_id)
+    if not entry:
+        return False
+    job, task = entry
+    job['cancelled'] = True
+    async_db.submit_write(update_range_job, job_id, status='cancelled')
+    task.cancel()
+    return True
+
+def cancel_range_jobs(user_id: int = None) -> int:
+    """取消某个用户（None 表示所有用户）的范围和评论区下载任务"""
+    job_ids = [
+        job_id for job_id, (job, _) in list(range_job_tasks.items())
+        if user_id is None or job['user_id'] == user_id
+    ]
+    return sum(1 for job_id in job_ids if cancel_range_job(job_id))
+
 async def handle_range_download(message: types.Message, start_chat_id, start_msg_id, end_chat_id, end_msg_id, user_id):
     """处理范围下载：下载两个消息ID之间的所有媒体"""
     try:
@@ -2918,188 +4417,356 @@ async def handle_range_download(message: types.Message, start_chat_id, start_msg
             return
         
         # 确定范围（自动排序）
-        chat_id = start_chat_id
         min_id = min(start_msg_id, end_msg_id)
         max_id = max(start_msg_id, end_msg_id)
-        range_size = max_id - min_id + 1
         
-        # 限制范围大小
-        if range_size > 1000:
-            await rate_limiter.send_message(
-                message.chat.id,
-                f"❌ 范围过大\n\n当前范围: {range_size} 条消息\n最大支持: 1000 条消息\n\n"
-                "💡 建议分段下载"
-            )
-            return
-        
-        # 发送初始消息
-        status_msg = await rate_limiter.send_message(
-            message.chat.id,
-            f"🔍 范围下载分析中...\n\n"
-            f"📊 消息范围: {min_id} - {max_id}\n"
-            f"📈 总数量: {range_size} 条\n"
-            f"⏳ 正在扫描媒体文件..."
-        )
-        
-        await ensure_userbot()
+        # 创建可续传的范围任务，游标记录已处理完的最后一条消息ID
+        job = {
+            'job_id': f"range_{uuid.uuid4().hex[:12]}",
+            'user_id': user_id,
+            'chat_id': start_chat_id_str,
+            'bot_chat_id': message.chat.id,
+            'min_id': min_id,
+            'max_id': max_id,
+            'cursor': min_id - 1,
+            'downloaded': 0,
+            'skipped': 0,
+            'failed': 0
+        }
+        await save_range_job_async(job)
+        start_range_job(job)
         
-        # 获取频道信息
+    except Exception as e:
+        error_msg = f"❌ 范围下载失败: {str(e)}"
         try:
-            chat_title = await get_chat_info(chat_id)
-            if not chat_title:
-                chat_title = f"频道_{chat_id}"
+            await rate_limiter.send_message(message.chat.id, error_msg)
         except:
+            await message.reply(error_msg)
+        print(f"[handle_range_download] error: {e}")
+
+def parse_stored_chat_id(chat_id: str):
+    """数据库中的 chat_id 是字符串，私密频道需要还原成整数"""
+    return int(chat_id) if chat_id.lstrip('-').isdigit() else chat_id
+
+async def run_range_job(job: dict):
+    """
+    执行（或继续）范围下载或评论区下载任务
+    
+    用 iter_messages 从游标之后按消息ID顺序流式扫描，内存占用与范围大小无关；
+    job['reply_to'] 不为空时扫描该消息的全部评论（讨论组中的回复）；
+    扫描到的媒体经有界队列交给下载 worker，实际并发由 download_manager 调度；
+    游标只推进到所有更早的消息都已处理完的位置，定期保存，重启后从游标继续；
+    扫描多次重试仍失败时任务标记为 failed，被取消时标记为 cancelled，两者都不再自动继续
+    """
+    job_id = job['job_id']
+    chat_id = parse_stored_chat_id(job['chat_id'])
+    bot_chat_id = job['bot_chat_id']
+    user_id = job['user_id']
+    min_id = job['min_id']
+    max_id = job['max_id']
+    reply_to = job.get('reply_to')
+    range_size = max_id - min_id + 1
+    if reply_to:
+        job_name = "评论区下载"
+        scope_text = f"💬 评论区: 消息 {reply_to} 的全部评论"
+        resumed = job['cursor'] > 0
+    else:
+        job_name = "范围下载"
+        scope_text = f"📊 消息范围: {min_id} - {max_id}\n📈 总数量: {range_size} 条"
+        resumed = job['cursor'] >= min_id
+    
+    status_msg = await rate_limiter.send_message(
+        bot_chat_id,
+        (f"🔄 继续{job_name} (任务 {job_id})\n\n从消息 {job['cursor'] + 1} 继续...\n" if resumed else f"🔍 {job_name}分析中...\n\n") +
+        f"{scope_text}\n"
+        f"⏳ 正在扫描媒体文件..."
+    )
+    
+    await ensure_userbot()
+    
+    # 获取频道信息
+    try:
+        chat_title = await get_chat_info(chat_id)
+        if not chat_title:
             chat_title = f"频道_{chat_id}"
-        
-        # 批量获取消息（优化性能）
-        media_messages = []
-        scanned = 0
-        batch_size = 100
-        
-        for offset in range(0, range_size, batch_size):
-            batch_min = min_id + offset
-            batch_max = min(batch_min + batch_size - 1, max_id)
-            
-            try:
-                # 获取一批消息
-                messages = await userbot.get_messages(
-                    chat_id,
-                    ids=list(range(batch_min, batch_max + 1))
-                )
-                
-                # 筛选包含媒体的消息
-                for msg in messages:
-                    if msg and (msg.media or msg.grouped_id):
-                        # 避免重复添加相册消息
-                        if msg.grouped_id:
-                            # 只添加每个相册的第一条消息
-                            if not any(m.grouped_id == msg.grouped_id for m in media_messages):
-                                media_messages.append(msg)
-                        else:
-                            media_messages.append(msg)
-                
-                scanned += len(messages) if isinstance(messages, list) else 1
-                
-                # 更新扫描进度
-                if scanned % 200 == 0 or offset + batch_size >= range_size:
-                    await rate_limiter.edit_message(
-                        message.chat.id,
-                        status_msg.message_id,
-                        f"🔍 范围下载分析中...\n\n"
-                        f"📊 消息范围: {min_id} - {max_id}\n"
-                        f"📈 总数量: {range_size} 条\n"
-                        f"🔎 已扫描: {scanned}/{range_size}\n"
-                        f"📥 找到媒体: {len(media_messages)} 条"
-                    )
-            except Exception as e:
-                print(f"批量获取消息失败 {batch_min}-{batch_max}: {e}")
-                continue
-        
-        if not media_messages:
+    except:
+        chat_title = f"频道_{chat_id}"
+    if reply_to:
+        # 评论按讨论组保存
+        chat_title = f"{chat_title} 的讨论组"
+    
+    queue = asyncio.Queue(maxsize=RANGE_QUEUE_SIZE)
+    worker_count = max(1, get_auto_concurrency_max() if get_auto_concurrency() else download_manager.limit)
+    stats = {
+        'found': 0,
+        'done': 0,
+        'downloaded': job['downloaded'],
+        'skipped': job['skipped'],
+        'failed': job['failed']
+    }
+    scanned_upto = job['cursor']  # 已扫描到的最后一条消息ID
+    inflight = set()  # 已扫描但还没处理完的消息ID
+    scan_finished = False
+    scan_error = None
+    last_status_update = 0
+    
+    def get_cursor() -> int:
+        return min(inflight) - 1 if inflight else scanned_upto
+    
+    def save_progress(status: str = None):
+        fields = dict(
+            cursor=get_cursor(),
+            downloaded=stats['downloaded'],
+            skipped=stats['skipped'],
+            failed=stats['failed']
+        )
+        if status:
+            fields['status'] = status
+        async_db.submit_write(update_range_job, job_id, **fields)
+    
+    async def update_status(force=False):
+        nonlocal last_status_update
+        now = time.time()
+        if not force and now - last_status_update < RANGE_STATUS_INTERVAL:
+            return
+        last_status_update = now
+        save_progress()
+        if scan_finished:
+            scan_text = "✅ 扫描完成"
+        elif reply_to:
+            scan_text = f"🔎 已扫描到评论: {scanned_upto}"
+        else:
+            scan_text = f"🔎 已扫描到: {max(scanned_upto, min_id - 1)}/{max_id}"
+        try:
             await rate_limiter.edit_message(
-                message.chat.id,
+                bot_chat_id,
                 status_msg.message_id,
-                f"ℹ️ 范围下载完成\n\n"
-                f"📊 扫描范围: {min_id} - {max_id} ({range_size} 条)\n"
-                f"📥 媒体文件: 0 条\n\n"
-                "该范围内没有找到媒体文件"
+                f"📥 {job_name}进行中... (任务 {job_id})\n\n"
+                f"{scope_text}\n"
+                f"{scan_text}\n"
+                f"📥 本次找到媒体: {stats['found']} 条\n"
+                f"✅ 已完成: {stats['downloaded']}\n"
+                f"⏭️ 跳过: {stats['skipped']}\n"
+                f"❌ 失败: {stats['failed']}\n"
+                f"⏳ 已处理: {stats['done']}/{stats['found']}\n"
+                f"📁 保存位置: {chat_title}"
             )
-            return
-        
-        # 显示下载确认
-        await rate_limiter.edit_message(
-            message.chat.id,
-            status_msg.message_id,
-            f"✅ 范围扫描完成\n\n"
-            f"📊 扫描范围: {min_id} - {max_id} ({range_size} 条)\n"
-            f"📥 找到媒体: {len(media_messages)} 条\n"
-            f"📁 保存位置: {chat_title}\n\n"
-            f"⏳ 开始批量下载..."
-        )
-        
-        # 批量下载媒体
-        downloaded_count = 0
-        failed_count = 0
-        skipped_count = 0
-        
-        for idx, msg in enumerate(media_messages, 1):
+        except Exception as e:
+            print(f"[run_range_job] 更新状态失败: {e}")
+    
+    async def scan():
+        nonlocal scan_finished, scanned_upto, scan_error
+        last_group_id = None
+        retries = 0
+        finished = False
+        try:
+            while not finished:
+                # 与下载一样选负载最低的账号，扫描期间计入该账号的负载；
+                # 每扫描一段重新选择，长时间的扫描不会一直压在同一个账号上
+                account = await account_pool.pick(chat_id)
+                account.active += 1
+                retry = False
+                try:
+                    # min_id/max_id 不包含边界，reverse=True 从旧到新遍历；评论按页自动翻完
+                    if reply_to:
+                        messages = account.client.iter_messages(
+                            chat_id, reply_to=reply_to, min_id=scanned_upto, reverse=True
+                        )
+                    else:
+                        messages = account.client.iter_messages(
+                            chat_id, min_id=scanned_upto, max_id=max_id + 1, reverse=True
+                        )
+                    segment_count = 0
+                    async for msg in messages:
+                        if msg.media or msg.grouped_id:
+                            # 相册的消息ID连续，每个相册只下载一次
+                            if not msg.grouped_id or msg.grouped_id != last_group_id:
+                                last_group_id = msg.grouped_id
+                                # 下载时按消息ID获取，直接命中缓存
+                                message_cache.put(get_source_chat_id(msg), msg)
+                                stats['found'] += 1
+                                inflight.add(msg.id)
+                                # 队列满时在这里等待下载追上
+                                await queue.put(msg)
+                        scanned_upto = msg.id
+                        retries = 0
+                        await update_status()
+                        segment_count += 1
+                        if segment_count >= RANGE_SCAN_SEGMENT:
+                            break
+                    else:
+                        finished = True
+                        if not reply_to:
+                            scanned_upto = max_id
+                except FloodWaitError as e:
+                    account_pool.mark_flood(account, e.seconds)
+                except Exception as e:
+                    retries += 1
+                    print(f"[run_range_job] 扫描失败（第 {retries} 次）{job_id} @ {scanned_upto}: {e}")
+                    if retries > RANGE_SCAN_RETRIES:
+                        scan_error = e
+                        break
+                    retry = True
+                finally:
+                    account.active -= 1
+                if retry:
+                    await asyncio.sleep(RANGE_SCAN_RETRY_DELAY)
+        finally:
+            scan_finished = True
+        # 被取消时 worker 也已取消，不再放入结束标记，避免队列满时卡住
+        for _ in range(worker_count):
+            await queue.put(None)
+    
+    # 文件任务记入任务日志的类型，重启时这些任务交给 range_jobs 按游标继续
+    job_type = 'comments' if reply_to else 'range'
+    
+    def get_source_chat_id(msg):
+        # 评论位于频道关联的讨论组，要按讨论组下载
+        return msg.chat_id if reply_to else chat_id
+    
+    async def download_worker():
+        while True:
+            msg = await queue.get()
+            if msg is None:
+                return
             try:
-                # 更新进度
-                if idx % 5 == 0 or idx == len(media_messages):
-                    await rate_limiter.edit_message(
-                        message.chat.id,
-                        status_msg.message_id,
-                        f"📥 范围下载进行中...\n\n"
-                        f"📊 总计: {len(media_messages)} 个文件\n"
-                        f"✅ 已完成: {downloaded_count}\n"
-                        f"⏭️ 跳过: {skipped_count}\n"
-                        f"❌ 失败: {failed_count}\n"
-                        f"⏳ 当前: {idx}/{len(media_messages)}\n\n"
-                        f"🔄 进度: {int(idx/len(media_messages)*100)}%"
-                    )
-                
-                # 下载消息
                 if msg.grouped_id:
                     # 相册下载
                     result = await download_album(
-                        chat_id,
+                        get_source_chat_id(msg),
                         msg.id,
-                        bot_chat_id=message.chat.id,
+                        bot_chat_id=bot_chat_id,
                         user_id=user_id,
                         skip_existing=True,
-                        progress_callback=None
+                        progress_callback=None,
+                        priority=PRIORITY_BULK,
+                        job_type=job_type
                     )
                 else:
                     # 单文件下载
                     result = await download_single_file(
-                        chat_id,
+                        get_source_chat_id(msg),
                         msg.id,
-                        bot_chat_id=message.chat.id,
+                        bot_chat_id=bot_chat_id,
                         user_id=user_id,
                         skip_existing=True,
-                        progress_callback=None
+                        progress_callback=None,
+                        priority=PRIORITY_BULK,
+                        job_type=job_type
                     )
                 
                 # 统计结果
                 if isinstance(result, list):
                     for item in result:
                         if '✅' in str(item) and '跳过' in str(item):
-                            skipped_count += 1
+                            stats['skipped'] += 1
                         elif '失败' in str(item) or '❌' in str(item):
-                            failed_count += 1
+                            stats['failed'] += 1
                         else:
-                            downloaded_count += 1
+                            stats['downloaded'] += 1
                 else:
-                    downloaded_count += 1
-                    
+                    stats['downloaded'] += 1
             except Exception as e:
                 print(f"范围下载单个文件失败 {msg.id}: {e}")
-                failed_count += 1
-                continue
-        
-        # 显示最终结果
-        result_text = f"✅ 范围下载完成\n\n"
-        result_text += f"📊 扫描范围: {min_id} - {max_id} ({range_size} 条消息)\n"
-        result_text += f"📥 媒体文件: {len(media_messages)} 条\n\n"
-        result_text += f"📈 下载结果:\n"
-        result_text += f"  ✅ 新下载: {downloaded_count} 个\n"
-        result_text += f"  ⏭️ 已存在: {skipped_count} 个\n"
-        result_text += f"  ❌ 失败: {failed_count} 个\n\n"
-        result_text += f"📁 保存位置: {chat_title}"
-        
+                stats['failed'] += 1
+            inflight.discard(msg.id)
+            stats['done'] += 1
+            await update_status()
+    
+    try:
+        await asyncio.gather(scan(), *[download_worker() for _ in range(worker_count)])
+    except asyncio.CancelledError:
+        # 保存游标；退出时被取消的任务保持 running，下次启动继续
+        save_progress()
+        if not job.get('cancelled'):
+            raise
         await rate_limiter.edit_message(
-            message.chat.id,
+            bot_chat_id,
             status_msg.message_id,
-            result_text
+            f"❌ {job_name}已取消 (任务 {job_id})\n\n"
+            f"📊 已处理到消息: {get_cursor()}\n"
+            f"✅ 已完成: {stats['downloaded']} | ⏭️ 跳过: {stats['skipped']} | ❌ 失败: {stats['failed']}"
         )
-        
+        return
+    
+    if scan_error:
+        # 标记为失败，不再在启动时自动继续
+        save_progress(status='failed')
+        await rate_limiter.edit_message(
+            bot_chat_id,
+            status_msg.message_id,
+            f"⚠️ {job_name}中断 (任务 {job_id})\n\n"
+            f"📊 已处理到消息: {get_cursor()}\n"
+            f"❌ 扫描出错: {scan_error}\n\n"
+            "💡 重新发起下载即可继续，已下载的文件会自动跳过"
+        )
+        return
+    
+    save_progress(status='completed')
+    
+    # 显示最终结果
+    result_text = f"✅ {job_name}完成\n\n"
+    result_text += (f"{scope_text}\n" if reply_to else f"📊 扫描范围: {min_id} - {max_id} ({range_size} 条消息)\n")
+    result_text += f"📥 本次找到媒体: {stats['found']} 条\n\n"
+    result_text += f"📈 下载结果:\n"
+    result_text += f"  ✅ 新下载: {stats['downloaded']} 个\n"
+    result_text += f"  ⏭️ 已存在: {stats['skipped']} 个\n"
+    result_text += f"  ❌ 失败: {stats['failed']} 个\n\n"
+    result_text += f"📁 保存位置: {chat_title}"
+    
+    await rate_limiter.edit_message(
+        bot_chat_id,
+        status_msg.message_id,
+        result_text
+    )
+
+async def resume_range_jobs():
+    """启动时在后台继续未完成的范围下载任务"""
+    try:
+        jobs = await get_range_jobs_async(status='running')
     except Exception as e:
-        error_msg = f"❌ 范围下载失败: {str(e)}"
-        try:
-            await rate_limiter.send_message(message.chat.id, error_msg)
-        except:
-            await message.reply(error_msg)
-        print(f"[handle_range_download] error: {e}")
+        print(f"读取范围下载任务失败: {e}")
+        return
+    for job in jobs:
+        if job['job_id'] in range_job_tasks:
+            continue
+        start_range_job(job)
+        print(f"🔄 继续范围下载任务: {job['job_id']}（从消息 {job['cursor'] + 1} 开始）")
+
+async def download_comments(chat_id, msg_id, user_id: int, bot_chat_id: int):
+    """
+    下载消息评论区的全部媒体，作为可续传的后台任务执行
+    
+    Returns:
+        无法开始下载时的提示文本，否则为 None
+    """
+    await ensure_userbot()
+    
+    # 获取原始消息
+    original_message = await get_message(chat_id, msg_id)
+    if not original_message:
+        return "❌ 无法获取原始消息"
+    
+    # 获取评论区（replies）
+    if not original_message.replies:
+        return "ℹ️ 该消息没有评论区或评论为空"
+    
+    job = {
+        'job_id': f"comments_{uuid.uuid4().hex[:12]}",
+        'user_id': user_id,
+        'chat_id': str(chat_id),
+        'bot_chat_id': bot_chat_id,
+        'min_id': 0,
+        'max_id': 0,
+        'cursor': 0,
+        'reply_to': msg_id,
+        'downloaded': 0,
+        'skipped': 0,
+        'failed': 0
+    }
+    await save_range_job_async(job)
+    start_range_job(job)
+    return None
 
 async def handle_link(message: types.Message, fast_mode: bool = False):
     """
@@ -3133,7 +4800,7 @@ async def handle_link(message: types.Message, fast_mode: bool = False):
     
     # 首先检查消息类型
     await ensure_userbot()
-    msg = await userbot.get_messages(chat_id, ids=msg_id)
+    msg = await get_message(chat_id, msg_id)
     if not msg:
         await message.reply('未找到消息')
         return
@@ -3314,13 +4981,11 @@ async def handle_file(message: types.Message):
                 orig_chat_id = message.forward_from_chat.id
                 orig_msg_id = message.forward_from_message_id
                 # 获取原始消息
-                orig_msg = await userbot.get_messages(orig_chat_id, ids=orig_msg_id)
+                orig_msg = await get_message(orig_chat_id, orig_msg_id)
                 if orig_msg and getattr(orig_msg, 'grouped_id', None):
                     orig_grouped_id = orig_msg.grouped_id
                     # 拉取原始相册
-                    all_msgs = await userbot.get_messages(orig_chat_id, limit=50, min_id=orig_msg.id-25, max_id=orig_msg.id+25)
-                    album_msgs = [m for m in all_msgs if getattr(m, 'grouped_id', None) == orig_grouped_id]
-                    album_msgs.sort(key=lambda m: m.id)
+                    album_msgs = await album_cache.get(orig_chat_id, orig_msg)
                     if not album_msgs:
                         await status_msg.edit_text("❌ 无法获取原始相册中的消息，请尝试单独转发每个文件")
                         return
@@ -3396,7 +5061,7 @@ async def handle_file(message: types.Message):
             status_msg = await message.reply("🔍 检测到转发的文件，正在准备下载原始文件...")
             
             # 获取原始消息
-            original_msg = await userbot.get_messages(original_chat_id, ids=original_message_id)
+            original_msg = await get_message(original_chat_id, original_message_id)
             if original_msg and hasattr(original_msg, 'media') and original_msg.media:
                 # 使用新的路径生成逻辑
                 file_path = get_download_path(chat_title, file_name)
@@ -3480,11 +5145,13 @@ async def handle_file(message: types.Message):
                 
                 try:
                     # 用 userbot 下载文件
-                    await download_manager.run(userbot.download_media(
+                    await download_manager.run(transfer_message_media(
+                        original_chat_id,
                         original_msg, 
-                        file=file_path, 
-                        progress_callback=progress_with_task_control
-                    ))
+                        file_path, 
+                        progress_callback=progress_with_task_control,
+                        task=task
+                    ), user_id=user_id, task=task)
                     task.status = "completed"
                     await bot.edit_message_text(
                         chat_id=sent_msg.chat.id, 
@@ -3592,11 +5259,12 @@ async def handle_file(message: types.Message):
         
         try:
             # 用 userbot 下载文件
-            await download_manager.run(userbot.download_media(
+            await download_manager.run(transfer_media(
                 await userbot.get_messages(message.chat.id, ids=message.message_id), 
-                file=file_path, 
-                progress_callback=progress_with_task_control
-            ))
+                file_path, 
+                progress_callback=progress_with_task_control,
+                task=task
+            ), user_id=user_id, task=task)
             task.status = "completed"
             await bot.edit_message_text(
                 chat_id=sent_msg.chat.id, 
@@ -3636,9 +5304,15 @@ def album_status_message(files, album_key=None, _message_id_cache=None):
 
 # ====== web 处理器 ======
 @app.get("/", response_class=HTMLResponse)
-async def index():
-    if not userbot.is_connected():
-        await userbot.connect()
+async def index(account: str = 'main'):
+    # 只查看已有账号；新账号在 /login 登录成功后才会创建
+    if not is_valid_account_name(account):
+        return '<div class="login-box">账号名只能包含字母、数字和下划线（最多32个字符）</div>'
+    if account not in account_pool.accounts:
+        return RedirectResponse(url=f"/login?account={account}", status_code=302)
+    client = account_pool.accounts[account].client
+    if not client.is_connected():
+        await client.connect()
     style = '''<style>
 body { background: #f7f7f7; font-family: Arial, sans-serif; }
 .login-box { background: #fff; max-width: 350px; margin: 60px auto; padding: 32px 28px 24px 28px; border-radius: 10px; box-shadow: 0 2px 16px #0001; }
@@ -3646,23 +5320,32 @@ body { background: #f7f7f7; font-family: Arial, sans-serif; }
 .login-box a.login-btn:hover { background: #0056b3; }
 .success { color: #fff; background: #28a745; border-radius: 5px; padding: 10px; margin-bottom: 18px; text-align: center; }
 </style>'''
-    if not await userbot.is_user_authorized():
-        return style + '''
+    accounts = ''.join(
+        f'<a href="/?account={html.escape(name)}">{html.escape(name)}</a> ' for name in account_pool.accounts
+    )
+    account_list = f'<div style="color:#888;font-size:13px;margin-top:18px;">账号：{accounts}</div>'
+    if not await client.is_user_authorized():
+        return style + f'''
 <div class="login-box">
-  <h2>Telegram Userbot</h2>
-  <a href="/login" class="login-btn">点击登录 Telegram Userbot</a>
+  <h2>Telegram Userbot（{account}）</h2>
+  <a href="/login?account={account}" class="login-btn">点击登录 Telegram Userbot</a>
+  {account_list}
 </div>
 '''
-    return style + '''
+    return style + f'''
 <div class="login-box">
   <div class="success">Userbot 登录成功！</div>
-  <h2>Telegram Userbot</h2>
+  <h2>Telegram Userbot（{account}）</h2>
   <div style="color:#888;font-size:15px;">你已成功登录，可关闭本页面。</div>
+  <div style="color:#888;font-size:13px;margin-top:8px;">添加新账号：打开 /login?account=账号名</div>
+  {account_list}
 </div>
 '''
 
 @app.get("/login", response_class=HTMLResponse)
-async def login_get():
+async def login_get(account: str = 'main'):
+    if not is_valid_account_name(account):
+        return '<div class="login-box">账号名只能包含字母、数字和下划线（最多32个字符）</div>'
     style = '''<style>
 body { background: #f7f7f7; font-family: Arial, sans-serif; }
 .login-box { background: #fff; max-width: 350px; margin: 60px auto; padding: 32px 28px 24px 28px; border-radius: 10px; box-shadow: 0 2px 16px #0001; }
@@ -3671,10 +5354,11 @@ body { background: #f7f7f7; font-family: Arial, sans-serif; }
 .login-box button { width: 100%; background: #007bff; color: #fff; border: none; border-radius: 5px; padding: 10px; font-size: 16px; cursor: pointer; transition: background 0.2s; }
 .login-box button:hover { background: #0056b3; }
 </style>'''
-    return style + '''
+    return style + f'''
 <div class="login-box">
-  <h2>Telegram Userbot 登录</h2>
+  <h2>Telegram Userbot 登录（{account}）</h2>
   <form action="/login" method="post">
+    <input name="account" value="{account}" hidden>
     <input name="phone" placeholder="手机号"><br>
     <button type="submit">发送验证码</button>
   </form>
@@ -3682,11 +5366,15 @@ body { background: #f7f7f7; font-family: Arial, sans-serif; }
 '''
 
 @app.post("/login", response_class=HTMLResponse)
-async def login_post(phone: str = Form(...)):
-    if not userbot.is_connected():
-        await userbot.connect()
-    if await userbot.is_user_authorized():
-        return RedirectResponse(url="/")
+async def login_post(phone: str = Form(...), account: str = Form('main')):
+    try:
+        client = await account_pool.get_login_client(account)
+    except ValueError as e:
+        return f'<div class="login-box">{e}</div>'
+    if not client.is_connected():
+        await client.connect()
+    if await client.is_user_authorized():
+        return RedirectResponse(url=f"/?account={account}", status_code=302)
     style = '''<style>
 body { background: #f7f7f7; font-family: Arial, sans-serif; }
 .login-box { background: #fff; max-width: 350px; margin: 60px auto; padding: 32px 28px 24px 28px; border-radius: 10px; box-shadow: 0 2px 16px #0001; }
@@ -3696,13 +5384,15 @@ body { background: #f7f7f7; font-family: Arial, sans-serif; }
 .login-box button:hover { background: #0056b3; }
 </style>'''
     try:
-        await userbot.send_code_request(phone)
+        await client.send_code_request(phone)
     except Exception as e:
-        return style + f'<div class="login-box">发送验证码失败: {e}</div>'
+        return style + f'<div class="login-box">发送验证码失败: {html.escape(str(e))}</div>'
+    phone = html.escape(phone)
     return style + f'''
 <div class="login-box">
   <h2>输入验证码</h2>
   <form action="/login2" method="post">
+    <input name="account" value="{account}" hidden>
     <input name="phone" value="{phone}" hidden>
     <div style="color:#888;font-size:14px;margin-bottom:8px;">手机号：{phone}</div>
     <input name="code" placeholder="验证码"><br>
@@ -3713,8 +5403,14 @@ body { background: #f7f7f7; font-family: Arial, sans-serif; }
 
 @app.post("/login2", response_class=HTMLResponse)
 async def login2(request: Request):
-    if not userbot.is_connected():
-        await userbot.connect()
+    form = await request.form()
+    account = form.get('account', 'main')
+    try:
+        client = await account_pool.get_login_client(account)
+    except ValueError as e:
+        return f'<div class="login-box">{e}</div>'
+    if not client.is_connected():
+        await client.connect()
     style = '''<style>
 body { background: #f7f7f7; font-family: Arial, sans-serif; }
 .login-box { background: #fff; max-width: 350px; margin: 60px auto; padding: 32px 28px 24px 28px; border-radius: 10px; box-shadow: 0 2px 16px #0001; }
@@ -3723,21 +5419,20 @@ body { background: #f7f7f7; font-family: Arial, sans-serif; }
 .login-box button { width: 100%; background: #007bff; color: #fff; border: none; border-radius: 5px; padding: 10px; font-size: 16px; cursor: pointer; transition: background 0.2s; }
 .login-box button:hover { background: #0056b3; }
 </style>'''
-    form = await request.form()
     phone = form['phone']
     code = form['code']
     password = form.get('password', None)
     try:
-        if not await userbot.is_user_authorized():
+        if not await client.is_user_authorized():
             try:
                 if not password:
                     # 第一步：尝试用验证码登录
-                    await userbot.sign_in(phone=phone, code=code)
-                    return RedirectResponse(url="/", status_code=302)
+                    await client.sign_in(phone=phone, code=code)
                 else:
                     # 第二步：用密码登录
-                    await userbot.sign_in(password=password)
-                    return RedirectResponse(url="/", status_code=302)
+                    await client.sign_in(password=password)
+                await account_pool.finish_login(account)
+                return RedirectResponse(url=f"/?account={account}", status_code=302)
             except Exception as e:
                 if 'SESSION_PASSWORD_NEEDED' in str(e) or 'password is required' in str(e):
                     # 需要二步验证密码，提示用户输入
@@ -3745,8 +5440,9 @@ body { background: #f7f7f7; font-family: Arial, sans-serif; }
 <div class="login-box">
   <h2>二步验证</h2>
   <form action="/login2" method="post">
-    <input name="phone" value="{phone}" hidden>
-    <input name="code" value="{code}" hidden>
+    <input name="account" value="{account}" hidden>
+    <input name="phone" value="{html.escape(phone)}" hidden>
+    <input name="code" value="{html.escape(code)}" hidden>
     <input name="password" placeholder="二步验证密码"><br>
     <button type="submit">提交</button>
   </form>
@@ -3754,9 +5450,10 @@ body { background: #f7f7f7; font-family: Arial, sans-serif; }
 '''
                 else:
                     raise e
-        return RedirectResponse(url="/", status_code=302)
+        await account_pool.finish_login(account)
+        return RedirectResponse(url=f"/?account={account}", status_code=302)
     except Exception as e:
-        return style + f'<div class="login-box">登录失败: {e}</div>'
+        return style + f'<div class="login-box">登录失败: {html.escape(str(e))}</div>'
 
 # ====== 回调处理辅助函数 ======
 async def handle_pending_tasks_callback(callback_query: types.CallbackQuery, data: str, user_id: int):
@@ -3841,6 +5538,7 @@ async def handle_pending_tasks_callback(callback_query: types.CallbackQuery, dat
             task_details = []
             for task in user_tasks[:10]:  # 最多显示10个
                 status_emoji = {
+                    'queued': '⏳',
                     'running': '⏬',
                     'paused': '⏸️',
                     'completed': '✅',
@@ -3900,7 +5598,7 @@ async def handle_download_callback(callback_query: types.CallbackQuery, data: st
             
             # 获取消息
             await ensure_userbot()
-            msg = await userbot.get_messages(chat_id, ids=msg_id)
+            msg = await get_message(chat_id, msg_id)
             if not msg:
                 await callback_query.message.edit_text("❌ 未找到消息")
                 return
@@ -3967,7 +5665,7 @@ async def handle_download_callback(callback_query: types.CallbackQuery, data: st
             
             # 检查是否是相册
             await ensure_userbot()
-            msg = await userbot.get_messages(chat_id, ids=msg_id)
+            msg = await get_message(chat_id, msg_id)
             
             if msg and msg.grouped_id:
                 # 相册下载
@@ -4025,7 +5723,7 @@ async def handle_download_callback(callback_query: types.CallbackQuery, data: st
             
             # 检查是否是相册
             await ensure_userbot()
-            msg = await userbot.get_messages(chat_id, ids=msg_id)
+            msg = await get_message(chat_id, msg_id)
             
             if msg and msg.grouped_id:
                 # 相册下载
@@ -4077,72 +5775,9 @@ async def handle_download_callback(callback_query: types.CallbackQuery, data: st
             await callback_query.message.edit_text("⏳ 正在获取评论区...")
             
             try:
-                await ensure_userbot()
-                
-                # 获取原始消息
-                original_message = await userbot.get_messages(chat_id, ids=msg_id)
-                if not original_message:
-                    await callback_query.message.edit_text("❌ 无法获取原始消息")
-                    return
-                
-                # 获取评论区（replies）
-                if not original_message.replies:
-                    await callback_query.message.edit_text("ℹ️ 该消息没有评论区或评论为空")
-                    return
-                
-                # 获取所有评论
-                replies = await userbot.get_messages(
-                    chat_id, 
-                    reply_to=msg_id,
-                    limit=100
-                )
-                
-                if not replies:
-                    await callback_query.message.edit_text("ℹ️ 评论区没有媒体文件")
-                    return
-                
-                # 筛选包含媒体的评论
-                media_messages = [r for r in replies if r.media or r.grouped_id]
-                
-                if not media_messages:
-                    await callback_query.message.edit_text("ℹ️ 评论区没有媒体文件")
-                    return
-                
-                await callback_query.message.edit_text(
-                    f"📥 找到 {len(media_messages)} 条包含媒体的评论，开始下载..."
-                )
-                
-                # 下载所有媒体
-                downloaded_count = 0
-                for reply_msg in media_messages:
-                    try:
-                        if reply_msg.grouped_id:
-                            # 相册
-                            await download_album(
-                                chat_id,
-                                reply_msg.id,
-                                bot_chat_id=callback_query.message.chat.id,
-                                user_id=user_id,
-                                progress_callback=None
-                            )
-                        else:
-                            # 单文件
-                            await download_single_file(
-                                chat_id,
-                                reply_msg.id,
-                                bot_chat_id=callback_query.message.chat.id,
-                                user_id=user_id,
-                                progress_callback=None
-                            )
-                        downloaded_count += 1
-                    except Exception as e:
-                        print(f"下载评论媒体失败: {e}")
-                        continue
-                
-                await callback_query.message.edit_text(
-                    f"✅ 评论区下载完成！成功下载 {downloaded_count}/{len(media_messages)} 个文件"
-                )
-                
+                error_text = await download_comments(chat_id, msg_id, user_id, callback_query.message.chat.id)
+                if error_text:
+                    await callback_query.message.edit_text(error_text)
             except Exception as e:
                 await callback_query.message.edit_text(
                     f"❌ 获取评论区失败: {str(e)}"
@@ -4180,6 +5815,14 @@ async def handle_callback_query(callback_query: types.CallbackQuery):
             await handle_download_callback(callback_query, data, user_id)
             return
         
+        # 任务历史翻页
+        if data.startswith("dl_history_"):
+            created_at, _, task_id = data[len("dl_history_"):].partition("|")
+            text, keyboard = await build_download_history(user_id, before=(created_at, task_id))
+            await callback_query.answer()
+            await callback_query.message.edit_text(text, reply_markup=keyboard)
+            return
+        
         # 处理强制重下载回调
         if data.startswith("force_redownload_"):
             task_id = data.replace("force_redownload_", "")
@@ -4384,6 +6027,9 @@ async def handle_all(message: types.Message):
         if message.text == "/resetsettings":
             await cmd_reset_settings(message)
             return
+        if message.text == "/reloadsettings":
+            await cmd_reload_settings(message)
+            return
         if message.text.startswith("/auto"):
             await cmd_auto(message)
             return
@@ -4393,6 +6039,18 @@ async def handle_all(message: types.Message):
         if message.text.startswith("/setrefresh "):
             await set_refresh_cmd(message)
             return
+        if message.text.startswith("/setretention "):
+            await set_retention_cmd(message)
+            return
+        if message.text.startswith("/setparallel "):
+            await set_parallel_cmd(message)
+            return
+        if message.text.startswith("/setspeed "):
+            await set_speed_cmd(message)
+            return
+        if message.text == "/accounts":
+            await cmd_accounts(message)
+            return
         if message.text.startswith("/classification "):
             await cmd_classification(message)
             return
@@ -4400,7 +6058,7 @@ async def handle_all(message: types.Message):
             await cmd_check_download(message)
             return
         # 下载控制命令
-        if message.text == "/downloads":
+        if message.text == "/downloads" or message.text.startswith("/downloads "):
             await cmd_list_downloads(message)
             return
         if message.text.startswith("/pause"):
@@ -4484,12 +6142,90 @@ async def ensure_userbot():
     if not await userbot.is_user_authorized():
         raise Exception("Userbot 未登录，请先在 Web 登录 userbot")
 
+# ====== 实体缓存 ======
+ENTITY_CACHE_TTL = 24 * 3600  # 实体信息的刷新周期（秒）
+
+class EntityCache:
+    """
+    频道/群组实体缓存：用户名或 ID -> 实体 ID、peer ID、access hash、标题
+    
+    内存中保存一份并持久化到数据库，过期后重新 get_entity；
+    公开频道的用户名解析（ResolveUsername）限流严格，范围和相册任务只需解析一次
+    """
+    def __init__(self, ttl: float = ENTITY_CACHE_TTL):
+        self.ttl = ttl
+        self.entries = {}  # key -> 实体信息
+        self.pending = {}  # 正在解析的 key -> Future
+    
+    @staticmethod
+    def _key(chat_id) -> str:
+        return str(chat_id).strip().lstrip('@').lower()
+    
+    async def _lookup(self, key: str):
+        info = self.entries.get(key)
+        if info is None:
+            try:
+                info = await get_cached_entity_async(key)
+            except Exception:
+                info = None
+            if info:
+                self.entries[key] = info
+        return info
+    
+    async def _resolve(self, chat_id) -> dict:
+        await ensure_userbot()
+        entity = await userbot.get_entity(chat_id)
+        info = {
+            'entity_id': entity.id,
+            'peer_id': tl_utils.get_peer_id(entity),
+            'peer_type': type(entity).__name__,
+            'access_hash': getattr(entity, 'access_hash', None),
+            'title': getattr(entity, 'title', None),
+            'username': getattr(entity, 'username', None),
+            'updated_at': time.time()
+        }
+        keys = {self._key(chat_id), str(info['peer_id'])}
+        if info['username']:
+            keys.add(self._key(info['username']))
+        for key in keys:
+            self.entries[key] = info
+        async_db.submit_write(save_cached_entity, list(keys), info)
+        return info
+    
+    async def get(self, chat_id) -> dict:
+        """获取实体信息，过期时重新解析；解析失败时退回到过期的缓存，没有缓存则抛出异常"""
+        key = self._key(chat_id)
+        info = await self._lookup(key)
+        if info and time.time() - info['updated_at'] < self.ttl:
+            return info
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key])
+        
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        try:
+            try:
+                result = await self._resolve(chat_id)
+            except Exception:
+                if not info:
+                    raise
+                result = info
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self.pending[key]
+
+entity_cache = EntityCache()
+
 async def get_chat_folder(chat_id):
     """获取频道/群组的基础文件夹路径（兼容旧版本）"""
-    await ensure_userbot()
     try:
-        entity = await userbot.get_entity(chat_id)
-        name = entity.title if hasattr(entity, 'title') else str(chat_id)
+        info = await entity_cache.get(chat_id)
+        name = info['title'] or str(chat_id)
     except Exception:
         name = None
     
@@ -4504,17 +6240,980 @@ async def get_chat_folder(chat_id):
 
 async def get_chat_info(chat_id):
     """获取频道/群组信息"""
-    await ensure_userbot()
     try:
-        entity = await userbot.get_entity(chat_id)
-        return entity.title if hasattr(entity, 'title') else None
+        info = await entity_cache.get(chat_id)
+        return info['title']
     except Exception:
         return None
 
-async def download_single_file(chat_id, msg_id, download_path=None, progress_callback=None, bot_chat_id=None, user_id=None, force_redownload=False, skip_existing=True):
-    """下载单个文件（非相册）"""
+# ====== 多连接并行下载引擎 ======
+import inspect
+from telethon import utils as tl_utils
+from telethon.network import MTProtoSender
+from telethon.tl.alltlobjects import LAYER
+from telethon.tl.functions import InvokeWithLayerRequest, PingRequest
+from telethon.tl.functions.auth import ExportAuthorizationRequest, ImportAuthorizationRequest
+from telethon.tl.functions.upload import GetFileRequest
+from telethon.tl.types import InputPhotoFileLocation, PhotoSize, PhotoSizeProgressive
+import random
+
+# 每个分片的大小：GetFile 要求 offset/limit 按 4KB 对齐，且 limit 能整除 1MB
+PARALLEL_PART_SIZE = 512 * 1024
+# 断点记录的最小写入间隔（秒）
+RESUME_CHECKPOINT_INTERVAL = 1.0
+
+def get_partial_paths(file_path: str) -> tuple[str, str]:
+    """
+    获取下载中间文件路径
+    
+    Returns:
+        (.part 数据文件, .resume 断点记录)，均为隐藏文件，不会被按消息ID前缀的检查匹配到
+    """
+    folder, base_name = os.path.split(file_path)
+    return os.path.join(folder, f".{base_name}.part"), os.path.join(folder, f".{base_name}.resume")
+
+def write_resume_state(file_path: str, offset: int, file_size: int):
+    """记录已连续写入并落盘的字节偏移"""
+    _, state_path = get_partial_paths(file_path)
+    with open(state_path, 'w', encoding='utf-8') as f:
+        json.dump({'offset': offset, 'size': file_size}, f)
+
+def read_resume_offset(file_path: str, expected_size: int) -> int:
+    """读取可续传的起始偏移，记录缺失或与文件大小不符时返回 0"""
+    part_path, state_path = get_partial_paths(file_path)
+    try:
+        if not os.path.exists(part_path) or not os.path.exists(state_path):
+            return 0
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('size') != expected_size:
+            return 0
+        offset = min(int(state.get('offset', 0)), os.path.getsize(part_path))
+        return offset - offset % PARALLEL_PART_SIZE
+    except Exception as e:
+        print(f"[resume] 读取断点记录失败 {state_path}: {e}")
+        return 0
+
+def prepare_resume(file_path: str, expected_size: int) -> int:
+    """
+    准备断点续传，返回本次下载的起始偏移
+    
+    旧版 download_media 留在目标路径的不完整文件是顺序写入的，
+    对齐到分片边界之前的数据都有效，转为 .part 后从该偏移继续
+    """
+    offset = read_resume_offset(file_path, expected_size)
+    if offset == 0 and expected_size > 0 and os.path.isfile(file_path):
+        local_size = os.path.getsize(file_path)
+        if 0 < local_size < expected_size:
+            part_path, _ = get_partial_paths(file_path)
+            offset = local_size - local_size % PARALLEL_PART_SIZE
+            os.replace(file_path, part_path)
+            write_resume_state(file_path, offset, expected_size)
+            file_index.remove(file_path)
+            file_index.add_partial(file_path)
+    return offset
+
+def discard_partial_download(file_path: str):
+    """删除未完成下载的中间文件"""
+    for path in get_partial_paths(file_path):
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except Exception as e:
+            print(f"[resume] 删除中间文件失败 {path}: {e}")
+    file_index.remove_partial(file_path)
+
+def remove_download_file(file_path: str):
+    """删除文件及其未完成下载的中间文件"""
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    file_index.remove(file_path)
+    discard_partial_download(file_path)
+
+def relocate_download(src_path: str, dst_path: str):
+    """把已下载（或下载中）的文件连同断点记录移动到新路径"""
+    if src_path == dst_path:
+        return
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    if os.path.exists(src_path):
+        os.replace(src_path, dst_path)
+        file_index.remove(src_path)
+        file_index.add(dst_path)
+        async_db.submit_write(move_stored_media, src_path, dst_path)
+    part_path, _ = get_partial_paths(src_path)
+    if os.path.exists(part_path):
+        file_index.remove_partial(src_path)
+        file_index.add_partial(dst_path)
+    for src, dst in zip(get_partial_paths(src_path), get_partial_paths(dst_path)):
+        if os.path.exists(src):
+            os.replace(src, dst)
+
+# 连接池空闲连接的健康检查间隔（秒）
+SENDER_POOL_HEALTH_INTERVAL = 60
+
+class SenderPool:
+    """
+    按数据中心维护的已授权连接池
+    
+    下载时借出连接、完成后归还，避免每个文件都重新导出授权和握手；
+    每个 DC 保留的空闲连接数与并行下载连接数一致，空闲连接定期 ping 检查
+    """
+    def __init__(self, client: TelegramClient):
+        self.client = client
+        self.idle = {}  # dc_id -> [MTProtoSender]
+        self.auth_keys = {}  # dc_id -> 导出授权后得到的 AuthKey
+        self.auth_lock = asyncio.Lock()
+        self.health_task = None
+    
+    def get_pool_size(self) -> int:
+        return max(1, get_parallel_connections())
+    
+    async def _create_sender(self, dc_id: int) -> MTProtoSender:
+        """创建一个到目标 DC 的已授权连接"""
+        dc = await self.client._get_dc(dc_id)
+        # 与会话同 DC 时直接复用会话的授权密钥，否则使用（或导出）该 DC 的授权
+        if dc_id == self.client.session.dc_id:
+            auth_key = self.client.session.auth_key
+        else:
+            auth_key = self.auth_keys.get(dc_id)
+        sender = MTProtoSender(auth_key, loggers=self.client._log)
+        await sender.connect(self.client._connection(
+            dc.ip_address, dc.port, dc.id,
+            loggers=self.client._log,
+            proxy=self.client._proxy
+        ))
+        if not auth_key:
+            # _init_request 是共享对象，导出/导入授权需要串行
+            async with self.auth_lock:
+                auth = await self.client(ExportAuthorizationRequest(dc_id))
+                self.client._init_request.query = ImportAuthorizationRequest(id=auth.id, bytes=auth.bytes)
+                await sender.send(InvokeWithLayerRequest(LAYER, self.client._init_request))
+            self.auth_keys[dc_id] = sender.auth_key
+        return sender
+    
+    async def _create_senders(self, dc_id: int, count: int) -> list:
+        """创建多个连接，部分失败时返回成功的部分"""
+        senders = []
+        if count <= 0:
+            return senders
+        if dc_id != self.client.session.dc_id and dc_id not in self.auth_keys:
+            # 第一个连接负责导出授权，其余连接复用同一授权密钥并发建立
+            senders.append(await self._create_sender(dc_id))
+            count -= 1
+        results = await asyncio.gather(*[self._create_sender(dc_id) for _ in range(count)], return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                print(f"[SenderPool] 创建 DC {dc_id} 连接失败: {result}")
+            else:
+                senders.append(result)
+        if not senders and results:
+            raise results[0]
+        return senders
+    
+    async def _disconnect(self, sender: MTProtoSender):
+        try:
+            await sender.disconnect()
+        except Exception as e:
+            print(f"[SenderPool] 关闭连接失败: {e}")
+    
+    async def acquire(self, dc_id: int, count: int) -> list:
+        """借出最多 count 个到 dc_id 的连接（至少 1 个），空闲不足时新建"""
+        # 启动时 userbot 未登录的情况下，首次借出时再启动健康检查
+        self.start()
+        idle = self.idle.setdefault(dc_id, [])
+        senders = []
+        while idle and len(senders) < count:
+            sender = idle.pop()
+            if sender.is_connected():
+                senders.append(sender)
+            else:
+                await self._disconnect(sender)
+        if len(senders) < count:
+            try:
+                senders.extend(await self._create_senders(dc_id, count - len(senders)))
+            except Exception:
+                if not senders:
+                    raise
+            try:
+                add_sender_pool_dc(dc_id)
+            except Exception as e:
+                print(f"[SenderPool] 记录 DC 失败: {e}")
+        return senders
+    
+    async def release(self, dc_id: int, senders: list, discard: bool = False):
+        """归还连接，超出池大小或已断开的连接直接关闭"""
+        idle = self.idle.setdefault(dc_id, [])
+        for sender in senders:
+            if not discard and sender.is_connected() and len(idle) < self.get_pool_size():
+                idle.append(sender)
+            else:
+                await self._disconnect(sender)
+    
+    async def _fill(self, dc_id: int):
+        """把 dc_id 的空闲连接补足到池大小"""
+        idle = self.idle.setdefault(dc_id, [])
+        missing = self.get_pool_size() - len(idle)
+        if missing > 0:
+            await self.release(dc_id, await self._create_senders(dc_id, missing))
+    
+    async def warm_up(self):
+        """预热会话所在 DC 和之前用过的媒体 DC"""
+        dc_ids = [self.client.session.dc_id] + sorted(get_sender_pool_dcs())
+        for dc_id in dict.fromkeys(dc_ids):
+            try:
+                await self._fill(dc_id)
+                print(f"✅ DC {dc_id} 连接池已预热: {len(self.idle[dc_id])} 个连接")
+            except Exception as e:
+                print(f"[SenderPool] DC {dc_id} 预热失败: {e}")
+    
+    async def _ping(self, sender: MTProtoSender) -> bool:
+        try:
+            await asyncio.wait_for(sender.send(PingRequest(ping_id=random.randrange(1 << 62))), timeout=10)
+            return True
+        except Exception:
+            await self._disconnect(sender)
+            return False
+    
+    async def check_health(self):
+        """ping 所有空闲连接，剔除失效的并补足"""
+        for dc_id in list(self.idle.keys()):
+            senders, self.idle[dc_id] = self.idle[dc_id], []
+            results = await asyncio.gather(*[self._ping(sender) for sender in senders])
+            healthy = [sender for sender, ok in zip(senders, results) if ok]
+            if len(healthy) < len(senders):
+                print(f"[SenderPool] DC {dc_id} 剔除 {len(senders) - len(healthy)} 个失效连接")
+            await self.release(dc_id, healthy)
+            try:
+                await self._fill(dc_id)
+            except Exception as e:
+                print(f"[SenderPool] DC {dc_id} 补充连接失败: {e}")
+    
+    async def health_check_loop(self):
+        while True:
+            await asyncio.sleep(SENDER_POOL_HEALTH_INTERVAL)
+            try:
+                if self.client.is_connected():
+                    await self.check_health()
+            except Exception as e:
+                print(f"[SenderPool] 健康检查失败: {e}")
+    
+    def start(self):
+        """启动后台健康检查"""
+        if not self.health_task:
+            self.health_task = asyncio.create_task(self.health_check_loop())
+
+sender_pool = SenderPool(userbot)
+
+class ParallelDownloader:
+    """
+    多连接分片下载器
+    
+    把文件按 PARALLEL_PART_SIZE 切成字节区间，通过从连接池借出的多个到媒体 DC 的连接并发拉取，
+    每个分片按偏移直接写入目标文件
+    """
+    def __init__(self, pool: SenderPool, dc_id: int, location, file_size: int, connections: int):
+        self.pool = pool
+        self.dc_id = dc_id
+        self.location = location
+        self.file_size = file_size
+        self.connections = max(1, connections)
+        self.senders = []
+    
+    async def _init_senders(self, count: int):
+        self.senders = await self.pool.acquire(self.dc_id, count)
+    
+    async def _close_senders(self, discard: bool = False):
+        await self.pool.release(self.dc_id, self.senders, discard=discard)
+        self.senders = []
+    
+    async def download(self, file_path: str, progress_callback=None, start_offset: int = 0, on_checkpoint=None, throttle=None) -> str:
+        """
+        下载到 file_path，返回保存路径
+        
+        start_offset: 续传起始偏移（需按分片对齐），之前的数据视为已写入
+        on_checkpoint: 连续写入水位前进时回调 on_checkpoint(offset)，用于持久化断点
+        throttle: 每收到一个分片后调用 await throttle(字节数)，用于带宽限制
+        """
+        offsets = list(range(start_offset, self.file_size, PARALLEL_PART_SIZE))
+        next_part = iter(offsets)
+        downloaded = start_offset
+        # 各 worker 乱序完成分片，只有连续完成的前缀才是可续传的水位
+        completed = set()
+        watermark = start_offset
+        last_checkpoint = time.time()
+        
+        folder = os.path.dirname(file_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        
+        async def worker(sender, f):
+            nonlocal downloaded, watermark, last_checkpoint
+            for offset in next_part:
+                result = await sender.send(GetFileRequest(self.location, offset=offset, limit=PARALLEL_PART_SIZE))
+                # seek 与 write 之间没有 await，多个 worker 共用一个文件句柄是安全的
+                f.seek(offset)
+                f.write(result.bytes)
+                downloaded += len(result.bytes)
+                download_manager.record_transfer(len(result.bytes))
+                if throttle:
+                    await throttle(len(result.bytes))
+                
+                completed.add(offset)
+                while watermark in completed:
+                    completed.remove(watermark)
+                    watermark += PARALLEL_PART_SIZE
+                now = time.time()
+                if on_checkpoint and now - last_checkpoint >= RESUME_CHECKPOINT_INTERVAL:
+                    # 先落盘数据再记录水位，保证记录的偏移之前的数据一定已写入
+                    f.flush()
+                    on_checkpoint(min(watermark, self.file_size))
+                    last_checkpoint = now
+                
+                if progress_callback:
+                    r = progress_callback(min(downloaded, self.file_size), self.file_size)
+                    if inspect.isawaitable(r):
+                        await r
+        
+        resuming = start_offset > 0 and os.path.exists(file_path)
+        if not offsets:
+            # 断点已到文件末尾，无需再建立连接
+            open(file_path, 'r+b' if resuming else 'wb').close()
+            return file_path
+        
+        await self._init_senders(min(self.connections, len(offsets)))
+        failed = False
+        try:
+            with open(file_path, 'r+b' if resuming else 'wb') as f:
+                if resuming:
+                    # 丢弃水位之后可能不完整的数据
+                    f.truncate(start_offset)
+                workers = [asyncio.create_task(worker(sender, f)) for sender in self.senders]
+                try:
+                    await asyncio.gather(*workers)
+                except BaseException:
+                    failed = True
+                    for w in workers:
+                        w.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
+                    if on_checkpoint:
+                        f.flush()
+                        on_checkpoint(min(watermark, self.file_size))
+                    raise
+        finally:
+            # 出错时连接状态未知（可能有未完成的请求），不放回池中
+            await self._close_senders(discard=failed)
+        return file_path
+
+def get_media_location(msg):
+    """
+    获取消息媒体的文件位置，用于按偏移分片拉取
+    
+    Returns:
+        (dc_id, InputFileLocation, 文件大小)，不支持的媒体返回 None
+    """
+    media = getattr(msg, 'media', None)
+    if isinstance(media, MessageMediaDocument) and media.document:
+        dc_id, location = tl_utils.get_input_location(media.document)
+        return dc_id, location, media.document.size
+    if isinstance(media, MessageMediaPhoto) and media.photo:
+        # 与 download_media 一致，下载字节数最大的尺寸；内联的缩略图没有独立文件
+        photo = media.photo
+        sizes = [size for size in photo.sizes if isinstance(size, (PhotoSize, PhotoSizeProgressive))]
+        if not sizes:
+            return None
+        byte_count = lambda size: size.size if isinstance(size, PhotoSize) else max(size.sizes)
+        largest = max(sizes, key=byte_count)
+        location = InputPhotoFileLocation(
+            id=photo.id,
+            access_hash=photo.access_hash,
+            file_reference=photo.file_reference,
+            thumb_size=largest.type
+        )
+        return photo.dc_id, location, byte_count(largest)
+    return None
+
+def should_use_parallel_engine(msg) -> bool:
+    """判断消息是否走多连接并行下载：按设置的连接数和大小阈值自动选择"""
+    # 图片体积小，只用单连接
+    if not isinstance(getattr(msg, 'media', None), MessageMediaDocument):
+        return False
+    if get_parallel_connections() <= 1:
+        return False
+    file_size = msg.file.size if getattr(msg, 'file', None) else 0
+    return file_size >= get_parallel_threshold()
+
+async def parallel_download_media(pool: SenderPool, media_location: tuple, file_path: str, progress_callback=None, connections: int = None, start_offset: int = 0, throttle=None) -> str:
+    """
+    使用分片引擎下载文件
+    
+    media_location: get_media_location 的返回值
+    start_offset: 从 .part 文件的该偏移继续下载（断点续传）
+    throttle: 带宽限制函数，见 BandwidthLimiter.get_throttle
+    """
+    dc_id, location, file_size = media_location
+    downloader = ParallelDownloader(
+        pool, dc_id, location, file_size,
+        connections or get_parallel_connections()
+    )
+    
+    # 先写入隐藏的 .part 文件，完成后再改名，避免中断的文件被当成已下载
+    part_path, state_path = get_partial_paths(file_path)
+    base_name = os.path.basename(file_path)
+    if start_offset:
+        print(f"[parallel_download] 从断点续传: {base_name} ({start_offset}/{file_size} bytes)")
+    print(f"[parallel_download] 开始下载: {base_name} ({file_size} bytes, {downloader.connections} 个连接, DC {dc_id})")
+    file_index.add_partial(file_path)
+    await downloader.download(
+        part_path,
+        progress_callback=progress_callback,
+        start_offset=start_offset,
+        on_checkpoint=lambda offset: write_resume_state(file_path, offset, file_size),
+        throttle=throttle
+    )
+    os.replace(part_path, file_path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    file_index.add(file_path)
+    return file_path
+
+# ====== 去重存储 ======
+import shutil
+
+def get_media_key(msg, media_location: tuple):
+    """按 Telegram 文件 ID 和大小生成去重键，同一文件在不同频道转发时 ID 相同"""
+    media = msg.media
+    if isinstance(media, MessageMediaDocument):
+        return f"document:{media.document.id}:{media_location[2]}"
+    return f"photo:{media.photo.id}:{media_location[2]}"
+
+async def restore_from_store(media_key: str, file_path: str) -> bool:
+    """
+    已下载过同一文件时直接硬链接（跨设备时复制）到 file_path，不再走网络
+    
+    Returns:
+        是否已从存储中还原
+    """
+    stored = await get_stored_media_async(media_key)
+    if not stored:
+        return False
+    src_path, size = stored
+    if src_path == file_path:
+        return os.path.exists(file_path) and os.path.getsize(file_path) == size
+    if not os.path.isfile(src_path) or os.path.getsize(src_path) != size:
+        # 原文件已被删除或改动
+        await delete_stored_media_async(media_key)
+        return False
+    
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+        file_index.remove(file_path)
+    try:
+        os.link(src_path, file_path)
+    except OSError:
+        # 不同文件系统无法硬链接，先复制到 .part 再改名，避免中断留下不完整的文件
+        part_path, _ = get_partial_paths(file_path)
+        await asyncio.to_thread(shutil.copyfile, src_path, part_path)
+        os.replace(part_path, file_path)
+    discard_partial_download(file_path)
+    file_index.add(file_path)
+    print(f"[media_store] 复用已下载的文件: {src_path} -> {file_path}")
+    return True
+
+async def transfer_media(msg, file_path: str, progress_callback=None, task: 'DownloadTask' = None, resume: bool = True, account: 'UserbotAccount' = None) -> str:
+    """
+    所有下载路径共用的传输入口：通过连接池分片下载，大文件使用多连接并行
+    
+    task: 可选，记录本次使用的下载引擎
+    resume: 是否从已下载的部分继续；为 False 时丢弃之前的未完成数据
+    account: 执行下载的 userbot 账号，msg 必须由该账号获取，默认主账号
+    """
+    account = account or account_pool.primary
+    throttle = bandwidth_limiter.get_throttle(task)
+    media_location = get_media_location(msg)
+    if not media_location:
+        # 无法按偏移拉取的媒体交给 Telethon 处理，在进度回调里限速
+        if task:
+            task.engine = "default"
+        last_current = 0
+        
+        async def throttled_progress(current, total):
+            nonlocal last_current
+            delta = max(0, current - last_current)
+            # 计入吞吐量统计，供并发数自动调节使用
+            download_manager.record_transfer(delta)
+            await throttle(delta)
+            last_current = current
+            if progress_callback:
+                r = progress_callback(current, total)
+                if inspect.isawaitable(r):
+                    await r
+        result = await account.client.download_media(msg, file=file_path, progress_callback=throttled_progress)
+        if result:
+            file_index.add(result)
+        return result
+    
+    media_key = get_media_key(msg, media_location)
+    if resume:
+        # 强制重下时不复用已有文件
+        try:
+            restored = await restore_from_store(media_key, file_path)
+        except Exception as e:
+            print(f"[media_store] 复用已下载文件失败，改为重新下载: {e}")
+            restored = False
+        if restored:
+            if task:
+                task.engine = "dedup"
+            return file_path
+        start_offset = prepare_resume(file_path, media_location[2])
+    else:
+        start_offset = 0
+        discard_partial_download(file_path)
+    
+    use_parallel = should_use_parallel_engine(msg)
+    if task:
+        task.engine = "parallel" if use_parallel else ("resume" if start_offset else "default")
+    result = await parallel_download_media(
+        account.sender_pool, media_location, file_path,
+        progress_callback=progress_callback,
+        connections=None if use_parallel else 1,
+        start_offset=start_offset,
+        throttle=throttle
+    )
+    async_db.submit_write(save_stored_media, media_key, file_path, media_location[2])
+    return result
+
+# ====== 多账号 userbot 池 ======
+from telethon.errors import FloodWaitError, FileReferenceExpiredError
+from telethon.errors import (
+    ChannelInvalidError, ChannelPrivateError, ChatAdminRequiredError, ChatForbiddenError,
+    PeerIdInvalidError, UserBannedInChannelError
+)
+from telethon.sessions import SQLiteSession, StringSession
+
+ACCOUNT_NAME_PATTERN = re.compile(r'[A-Za-z0-9_]{1,32}')
+MAX_PENDING_LOGINS = 5  # 同时进行中的网页登录数上限，超出时丢弃最早的
+CHAT_ACCESS_DENIED_TTL = 600  # 无权访问频道的结果缓存时间（秒），加入频道后可重新分配
+# 表示账号确实无权访问频道的错误；get_entity 找不到实体时抛出 ValueError
+CHAT_ACCESS_ERRORS = (
+    ChannelInvalidError, ChannelPrivateError, ChatAdminRequiredError, ChatForbiddenError,
+    PeerIdInvalidError, UserBannedInChannelError, ValueError
+)
+
+def is_valid_account_name(name: str) -> bool:
+    return isinstance(name, str) and ACCOUNT_NAME_PATTERN.fullmatch(name) is not None
+
+class UserbotAccount:
+    """一个 userbot 会话及其负载状态"""
+    def __init__(self, name: str, client: TelegramClient, pool: SenderPool = None):
+        self.name = name
+        self.client = client
+        self.sender_pool = pool or SenderPool(client)
+        self.active = 0  # 正在执行的操作数
+        self.flood_until = 0  # FloodWait 结束时间
+        self.chat_access = {}  # str(chat_id) -> 已确认可以访问该频道
+        self.chat_denied = {}  # str(chat_id) -> 无权访问的缓存过期时间
+    
+    def is_flood_waiting(self) -> bool:
+        return time.time() < self.flood_until
+    
+    async def is_ready(self) -> bool:
+        """连接并确认账号已登录"""
+        try:
+            if not self.client.is_connected():
+                await self.client.connect()
+            return await self.client.is_user_authorized()
+        except Exception as e:
+            print(f"[AccountPool] 账号 {self.name} 连接失败: {e}")
+            return False
+
+class AccountPool:
+    """
+    多账号 userbot 池
+    
+    下载按频道可访问性和当前负载分配到不同账号，
+    某个账号遇到 FloodWait 时在冷却结束前不再分配，并切换到其他账号重试
+    """
+    def __init__(self, primary_client: TelegramClient, primary_pool: SenderPool):
+        self.primary = UserbotAccount('main', primary_client, primary_pool)
+        self.accounts = {'main': self.primary}
+        self.pending = OrderedDict()  # name -> 登录中的新账号客户端（内存会话）
+    
+    def _create_account(self, name: str, session_path: str) -> UserbotAccount:
+        account = UserbotAccount(name, TelegramClient(session_path, API_ID, API_HASH))
+        self.accounts[name] = account
+        return account
+    
+    async def load(self):
+        """从数据库加载额外的账号"""
+        try:
+            for row in await get_userbot_accounts_async():
+                if row['name'] not in self.accounts:
+                    self._create_account(row['name'], row['session_path'])
+        except Exception as e:
+            print(f"[AccountPool] 加载账号失败: {e}")
+    
+    async def get_login_client(self, name: str) -> TelegramClient:
+        """
+        获取 /login 流程使用的客户端
+        
+        新账号使用内存会话，登录成功（finish_login）前不写入数据库、不创建会话文件
+        """
+        if name in self.accounts:
+            return self.accounts[name].client
+        if not is_valid_account_name(name):
+            raise ValueError("账号名只能包含字母、数字和下划线（最多32个字符）")
+        client = self.pending.get(name)
+        if client is None:
+            while len(self.pending) >= MAX_PENDING_LOGINS:
+                _, stale = self.pending.popitem(last=False)
+                await stale.disconnect()
+            client = TelegramClient(StringSession(), API_ID, API_HASH)
+            self.pending[name] = client
+        return client
+    
+    async def finish_login(self, name: str):
+        """新账号登录成功后把会话保存为文件，并加入账号池"""
+        client = self.pending.pop(name, None)
+        if client is None:
+            return
+        session_dir = os.path.dirname(USER_SESSION) or '.'
+        os.makedirs(session_dir, exist_ok=True)
+        session_path = os.path.join(session_dir, f"userbot_{name}.session")
+        session = SQLiteSession(session_path)
+        session.set_dc(client.session.dc_id, client.session.server_address, client.session.port)
+        session.auth_key = client.session.auth_key
+        session.save()
+        session.close()
+        await client.disconnect()
+        await save_userbot_account_async(name, session_path)
+        self._create_account(name, session_path)
+        print(f"✅ 新账号 {name} 登录成功，已加入账号池")
+    
+    async def _can_access(self, account: UserbotAccount, chat_id) -> bool:
+        key = str(chat_id)
+        if key in account.chat_access:
+            return True
+        if account.chat_denied.get(key, 0) > time.time():
+            return False
+        if account.is_flood_waiting() or not await account.is_ready():
+            return False
+        try:
+            await account.client.get_entity(chat_id)
+        except FloodWaitError as e:
+            self.mark_flood(account, e.seconds)
+            return False
+        except CHAT_ACCESS_ERRORS:
+            account.chat_denied[key] = time.time() + CHAT_ACCESS_DENIED_TTL
+            return False
+        except Exception as e:
+            # 超时、断线等临时错误不缓存，下次重新检查
+            print(f"[AccountPool] 账号 {account.name} 检查频道 {chat_id} 失败: {e}")
+            return False
+        account.chat_access[key] = True
+        account.chat_denied.pop(key, None)
+        return True
+    
+    async def pick(self, chat_id, exclude=()) -> UserbotAccount:
+        """选择能访问该频道且负载最低的账号，全部处于 FloodWait 时等待最先冷却的账号"""
+        accessible = [
+            account for account in self.accounts.values()
+            if account.name not in exclude and await self._can_access(account, chat_id)
+        ]
+        available = [account for account in accessible if not account.is_flood_waiting()]
+        if available:
+            return min(available, key=lambda account: account.active)
+        if accessible:
+            account = min(accessible, key=lambda account: account.flood_until)
+            wait = account.flood_until - time.time()
+            if wait > 0:
+                print(f"[AccountPool] 所有账号均在 FloodWait，等待 {wait:.0f} 秒")
+                await asyncio.sleep(wait)
+            return account
+        if 'main' not in exclude:
+            # 没有账号确认可访问时仍交给主账号（等待其冷却），由实际请求给出错误
+            wait = self.primary.flood_until - time.time()
+            if wait > 0:
+                print(f"[AccountPool] 主账号在 FloodWait，等待 {wait:.0f} 秒")
+                await asyncio.sleep(wait)
+            return self.primary
+        if exclude:
+            # 其余账号都无法访问该频道，回到已尝试过的账号，等待其 FloodWait 冷却
+            return await self.pick(chat_id)
+        raise Exception("没有可用的 userbot 账号可以访问该频道")
+    
+    def mark_flood(self, account: UserbotAccount, seconds: int):
+        account.flood_until = max(account.flood_until, time.time() + seconds)
+        concurrency_tuner.on_flood_wait()
+        print(f"⚠️ 账号 {account.name} 触发 FloodWait，{seconds} 秒内不再分配任务")
+    
+    async def run(self, chat_id, func):
+        """在选出的账号上执行 func(account)，遇到 FloodWait 时切换账号重试"""
+        tried = set()
+        while True:
+            account = await self.pick(chat_id, exclude=tried)
+            account.active += 1
+            try:
+                return await func(account)
+            except FloodWaitError as e:
+                self.mark_flood(account, e.seconds)
+                tried.add(account.name)
+                if len(tried) >= len(self.accounts):
+                    # 所有账号都试过了，下一轮由 pick 等待冷却
+                    tried = set()
+            finally:
+                account.active -= 1
+    
+    async def warm_up(self):
+        """预热所有已登录账号的连接池"""
+        for account in self.accounts.values():
+            if await account.is_ready():
+                await account.sender_pool.warm_up()
+                account.sender_pool.start()
+            else:
+                print(f"ℹ️ 账号 {account.name} 未登录，跳过连接池预热")
+    
+    def get_status_text(self) -> str:
+        lines = []
+        for account in self.accounts.values():
+            if account.is_flood_waiting():
+                state = f"⏳ FloodWait 剩余 {account.flood_until - time.time():.0f} 秒"
+            else:
+                state = "🟢 可用"
+            lines.append(f"• {account.name}: {state} | 进行中: {account.active}")
+        return "\n".join(lines)
+
+account_pool = AccountPool(userbot, sender_pool)
+
+async def transfer_message_media(chat_id, msg, file_path: str, progress_callback=None, task: 'DownloadTask' = None, resume: bool = True) -> str:
+    """
+    通过账号池下载消息媒体
+    
+    选中的账号与获取 msg 的账号不同时，用该账号重新获取消息（文件引用按账号区分）；
+    FloodWait 切换账号后从断点继续
+    """
+    first_attempt = True
+    
+    async def attempt(account: UserbotAccount):
+        nonlocal first_attempt
+        # 强制重下只在第一次尝试时丢弃旧数据，切换账号后从断点继续
+        attempt_resume = resume or not first_attempt
+        first_attempt = False
+        account_msg = msg
+        if getattr(msg, '_client', None) is not account.client:
+            account_msg = await account.client.get_messages(chat_id, ids=msg.id)
+            if not account_msg:
+                raise Exception(f"账号 {account.name} 无法获取消息 {msg.id}")
+        try:
+            return await transfer_media(
+                account_msg, file_path,
+                progress_callback=progress_callback,
+                task=task,
+                resume=attempt_resume,
+                account=account
+            )
+        except FileReferenceExpiredError:
+            # 缓存的消息文件引用已过期：丢弃缓存，重新获取消息后从断点继续
+            message_cache.invalidate(chat_id, msg.id)
+            if getattr(msg, 'grouped_id', None):
+                album_cache.invalidate(chat_id, msg.grouped_id)
+            account_msg = await account.client.get_messages(chat_id, ids=msg.id)
+            if not account_msg:
+                raise
+            message_cache.put(chat_id, account_msg)
+            return await transfer_media(
+                account_msg, file_path,
+                progress_callback=progress_callback,
+                task=task,
+                resume=True,
+                account=account
+            )
+    return await account_pool.run(chat_id, attempt)
+
+# ====== 相册缓存 ======
+ALBUM_CACHE_TTL = 600  # 相册成员列表的缓存时间（秒）
+ALBUM_CACHE_MAX_ENTRIES = 500
+
+class AlbumCache:
+    """
+    相册成员缓存，按 (chat_id, grouped_id) 保存解析好的成员消息列表
+    
+    链接检查、下载和回调共用同一份结果；同一相册的并发解析只请求一次，
+    过期或下载时遇到文件引用失效才重新获取
+    """
+    def __init__(self, ttl: float = ALBUM_CACHE_TTL, max_entries: int = ALBUM_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}  # (str(chat_id), grouped_id) -> (过期时间, 成员消息列表)
+        self.pending = {}  # 正在解析的相册 -> Future
+    
+    def invalidate(self, chat_id, grouped_id):
+        self.entries.pop((str(chat_id), grouped_id), None)
+    
+    def _prune(self):
+        now = time.time()
+        for key in [key for key, (expires_at, _) in self.entries.items() if expires_at <= now]:
+            del self.entries[key]
+        # 仍然超出上限时丢弃最早加入的条目
+        while len(self.entries) > self.max_entries:
+            del self.entries[next(iter(self.entries))]
+    
+    async def _fetch(self, chat_id, msg) -> list:
+        all_msgs = await account_pool.run(
+            chat_id,
+            lambda account: account.client.get_messages(chat_id, limit=50, min_id=msg.id-25, max_id=msg.id+25)
+        )
+        album = [m for m in all_msgs if getattr(m, 'grouped_id', None) == msg.grouped_id]
+        album.sort(key=lambda m: m.id)
+        for m in album:
+            message_cache.put(chat_id, m)
+        return album
+    
+    async def get(self, chat_id, msg) -> list:
+        """获取 msg 所在相册的全部消息（按消息ID排序）"""
+        key = (str(chat_id), msg.grouped_id)
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.time():
+            return entry[1]
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key])
+        
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        try:
+            album = await self._fetch(chat_id, msg)
+            if album:
+                self.entries[key] = (time.time() + self.ttl, album)
+                self._prune()
+            future.set_result(album)
+            return album
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            del self.pending[key]
+
+album_cache = AlbumCache()
+
+# ====== 消息缓存 ======
+MESSAGE_CACHE_SIZE = 2000  # 最多缓存的消息数
+MESSAGE_CACHE_TTL = 1800  # 消息的缓存时间（秒），在文件引用通常失效之前过期
+
+class MessageCache:
+    """
+    按 (chat_id, msg_id) 缓存已获取的消息，LRU 淘汰
+    
+    链接检查、回调和下载函数先查缓存再请求；
+    下载时遇到文件引用失效会立即丢弃对应条目
+    """
+    def __init__(self, max_size: int = MESSAGE_CACHE_SIZE, ttl: float = MESSAGE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # (str(chat_id), msg_id) -> (过期时间, 消息)
+    
+    def get(self, chat_id, msg_id):
+        key = (str(chat_id), msg_id)
+        entry = self.entries.get(key)
+        if not entry:
+            return None
+        if entry[0] <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+    
+    def put(self, chat_id, msg):
+        if not msg:
+            return
+        key = (str(chat_id), msg.id)
+        self.entries[key] = (time.time() + self.ttl, msg)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    def invalidate(self, chat_id, msg_id):
+        self.entries.pop((str(chat_id), msg_id), None)
+
+message_cache = MessageCache()
+
+# ====== 批量消息获取 ======
+MESSAGE_BATCH_DELAY = 0.01  # 收集同一频道单条请求的时间窗口（秒）
+MESSAGE_BATCH_SIZE = 100  # 单次 get_messages 最多请求的消息数
+
+class MessageLoader:
+    """
+    合并并发的单条消息请求
+    
+    同一频道在时间窗口内的请求合并为一次最多 100 个 ID 的 get_messages，
+    结果再分发给各个等待者，突发负载下减少 RPC 次数和 FloodWait
+    """
+    def __init__(self, delay: float = MESSAGE_BATCH_DELAY, batch_size: int = MESSAGE_BATCH_SIZE):
+        self.delay = delay
+        self.batch_size = batch_size
+        self.batches = {}  # str(chat_id) -> (chat_id, {msg_id: [Future]})
+    
+    def load(self, chat_id, msg_id) -> asyncio.Future:
+        key = str(chat_id)
+        if key not in self.batches:
+            self.batches[key] = (chat_id, {})
+            asyncio.get_running_loop().call_later(self.delay, self._dispatch, key)
+        waiters = self.batches[key][1]
+        future = asyncio.get_running_loop().create_future()
+        waiters.setdefault(msg_id, []).append(future)
+        if len(waiters) >= self.batch_size:
+            self._dispatch(key)
+        return future
+    
+    def _dispatch(self, key: str):
+        batch = self.batches.pop(key, None)
+        if batch:
+            # 保留任务引用，避免进行中的请求被回收导致等待者永远挂起
+            schedule_background(self._fetch(*batch))
+    
+    async def _fetch(self, chat_id, waiters: dict):
+        ids = list(waiters)
+        try:
+            messages = await account_pool.run(chat_id, lambda account: account.client.get_messages(chat_id, ids=ids))
+        except BaseException as e:
+            # 被取消时也要结束所有等待者，否则调用方会一直挂起
+            for futures in waiters.values():
+                for future in futures:
+                    if future.done():
+                        continue
+                    if isinstance(e, asyncio.CancelledError):
+                        future.cancel()
+                    else:
+                        future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        # 按 ID 请求时结果与 ids 一一对应，不存在的消息为 None
+        for msg_id, msg in zip(ids, messages):
+            for future in waiters[msg_id]:
+                if not future.done():
+                    future.set_result(msg)
+
+message_loader = MessageLoader()
+
+async def get_message(chat_id, msg_id):
+    """获取单条消息，优先使用缓存，未命中时与其他并发请求合并获取"""
+    msg = message_cache.get(chat_id, msg_id)
+    if msg is None:
+        msg = await message_loader.load(chat_id, msg_id)
+        message_cache.put(chat_id, msg)
+    return msg
+
+async def download_single_file(chat_id, msg_id, download_path=None, progress_callback=None, bot_chat_id=None, user_id=None, force_redownload=False, skip_existing=True, priority=PRIORITY_INTERACTIVE, job_type='single', task_id=None):
+    """下载单个文件（非相册）
+    
+    priority: 调度优先级，批量任务传入 PRIORITY_BULK
+    job_type: 记入任务日志的任务类型（single、album、range、comments）
+    task_id: 重启后重新执行时沿用的原任务ID
+    """
     await ensure_userbot()
-    msg = await userbot.get_messages(chat_id, ids=msg_id)
+    msg = await get_message(chat_id, msg_id)
     if not msg:
         return ['未找到消息']
     
@@ -4567,20 +7266,20 @@ async def download_single_file(chat_id, msg_id, download_path=None, progress_cal
             print(f"[download_single_file] 文件完整，跳过下载")
             return [f'✅ 消息 {msg.id} 的文件已存在且完整，跳过下载: {os.path.basename(existing_file_path)}']
         else:
-            # 文件不完整，继续下载但可能需要删除现有文件
-            print(f"[download_single_file] 文件不完整，将重新下载")
+            # 文件不完整，保留已下载的部分用于断点续传
+            print(f"[download_single_file] 文件不完整，将从断点继续下载")
             if existing_file_path != full_file_path:
-                # 如果现有文件路径与目标路径不同，删除现有文件
+                # 如果现有文件路径与目标路径不同，移动到目标路径后续传
                 try:
-                    os.remove(existing_file_path)
-                    print(f"[download_single_file] 删除不完整的现有文件: {existing_file_path}")
+                    relocate_download(existing_file_path, full_file_path)
+                    print(f"[download_single_file] 移动不完整的现有文件: {existing_file_path} -> {full_file_path}")
                 except Exception as e:
-                    print(f"[download_single_file] 删除现有文件失败: {e}")
+                    print(f"[download_single_file] 移动现有文件失败: {e}")
     
     # 如果强制重新下载且找到现有文件，删除它
     if force_redownload and existing_file_found:
         try:
-            os.remove(existing_file_path)
+            remove_download_file(existing_file_path)
             print(f"[download_single_file] 强制重下载，删除现有文件: {existing_file_path}")
         except Exception as e:
             print(f"[download_single_file] 删除现有文件失败: {e}")
@@ -4592,7 +7291,7 @@ async def download_single_file(chat_id, msg_id, download_path=None, progress_cal
     # 如果强制重新下载，删除现有文件
     if force_redownload and file_exists:
         try:
-            os.remove(existing_path)
+            remove_download_file(existing_path)
             print(f"[download_single_file] 删除现有文件进行强制重下: {os.path.basename(existing_path)}")
             file_exists = False
             local_size = 0
@@ -4607,7 +7306,10 @@ async def download_single_file(chat_id, msg_id, download_path=None, progress_cal
     refresh_interval = get_refresh_interval()
     
     # 创建下载任务
-    task_id = download_manager.add_task(chat_id, msg.id, filename, user_id or 0)
+    task_id = download_manager.add_task(
+        chat_id, msg.id, filename, user_id or 0, task_id=task_id,
+        job_type=job_type, file_path=full_file_path, bot_chat_id=bot_chat_id, priority=priority
+    )
     task = download_manager.get_task(task_id)
     
     sent_msg = None
@@ -4635,10 +7337,11 @@ async def download_single_file(chat_id, msg_id, download_path=None, progress_cal
         
         # 更新任务进度信息
         now = time.time()
-        task.progress = current / total_bytes if total_bytes else 0
-        task.total_size = total_bytes
-        task.current_size = current
-        task.speed = (current - last_bytes[0]) / (now - last_update + 1e-6) if now > last_update else 0
+        # 已下载的字节数经 task_state_writer 合并写入任务日志
+        task.update_progress(
+            current / total_bytes if total_bytes else 0, current, total_bytes,
+            (current - last_bytes[0]) / (now - last_update + 1e-6) if now > last_update else 0
+        )
         
         percent = int(current * 100 / total_bytes) if total_bytes else 0
         speed_str = f"{task.speed/1024/1024:.2f}MB/s" if task.speed > 1024*1024 else f"{task.speed/1024:.2f}KB/s"
@@ -4673,17 +7376,20 @@ async def download_single_file(chat_id, msg_id, download_path=None, progress_cal
     if final_existing_found and skip_existing and not force_redownload:
         if expected_size == 0 or final_existing_size == expected_size:
             print(f"[download_single_file] 最终检查: 消息 {msg.id} 的文件已完整，取消下载任务")
-            task.status = "completed"
+            task.set_status("completed")
             download_manager.remove_completed_task(task_id)
             return [f'✅ 消息 {msg.id} 的文件已存在且完整，跳过下载: {os.path.basename(final_existing_path)}']
     
     print(f"[download_single_file] 开始实际下载: {filename}")
     try:
         file = await download_manager.run(
-            userbot.download_media(msg, file=full_file_path, progress_callback=progress_with_task_control)
+            transfer_message_media(chat_id, msg, full_file_path, progress_callback=progress_with_task_control, task=task, resume=not force_redownload),
+            user_id=user_id or 0,
+            priority=priority,
+            task=task
         )
         saved_files.append(file)
-        task.status = "completed"
+        task.set_status("completed")
         if sent_msg:
             await bot.edit_message_text(
                 chat_id=sent_msg.chat.id, 
@@ -4693,10 +7399,11 @@ async def download_single_file(chat_id, msg_id, download_path=None, progress_cal
         if progress_callback:
             await progress_callback(1, 1)
     except asyncio.CancelledError:
-        # 任务被取消，不需要额外处理
-        pass
+        # 用户取消任务时不需要额外处理；外部取消（范围任务被取消、程序退出）继续向上传播
+        if not task.cancel_event.is_set():
+            raise
     except Exception as e:
-        task.status = "failed"
+        task.set_status("failed")
         if sent_msg:
             await bot.edit_message_text(
                 chat_id=sent_msg.chat.id, 
@@ -4711,17 +7418,15 @@ async def download_single_file(chat_id, msg_id, download_path=None, progress_cal
     
     return saved_files
 
-async def download_album(chat_id, msg_id, download_path=None, progress_callback=None, bot_chat_id=None, user_id=None, force_redownload=False, skip_existing=True):
+async def download_album(chat_id, msg_id, download_path=None, progress_callback=None, bot_chat_id=None, user_id=None, force_redownload=False, skip_existing=True, priority=PRIORITY_INTERACTIVE, job_type='album'):
     await ensure_userbot()
-    msg = await userbot.get_messages(chat_id, ids=msg_id)
+    msg = await get_message(chat_id, msg_id)
     if not msg:
         return ['未找到消息']
     if not msg.grouped_id:
         return ['消息不是相册']
     # 获取同一 grouped_id 的所有消息
-    all_msgs = await userbot.get_messages(chat_id, limit=50, min_id=msg.id-25, max_id=msg.id+25)
-    album = [m for m in all_msgs if getattr(m, 'grouped_id', None) == msg.grouped_id]
-    album.sort(key=lambda m: m.id)
+    album = await album_cache.get(chat_id, msg)
     
     # 获取频道信息用于路径生成
     chat_title = await get_chat_info(chat_id) if not download_path else None
@@ -4780,20 +7485,20 @@ async def download_album(chat_id, msg_id, download_path=None, progress_callback=
                         await progress_callback(idx, total)
                     return
                 else:
-                    # 文件不完整，继续下载但可能需要删除现有文件
-                    print(f"[download_album] 文件不完整，将重新下载")
+                    # 文件不完整，保留已下载的部分用于断点续传
+                    print(f"[download_album] 文件不完整，将从断点继续下载")
                     if existing_file_path != full_file_path:
-                        # 如果现有文件路径与目标路径不同，删除现有文件
+                        # 如果现有文件路径与目标路径不同，移动到目标路径后续传
                         try:
-                            os.remove(existing_file_path)
-                            print(f"[download_album] 删除不完整的现有文件: {existing_file_path}")
+                            relocate_download(existing_file_path, full_file_path)
+                            print(f"[download_album] 移动不完整的现有文件: {existing_file_path} -> {full_file_path}")
                         except Exception as e:
-                            print(f"[download_album] 删除现有文件失败: {e}")
+                            print(f"[download_album] 移动现有文件失败: {e}")
             
             # 如果强制重新下载且找到现有文件，删除它
             if force_redownload and existing_file_found:
                 try:
-                    os.remove(existing_file_path)
+                    remove_download_file(existing_file_path)
                     print(f"[download_album] 强制重下载，删除现有文件: {existing_file_path}")
                 except Exception as e:
                     print(f"[download_album] 删除现有文件失败: {e}")
@@ -4803,20 +7508,23 @@ async def download_album(chat_id, msg_id, download_path=None, progress_callback=
             file_exists, existing_path, local_size = check_message_file_exists(folder, m.id, expected_size)
             
             if file_exists and not force_redownload and local_size != expected_size:
-                # 文件存在但大小不匹配，需要重新下载
-                print(f"[download_album] 文件大小不匹配，重新下载: {os.path.basename(existing_path)} ({local_size}/{expected_size})")
+                # 文件存在但大小不匹配，从断点继续下载
+                print(f"[download_album] 文件不完整，继续下载: {os.path.basename(existing_path)} ({local_size}/{expected_size})")
             
             if force_redownload and file_exists:
                 # 强制重新下载，删除现有文件
                 try:
-                    os.remove(existing_path)
+                    remove_download_file(existing_path)
                     file_exists = False
                     local_size = 0
                 except Exception as e:
                     print(f"[download_album] 删除现有文件失败: {e}")
             
             # 创建下载任务
-            task_id = download_manager.add_task(chat_id, m.id, filename, user_id or 0)
+            task_id = download_manager.add_task(
+                chat_id, m.id, filename, user_id or 0,
+                job_type=job_type, file_path=full_file_path, bot_chat_id=bot_chat_id, priority=priority
+            )
             task = download_manager.get_task(task_id)
             
             sent_msg = None
@@ -4844,10 +7552,11 @@ async def download_album(chat_id, msg_id, download_path=None, progress_callback=
                 
                 # 更新任务进度信息
                 now = time.time()
-                task.progress = current / total_bytes if total_bytes else 0
-                task.total_size = total_bytes
-                task.current_size = current
-                task.speed = (current - last_bytes[0]) / (now - last_update + 1e-6) if now > last_update else 0
+                # 已下载的字节数经 task_state_writer 合并写入任务日志
+                task.update_progress(
+                    current / total_bytes if total_bytes else 0, current, total_bytes,
+                    (current - last_bytes[0]) / (now - last_update + 1e-6) if now > last_update else 0
+                )
                 
                 percent = int(current * 100 / total_bytes) if total_bytes else 0
                 speed_str = f"{task.speed/1024/1024:.2f}MB/s" if task.speed > 1024*1024 else f"{task.speed/1024:.2f}KB/s"
@@ -4882,7 +7591,7 @@ async def download_album(chat_id, msg_id, download_path=None, progress_callback=
             if final_existing_found and skip_existing and not force_redownload:
                 if expected_size == 0 or final_existing_size == expected_size:
                     print(f"[download_album] 最终检查: 消息 {m.id} 的文件已完整，跳过下载")
-                    task.status = "completed"
+                    task.set_status("completed")
                     skipped_files.append(f"✅ {os.path.basename(final_existing_path)}")
                     download_manager.remove_completed_task(task_id)
                     if progress_callback:
@@ -4891,9 +7600,14 @@ async def download_album(chat_id, msg_id, download_path=None, progress_callback=
             
             print(f"[download_album] 开始实际下载: {filename}")
             try:
-                file = await userbot.download_media(m, file=full_file_path, progress_callback=progress_with_task_control)
+                file = await download_manager.run(
+                    transfer_message_media(chat_id, m, full_file_path, progress_callback=progress_with_task_control, task=task, resume=not force_redownload),
+                    user_id=user_id or 0,
+                    priority=priority,
+                    task=task
+                )
                 saved_files.append(file)
-                task.status = "completed"
+                task.set_status("completed")
                 if sent_msg:
                     await bot.edit_message_text(
                         chat_id=sent_msg.chat.id, 
@@ -4903,10 +7617,11 @@ async def download_album(chat_id, msg_id, download_path=None, progress_callback=
                 if progress_callback:
                     await progress_callback(idx, total)
             except asyncio.CancelledError:
-                # 任务被取消，不需要额外处理
-                pass
+                # 用户取消任务时不需要额外处理；外部取消（范围任务被取消、程序退出）继续向上传播
+                if not task.cancel_event.is_set():
+                    raise
             except Exception as e:
-                task.status = "failed"
+                task.set_status("failed")
                 if sent_msg:
                     await bot.edit_message_text(
                         chat_id=sent_msg.chat.id, 
@@ -4918,7 +7633,7 @@ async def download_album(chat_id, msg_id, download_path=None, progress_callback=
                 # 清理已完成的任务
                 download_manager.remove_completed_task(task_id)
     
-    tasks = [download_manager.run(download_one_with_task_control(idx, m)) for idx, m in enumerate(album, 1)]
+    tasks = [download_one_with_task_control(idx, m) for idx, m in enumerate(album, 1)]
     try:
         await asyncio.gather(*tasks, return_exceptions=True)
     except Exception as e:
@@ -4929,29 +7644,87 @@ async def download_album(chat_id, msg_id, download_path=None, progress_callback=
         return ['all_skipped']
     return saved_files + skipped_files
 
-def add_auto_download(chat):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('INSERT OR IGNORE INTO auto_download (chat) VALUES (?)', (chat,))
-    conn.commit()
-    conn.close()
 # ====== 启动 ======
+async def run_startup_phases():
+    """
+    启动的后台阶段，在机器人和网页服务开始响应之后依次执行
+    """
+    phases = [
+        # 恢复未完成的任务（优先读取退出时的快照）
+        ("恢复未完成的任务", restore_pending_tasks),
+        # 继续未完成的范围下载
+        ("继续范围下载", resume_range_jobs),
+        # 设置关键词监听
+        ("设置关键词监听", setup_keyword_monitors),
+        # 预热各账号的媒体 DC 连接池（未登录的账号跳过，首次下载时再建立）
+        ("预热连接池", account_pool.warm_up),
+    ]
+    for name, phase in phases:
+        started = time.time()
+        try:
+            await phase()
+            print(f"[startup] {name}完成，用时 {time.time() - started:.1f} 秒")
+        except Exception as e:
+            print(f"ℹ️ 启动阶段「{name}」失败: {e}")
+
+SHUTDOWN_TIMEOUT = 10  # 退出时等待被取消的协程结束的最长时间（秒）
+
+async def cancel_running_tasks():
+    """
+    退出时取消当前协程以外的所有协程并等待它们结束
+    
+    包括启动阶段、background_tasks 中的任务重放、range_job_tasks 中的范围任务，
+    以及机器人命令中正在执行的下载
+    """
+    current = asyncio.current_task()
+    tasks = [task for task in asyncio.all_tasks() if task is not current and not task.done()]
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=SHUTDOWN_TIMEOUT)
+        if pending:
+            print(f"[shutdown] {len(pending)} 个协程在 {SHUTDOWN_TIMEOUT} 秒内未结束")
+
 async def main():
-    # 初始化数据库
-    init_db()
+    # 关键路径：只做响应命令之前必需的初始化
+    await async_db.write(init_db)
+    # 旧数据库一次性切换为增量回收，此时还没有其他读写在排队
+    await async_db.write(enable_incremental_vacuum)
+    # download_manager 在导入时按当时的设置快照创建，按建表后的设置更新并发数
+    download_manager.update_limit(get_max_concurrent_downloads())
     
-    # 恢复未完成的任务
-    await restore_pending_tasks()
+    # 加载额外的 userbot 账号
+    await account_pool.load()
     
-    # 设置关键词监听
-    await setup_keyword_monitors()
+    # 开启了自动调节时启动并发数调节器
+    if get_auto_concurrency():
+        concurrency_tuner.start()
+    
+    # 定期归档过期的任务记录
+    task_retention.start()
+    
+    # 其余启动工作在后台进行，退出时由 cancel_running_tasks 取消
+    schedule_background(run_startup_phases())
     
     config = uvicorn.Config(app, host="0.0.0.0", port=8000, loop="asyncio")
     server = uvicorn.Server(config)
-    await asyncio.gather(
-        server.serve(),
-        dp.start_polling(bot)
-    )
+    try:
+        await asyncio.gather(
+            server.serve(),
+            dp.start_polling(bot)
+        )
+    finally:
+        # 先停止启动阶段、后台重放、范围任务和进行中的下载，之后任务状态不再变化；
+        # 被取消的下载保持 running，下次启动时继续
+        await cancel_running_tasks()
+        # 写入尚未落盘的任务进度，再在写线程中（排在这些写入之后）保存未完成任务的快照
+        task_state_writer.flush()
+        try:
+            await async_db.write(write_task_snapshot)
+        except Exception as e:
+            print(f"[startup] 保存任务快照失败: {e}")
+        async_db.close()
+        close_db()
 
 if __name__ == '__main__':
     asyncio.run(main())